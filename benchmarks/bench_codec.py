@@ -0,0 +1,53 @@
+"""
+Benchmark of the JSON codec (wzdx_sandbox.codec) against the standard library
+json module on the newline JSON records the lake ingest reads and writes.
+
+Run from the repo's root folder:
+
+    python -m benchmarks.bench_codec [n_features] [n_repeats]
+
+"""
+import json
+import sys
+import timeit
+
+from benchmarks.feeds import make_snapshot
+from wzdx_sandbox import codec
+
+
+def _best(func, n_repeats):
+    return min(timeit.repeat(func, number=1, repeat=n_repeats))
+
+
+def run(n_features=2000, n_repeats=5):
+    """
+    Times serializing each feature to a newline JSON line and parsing the
+    lines back, with the standard library and with the codec.
+
+    Returns:
+        Array of result dictionary objects, one per feed version.
+    """
+    results = []
+    for version in ['2.0', '3.0', '4.0']:
+        features = make_snapshot(version, n_features)['features']
+        json_lines = [json.dumps(f).encode('utf-8') for f in features]
+        codec_lines = [codec.dumps(f) for f in features]
+        result = {
+            'version': version,
+            'n_features': n_features,
+            'backend': codec.BACKEND,
+            'json_dumps_s': _best(lambda: [json.dumps(f).encode('utf-8') for f in features], n_repeats),
+            'codec_dumps_s': _best(lambda: [codec.dumps(f) for f in features], n_repeats),
+            'json_loads_s': _best(lambda: [json.loads(line) for line in json_lines], n_repeats),
+            'codec_loads_s': _best(lambda: [codec.loads(line) for line in codec_lines], n_repeats),
+        }
+        result['dumps_speedup'] = round(result['json_dumps_s'] / result['codec_dumps_s'], 2)
+        result['loads_speedup'] = round(result['json_loads_s'] / result['codec_loads_s'], 2)
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:3]]
+    for result in run(*args):
+        print(json.dumps(result))
@@ -0,0 +1,279 @@
+"""
+Benchmark of the lake ingest (WorkZoneSandbox.ingest) on synthetic feeds
+(see benchmarks.feeds), against an in-memory S3 stand-in
+(benchmarks.local_s3.LocalS3Client) that counts calls and bytes.
+
+Scenarios, for each spec version and feed size:
+
+- cold: first snapshot of a feed, into an empty lake.
+- steady: the same snapshot again, nothing changed.
+- churn: the next snapshot of the feed, with a share of its work zones changed.
+
+Each scenario runs in a fresh process, so that its peak RSS is its own, and
+reports throughput, p50/p99 latency of the work zone statuses that were
+merged into their work zone file (statuses skipped by the digest index are
+not timed), peak RSS and S3 calls.
+
+Run from the repo's root folder:
+
+    python -m benchmarks.bench_ingest [--sizes 10 1000 50000] [--save-baseline]
+
+Results are compared with the baseline file, and the command exits with status
+1 if any scenario regressed. Timings depend on the machine, so save a baseline
+on the machine you compare on; S3 call counts do not.
+
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import logging
+import os
+import resource
+import sys
+import time
+
+from benchmarks.feeds import churn, make_snapshot, to_bytes
+from benchmarks.local_s3 import LocalS3Client
+from wzdx_sandbox import digest_index
+from wzdx_sandbox.s3_helper import S3Helper
+from wzdx_sandbox.wzdx_sandbox import WorkZoneSandbox
+
+
+SCENARIOS = ('cold', 'steady', 'churn')
+VERSIONS = ('1.1', '2.0', '3.0', '4.1')
+DEFAULT_SIZES = (10, 1000)
+DEFAULT_CHURN = 0.2
+DEFAULT_REPEATS = 3
+# relative change of a timing, or of the peak RSS, reported as a regression
+DEFAULT_TOLERANCE = 0.5
+# timings of scenarios shorter than this are too noisy to compare
+MIN_COMPARED_SECONDS = 0.05
+# the sandboxes log through this logger, so that their progress messages are not printed
+logger = logging.getLogger(__name__)
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baselines', 'bench_ingest.json')
+
+
+class TimedSandbox(WorkZoneSandbox):
+    """
+    WorkZoneSandbox that records how long each work zone status takes to merge.
+
+    """
+    def __init__(self, *args, **kwargs):
+        super(TimedSandbox, self).__init__(*args, **kwargs)
+        self.latencies = []
+
+    def process_records(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super(TimedSandbox, self).process_records(*args, **kwargs)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(round(q * (len(values) - 1))), len(values) - 1)]
+
+
+def _feed(version):
+    return {'feedname': 'bench', 'state': 'XX', 'version': version.split('.')[0],
+            'format': 'xml' if version.startswith('1') else 'geojson'}
+
+
+def run_scenario(scenario, version, n_features, churn_fraction=DEFAULT_CHURN, sandbox_args=None):
+    """
+    Runs one scenario in the current process.
+
+    Parameters:
+        scenario: 'cold', 'steady' or 'churn'.
+        version: Spec version of the feed, e.g. '4.1'.
+        n_features: Number of work zones in the feed.
+        churn_fraction: Optional share of work zones changed in the churn scenario.
+        sandbox_args: Optional dictionary of other arguments of WorkZoneSandbox
+            (e.g. layout, compression, max_workers). The digest index is on,
+            in a separate state bucket, unless use_digest_index is False.
+    Returns:
+        Result dictionary object.
+    """
+    digest_index.clear_cache()
+    client = LocalS3Client()
+
+    def make_sandbox():
+        return TimedSandbox('bench-bucket', feed=_feed(version), s3helper=S3Helper(client=client),
+            logger=logger, **dict({'use_digest_index': True, 'state_bucket': 'bench-state'}, **(sandbox_args or {})))
+
+    snapshot = make_snapshot(version, n_features)
+    if scenario == 'cold':
+        data = to_bytes(snapshot)
+    elif scenario == 'steady':
+        make_sandbox().ingest(to_bytes(snapshot))
+        data = to_bytes(snapshot)
+    elif scenario == 'churn':
+        # two snapshots already, so that unchanged work zones take the overwrite path
+        second = churn(snapshot, 0, seed=1)
+        make_sandbox().ingest(to_bytes(snapshot))
+        make_sandbox().ingest(to_bytes(second))
+        data = to_bytes(churn(second, churn_fraction, seed=2))
+    else:
+        raise ValueError('scenario must be one of {}, got {}'.format(SCENARIOS, scenario))
+
+    calls = dict(client.calls)
+    bytes_read, bytes_written = client.bytes_read, client.bytes_written
+    sandbox = make_sandbox()
+    start = time.perf_counter()
+    report = sandbox.ingest(data)
+    wall_seconds = time.perf_counter() - start
+
+    s3_calls = {op: n - calls.get(op, 0) for op, n in client.calls.items() if n - calls.get(op, 0)}
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    p50 = percentile(sandbox.latencies, 0.5)
+    p99 = percentile(sandbox.latencies, 0.99)
+    return {
+        'scenario': scenario,
+        'version': version,
+        'n_features': n_features,
+        'n_bytes': len(data),
+        'wall_seconds': round(wall_seconds, 6),
+        'features_per_second': round(n_features / wall_seconds, 1),
+        'n_timed': len(sandbox.latencies),
+        'p50_ms': round(p50 * 1000, 3) if p50 is not None else None,
+        'p99_ms': round(p99 * 1000, 3) if p99 is not None else None,
+        # kilobytes on Linux, bytes on macOS
+        'peak_rss_mb': round(max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1),
+        's3_calls': s3_calls,
+        's3_bytes_read': client.bytes_read - bytes_read,
+        's3_bytes_written': client.bytes_written - bytes_written,
+        'outcomes': report.outcomes,
+        'phase_cpu_seconds': {phase: round(seconds, 6) for phase, seconds in report.phase_cpu_seconds.items()},
+    }
+
+
+def run(sizes=DEFAULT_SIZES, versions=VERSIONS, scenarios=SCENARIOS, churn_fraction=DEFAULT_CHURN,
+        sandbox_args=None, isolate=True, repeats=DEFAULT_REPEATS):
+    """
+    Runs every scenario for every version and size.
+
+    Parameters:
+        isolate: Optional. If True (default), each scenario runs in a fresh
+            process, otherwise in this one.
+        repeats: Optional number of runs of each scenario. The best value of
+            each timing over the runs is kept, as timings only get worse from
+            noise (e.g. other processes, garbage collection).
+    Returns:
+        Array of result dictionary objects.
+    """
+    results = []
+    for n_features in sizes:
+        for version in versions:
+            for scenario in scenarios:
+                args = (scenario, version, n_features, churn_fraction, sandbox_args)
+                runs = []
+                for _ in range(repeats):
+                    if isolate:
+                        with ProcessPoolExecutor(max_workers=1) as executor:
+                            runs.append(executor.submit(run_scenario, *args).result())
+                    else:
+                        runs.append(run_scenario(*args))
+                results.append(_best(runs))
+    return results
+
+
+def _best(runs):
+    result = max(runs, key=lambda run: run['features_per_second'])
+    for field in ['p50_ms', 'p99_ms']:
+        values = [run[field] for run in runs if run[field] is not None]
+        result[field] = min(values) if values else None
+    return result
+
+
+def result_key(result):
+    return '{scenario}/v{version}/{n_features}'.format(**result)
+
+
+def load_baseline(path=BASELINE_PATH):
+    try:
+        with open(path) as in_f:
+            return json.load(in_f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(results, path=BASELINE_PATH):
+    """
+    Stores results as the baseline, keyed by scenario, version and size.
+    Baselines of other scenarios already in the file are kept.
+
+    """
+    baseline = load_baseline(path)
+    baseline.update({result_key(result): result for result in results})
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as out_f:
+        json.dump(baseline, out_f, indent=2, sort_keys=True)
+        out_f.write('\n')
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares results with a baseline.
+
+    Returns:
+        Array of strings describing each regression: more S3 calls of any
+        operation, higher peak RSS, or, for scenarios that take at least
+        MIN_COMPARED_SECONDS, lower throughput or higher p99 latency, by more
+        than tolerance.
+    """
+    regressions = []
+    for result in results:
+        key = result_key(result)
+        base = baseline.get(key)
+        if base is None:
+            continue
+        for op, n in sorted(result['s3_calls'].items()):
+            if n > base['s3_calls'].get(op, 0):
+                regressions.append('{}: {} {} calls, baseline {}'.format(key, n, op, base['s3_calls'].get(op, 0)))
+        fields = ['peak_rss_mb']
+        if base['wall_seconds'] >= MIN_COMPARED_SECONDS:
+            fields.append('p99_ms')
+            if result['features_per_second'] < base['features_per_second'] * (1 - tolerance):
+                regressions.append('{}: {} features/s, baseline {}'.format(
+                    key, result['features_per_second'], base['features_per_second']))
+        for field in fields:
+            if result[field] is not None and base.get(field) is not None and result[field] > base[field] * (1 + tolerance):
+                regressions.append('{}: {} {}, baseline {}'.format(key, field, result[field], base[field]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES))
+    parser.add_argument('--versions', nargs='+', default=list(VERSIONS))
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument('--churn', type=float, default=DEFAULT_CHURN, help='share of work zones changed')
+    parser.add_argument('--layout', default='ndjson')
+    parser.add_argument('--compression', default=None)
+    parser.add_argument('--max-workers', type=int, default=None)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    parser.add_argument('--no-isolate', action='store_true', help='run all scenarios in this process')
+    args = parser.parse_args(argv)
+
+    sandbox_args = {'layout': args.layout, 'compression': args.compression, 'max_workers': args.max_workers}
+    results = run(args.sizes, args.versions, args.scenarios, args.churn, sandbox_args, not args.no_isolate,
+        args.repeats)
+    for result in results:
+        print(json.dumps(result))
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        return 0
+    regressions = compare(results, load_baseline(args.baseline), args.tolerance)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
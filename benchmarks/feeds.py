@@ -0,0 +1,173 @@
+"""
+Generators of synthetic WZDx feed snapshots for the benchmarks: version 1 XML
+and version 2, 3 and 4 GeoJSON feeds of any size, and successive snapshots of
+a feed with a configurable share of work zones changing between them.
+
+"""
+from copy import deepcopy
+from datetime import datetime, timedelta
+import json
+import random
+
+import xmltodict
+
+
+UPDATE_DATE = '2021-03-01T12:00:00Z'
+
+
+def _coordinates(rng, n_points=20):
+    lon, lat = rng.uniform(-120, -75), rng.uniform(30, 45)
+    return [[round(lon + i * 0.0007, 6), round(lat + i * 0.0005, 6)] for i in range(n_points)]
+
+
+def _v2_feature(rng, i):
+    return {
+        'type': 'Feature',
+        'properties': {
+            'road_event_id': 'wz{}'.format(i), 'data_source_id': 'src1', 'event_type': 'work-zone',
+            'road_name': 'I-{}'.format(rng.randint(1, 99)), 'direction': 'northbound',
+            'beginning_cross_street': 'Exit {}'.format(rng.randint(1, 300)), 'vehicle_impact': 'some-lanes-closed',
+            'start_date': '2021-03-01T08:00:00Z', 'end_date': '2021-04-01T18:00:00Z',
+            'description': 'Lane closure – résurfaçage', 'creation_date': '2021-02-20T08:00:00Z',
+            'update_date': '2021-03-01T12:00:00Z', 'lanes': [
+                {'order': n, 'type': 'general', 'status': 'open' if n else 'closed'} for n in range(3)
+            ]
+        },
+        'geometry': {'type': 'LineString', 'coordinates': _coordinates(rng)}
+    }
+
+
+def _v4_feature(rng, i):
+    feature = _v2_feature(rng, i)
+    props = feature['properties']
+    feature['id'] = props.pop('road_event_id')
+    feature['properties'] = {
+        'core_details': {
+            'event_type': props.pop('event_type'), 'data_source_id': props.pop('data_source_id'),
+            'road_names': [props.pop('road_name')], 'direction': props.pop('direction'),
+            'description': props.pop('description'), 'creation_date': props.pop('creation_date'),
+            'update_date': props.pop('update_date')
+        },
+        'start_date': props.pop('start_date'), 'end_date': props.pop('end_date'),
+        'is_start_date_verified': False, 'is_end_date_verified': False,
+        'location_method': 'channel-device-method', 'vehicle_impact': props.pop('vehicle_impact'),
+        'lanes': props.pop('lanes')
+    }
+    return feature
+
+
+def _v1_activity(rng, i):
+    return {
+        'identifier': 'wz{}'.format(i), 'subidentifier': 'seg1',
+        'startDateTime': '2021-03-01T08:00:00Z', 'endDateTime': '2021-04-01T18:00:00Z',
+        'beginLocation': {'roadDirection': 'northbound', 'roadName': 'I-{}'.format(rng.randint(1, 99)),
+                          'latitude': str(round(rng.uniform(30, 45), 6)), 'longitude': str(round(rng.uniform(-120, -75), 6))},
+        'endLocation': {'roadDirection': 'northbound', 'latitude': str(round(rng.uniform(30, 45), 6)),
+                        'longitude': str(round(rng.uniform(-120, -75), 6))},
+        'wzStatus': 'active', 'totalLanes': '3', 'lanesAffected': 'some-lanes-closed',
+        'workersPresent': 'true', 'description': 'Lane closure'
+    }
+
+
+def _make_feature(version, rng, i):
+    if version.startswith('1'):
+        return _v1_activity(rng, i)
+    if version.startswith('4'):
+        return _v4_feature(rng, i)
+    feature = _v2_feature(rng, i)
+    if version.startswith('3'):
+        feature['properties']['road_names'] = [feature['properties'].pop('road_name')]
+    return feature
+
+
+def make_snapshot(version, n_features, seed=0, update_date=UPDATE_DATE):
+    """
+    Builds a synthetic WZDx feed snapshot.
+
+    Parameters:
+        version: '1.1', '2.0', '3.0' or '4.0'. Version 1 snapshots are
+            rendered as XML by to_bytes, the others as GeoJSON.
+        n_features: Number of work zone features.
+        seed: Seed of the random generator.
+        update_date: Optional update date of the feed.
+    Returns:
+        Dictionary object of the feed.
+    """
+    rng = random.Random(seed)
+    features = [_make_feature(version, rng, i) for i in range(n_features)]
+    if version.startswith('1'):
+        return {'WZDx': {'Header': {'timeStampUpdate': update_date, 'versionNo': version},
+                         'WorkZoneActivity': features}}
+    header_field_name = 'feed_info' if version.startswith('4') else 'road_event_feed_info'
+    update_time_field_name = 'feed_update_date' if version.startswith('2') else 'update_date'
+    return {header_field_name: {update_time_field_name: update_date, 'version': version},
+            'type': 'FeatureCollection', 'features': features}
+
+
+def _activities(snapshot):
+    if 'WZDx' in snapshot:
+        return snapshot['WZDx']['WorkZoneActivity']
+    return snapshot['features']
+
+
+def _header(snapshot):
+    if 'WZDx' in snapshot:
+        return snapshot['WZDx']['Header']
+    return snapshot.get('feed_info') or snapshot['road_event_feed_info']
+
+
+def _end_date(activity):
+    # the field churned in each version
+    if 'properties' in activity:
+        return activity['properties'], 'end_date'
+    return activity, 'endDateTime'
+
+
+def churn(snapshot, fraction, seed=0, update_date=None):
+    """
+    Builds the next snapshot of a feed, in which a fraction of the work zones
+    changed: 80% of them get a new end date, 10% are removed and as many new
+    work zones are added.
+
+    Parameters:
+        snapshot: Dictionary object of the feed, as returned by make_snapshot.
+        fraction: Fraction of the work zones that change, from 0 to 1.
+        seed: Seed of the random generator.
+        update_date: Optional update date of the new snapshot. Defaults to
+            one hour after the update date of snapshot.
+    Returns:
+        Dictionary object of the new feed. snapshot is not modified.
+    """
+    rng = random.Random(seed)
+    snapshot = deepcopy(snapshot)
+    header = _header(snapshot)
+    update_time_field_name = 'timeStampUpdate' if 'timeStampUpdate' in header else (
+        'feed_update_date' if 'feed_update_date' in header else 'update_date')
+    if update_date is None:
+        last = datetime.strptime(header[update_time_field_name], '%Y-%m-%dT%H:%M:%SZ')
+        update_date = (last + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    header[update_time_field_name] = update_date
+    version = header.get('versionNo') or header['version']
+
+    activities = _activities(snapshot)
+    n_changed = int(round(len(activities) * fraction))
+    changed = rng.sample(range(len(activities)), n_changed)
+    n_removed = n_changed // 10
+    removed = set(changed[:n_removed])
+    for i in changed[n_removed:]:
+        fields, name = _end_date(activities[i])
+        fields[name] = '2021-05-{:02d}T18:00:00Z'.format(rng.randint(1, 28))
+    activities[:] = [activity for i, activity in enumerate(activities) if i not in removed]
+    next_id = rng.randint(10**6, 10**7)
+    activities.extend(_make_feature(version, rng, next_id + i) for i in range(n_removed))
+    return snapshot
+
+
+def to_bytes(snapshot):
+    """
+    Renders a snapshot as the raw feed: XML for version 1, GeoJSON otherwise.
+
+    """
+    if 'WZDx' in snapshot:
+        return xmltodict.unparse(snapshot).encode('utf-8')
+    return json.dumps(snapshot).encode('utf-8')
@@ -0,0 +1,214 @@
+"""
+In-memory stand-in for the subset of the boto3 S3 client used by S3Helper.
+Meant for local runs, tests and benchmarks: pass an instance to
+S3Helper(client=...). It is kept out of the wzdx_sandbox package, which is
+shipped with the lambdas.
+
+"""
+from datetime import datetime, timezone
+import hashlib
+import io
+import threading
+import uuid
+
+import botocore.exceptions
+from botocore.response import StreamingBody
+
+
+class _Exceptions(object):
+    class NoSuchKey(botocore.exceptions.ClientError):
+        pass
+
+
+class LocalS3Client(object):
+    """
+    Thread-safe in-memory S3 client. Objects are kept per bucket as bytes,
+    along with their ETag, last modified time and any other put_object
+    parameters (e.g. ContentEncoding). Conditional writes (IfMatch and
+    IfNoneMatch='*') fail with a PreconditionFailed error, as on S3, which
+    lets tests simulate concurrent writers. Every call is counted in
+    `calls`, keyed by operation name, and the bytes of object bodies read and
+    written in `bytes_read` and `bytes_written`.
+
+    """
+    exceptions = _Exceptions
+
+    min_part_size = 5 * 1024 * 1024
+
+    def __init__(self):
+        self.objects = {}
+        self.calls = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.uploads = {}
+        self._lock = threading.Lock()
+
+    def _count(self, operation, bytes_read=0, bytes_written=0):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+
+    def _get(self, operation, Bucket, Key):
+        obj = self.objects.get(Bucket, {}).get(Key)
+        if obj is None:
+            if operation == 'HeadObject':
+                raise botocore.exceptions.ClientError(
+                    {'Error': {'Code': '404', 'Message': 'Not Found'}}, operation)
+            raise self.exceptions.NoSuchKey(
+                {'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.'}}, operation)
+        return obj
+
+    def head_object(self, Bucket, Key):
+        self._count('head_object')
+        obj = self._get('HeadObject', Bucket, Key)
+        response = {'ContentLength': len(obj['Body']), 'ETag': obj['ETag'], 'LastModified': obj['LastModified']}
+        response.update(obj['Headers'])
+        return response
+
+    def get_object(self, Bucket, Key, Range=None):
+        self._count('get_object')
+        obj = self._get('GetObject', Bucket, Key)
+        body = obj['Body']
+        response = {'ETag': obj['ETag'], 'LastModified': obj['LastModified']}
+        response.update(obj['Headers'])
+        if Range:
+            # only 'bytes=start-end', 'bytes=start-' and suffix 'bytes=-length' ranges
+            first, last = Range.split('=')[1].split('-')
+            if first == '':
+                first, last = max(len(body) - int(last), 0), len(body) - 1
+            else:
+                first, last = int(first), min(int(last), len(body) - 1) if last else len(body) - 1
+            response['ContentRange'] = 'bytes {}-{}/{}'.format(first, last, len(body))
+            body = body[first:last+1]
+        response['Body'] = StreamingBody(io.BytesIO(body), len(body))
+        response['ContentLength'] = len(body)
+        with self._lock:
+            self.bytes_read += len(body)
+        return response
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, MaxKeys=1000, ContinuationToken=None):
+        self._count('list_objects_v2')
+        with self._lock:
+            keys = sorted(k for k in self.objects.get(Bucket, {}) if k.startswith(Prefix))
+        if Delimiter:
+            # collapse nested keys into their common prefix, as S3 does
+            entries = set()
+            for key in keys:
+                rest = key[len(Prefix):]
+                if Delimiter in rest:
+                    entries.add(Prefix + rest.split(Delimiter, 1)[0] + Delimiter)
+                else:
+                    entries.add(key)
+            keys = sorted(entries)
+        start = int(ContinuationToken or 0)
+        page_keys = keys[start:start+MaxKeys]
+        contents = []
+        common_prefixes = []
+        for key in page_keys:
+            obj = self.objects[Bucket].get(key)
+            if obj is None:
+                common_prefixes.append({'Prefix': key})
+                continue
+            contents.append({'Key': key, 'ETag': obj['ETag'], 'Size': len(obj['Body']),
+                             'LastModified': obj['LastModified']})
+        response = {'KeyCount': len(page_keys), 'IsTruncated': start+MaxKeys < len(keys)}
+        if contents:
+            response['Contents'] = contents
+        if common_prefixes:
+            response['CommonPrefixes'] = common_prefixes
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(start+MaxKeys)
+        return response
+
+    def get_paginator(self, operation_name):
+        if operation_name != 'list_objects_v2':
+            raise NotImplementedError(operation_name)
+        return _ListObjectsV2Paginator(self)
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        if type(Body) != bytes:
+            Body = Body.read() if hasattr(Body, 'read') else Body.encode('utf-8')
+        self._count('put_object', bytes_written=len(Body))
+        etag = '"{}"'.format(hashlib.md5(Body).hexdigest())
+        self._store(Bucket, Key, Body, etag, kwargs, IfMatch, IfNoneMatch)
+        return {'ETag': etag}
+
+    def _store(self, bucket, key, body, etag, headers, if_match=None, if_none_match=None):
+        with self._lock:
+            # conditions are checked under the same lock as the write, as S3 does atomically
+            current = self.objects.get(bucket, {}).get(key)
+            if (if_none_match == '*' and current is not None) or \
+                    (if_match is not None and (current is None or current['ETag'] != if_match)):
+                raise botocore.exceptions.ClientError(
+                    {'Error': {'Code': 'PreconditionFailed',
+                               'Message': 'At least one of the pre-conditions you specified did not hold'},
+                     'ResponseMetadata': {'HTTPStatusCode': 412}}, 'PutObject')
+            self.objects.setdefault(bucket, {})[key] = {
+                'Body': body,
+                'ETag': etag,
+                'LastModified': datetime.now(timezone.utc),
+                'Headers': headers
+            }
+
+    def _get_upload(self, operation, UploadId):
+        upload = self.uploads.get(UploadId)
+        if upload is None:
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': 'NoSuchUpload', 'Message': 'The specified upload does not exist.'}}, operation)
+        return upload
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._count('create_multipart_upload')
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self.uploads[upload_id] = {'Bucket': Bucket, 'Key': Key, 'Headers': kwargs, 'Parts': {}}
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._count('upload_part', bytes_written=len(Body))
+        upload = self._get_upload('UploadPart', UploadId)
+        etag = '"{}"'.format(hashlib.md5(Body).hexdigest())
+        with self._lock:
+            upload['Parts'][PartNumber] = (etag, Body)
+        return {'ETag': etag}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._count('complete_multipart_upload')
+        upload = self._get_upload('CompleteMultipartUpload', UploadId)
+        parts = [upload['Parts'][part['PartNumber']][1] for part in MultipartUpload['Parts']]
+        if any(len(part) < self.min_part_size for part in parts[:-1]):
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': 'EntityTooSmall', 'Message': 'Your proposed upload is smaller than the minimum allowed size'}},
+                'CompleteMultipartUpload')
+        # ETag of a multipart object: MD5 of the parts' MD5s, and the number of parts
+        digests = b''.join(hashlib.md5(part).digest() for part in parts)
+        etag = '"{}-{}"'.format(hashlib.md5(digests).hexdigest(), len(parts))
+        self._store(Bucket, Key, b''.join(parts), etag, upload['Headers'])
+        with self._lock:
+            del self.uploads[UploadId]
+        return {'Bucket': Bucket, 'Key': Key, 'ETag': etag}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._count('abort_multipart_upload')
+        with self._lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+
+class _ListObjectsV2Paginator(object):
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None, PaginationConfig=None):
+        page_size = (PaginationConfig or {}).get('PageSize', 1000)
+        token = None
+        while True:
+            kwargs = {'Bucket': Bucket, 'Prefix': Prefix, 'Delimiter': Delimiter, 'MaxKeys': page_size}
+            if token:
+                kwargs['ContinuationToken'] = token
+            page = self.client.list_objects_v2(**kwargs)
+            yield page
+            if not page['IsTruncated']:
+                break
+            token = page['NextContinuationToken']
@@ -7,7 +7,8 @@ import logging
 import os
 import traceback
 
-from wzdx_sandbox.wzdx_sandbox import WorkZoneRawSandbox
+from wzdx_sandbox.dispatch import Dispatcher, create_queue
+from wzdx_sandbox.wzdx_sandbox import WorkZoneRawSandbox, ingest_raw_feeds
 
 
 logger = logging.getLogger()
@@ -16,23 +17,56 @@ logger.setLevel(logging.INFO)  # necessary to make sure aws is logging
 BUCKET = os.environ.get('BUCKET')
 LAMBDA_TO_TRIGGER = os.environ.get('LAMBDA_TO_TRIGGER')
 SOCRATA_LAMBDA_TO_TRIGGER = os.environ.get('SOCRATA_LAMBDA_TO_TRIGGER')
+COMPRESSION = os.environ.get('COMPRESSION') or None
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', 0)) or None
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 0)) or None
+MAX_CONNECTIONS_PER_HOST = int(os.environ.get('MAX_CONNECTIONS_PER_HOST', 4))
+FEED_TIMEOUT = float(os.environ.get('FEED_TIMEOUT', 60))
+CONDITIONAL_FETCH = os.environ.get('CONDITIONAL_FETCH', '').lower() in ('1', 'true', 'yes')
+STATE_BUCKET = os.environ.get('STATE_BUCKET') or None
+LAKE_QUEUE_URL = os.environ.get('LAKE_QUEUE_URL')
+SOCRATA_QUEUE_URL = os.environ.get('SOCRATA_QUEUE_URL')
 
 
-if None in [BUCKET, LAMBDA_TO_TRIGGER]:
-    logger.error('Required ENV variable(s) not found. Please make sure you have specified the following ENV variables: BUCKET, LAMBDA_TO_TRIGGER')
+if BUCKET is None or (LAMBDA_TO_TRIGGER is None and LAKE_QUEUE_URL is None):
+    logger.error('Required ENV variable(s) not found. Please make sure you have specified the following ENV variables: BUCKET, LAMBDA_TO_TRIGGER or LAKE_QUEUE_URL')
     exit()
+if CONDITIONAL_FETCH and STATE_BUCKET is None:
+    logger.error('CONDITIONAL_FETCH requires the STATE_BUCKET ENV variable.')
+    exit()
+
+
+def create_dispatcher():
+    """
+    Creates the dispatcher of snapshots to the downstream lambdas' queues, if
+    queues are configured. Lambdas without a queue are invoked directly.
+
+    """
+    queues = {}
+    if LAKE_QUEUE_URL:
+        queues['lake'] = create_queue(LAKE_QUEUE_URL)
+    if SOCRATA_QUEUE_URL:
+        queues['socrata'] = create_queue(SOCRATA_QUEUE_URL)
+    return Dispatcher(queues) if queues else None
 
 
 def lambda_handler(event=None, context=None):
     """AWS Lambda handler. """
+    if 'feeds' in event:
+        return ingest_batch(event)
+    dispatcher = create_dispatcher()
     try:
         wzdx_sandbox = WorkZoneRawSandbox(feed=event['feed'], bucket=BUCKET,
                         lambda_to_trigger=LAMBDA_TO_TRIGGER,
                         socrata_lambda_to_trigger=SOCRATA_LAMBDA_TO_TRIGGER,
-                        logger=logger)
+                        compression=event['feed'].get('compression') or COMPRESSION,
+                        compression_level=COMPRESSION_LEVEL, conditional_fetch=CONDITIONAL_FETCH,
+                        state_bucket=STATE_BUCKET, dispatcher=dispatcher, logger=logger)
         if event['feed']['pipedtosandbox'] == True:
             print("Ingesting {}".format(event['feed']['feedname']))
             wzdx_sandbox.ingest()
+            if dispatcher is not None:
+                dispatcher.flush()
         else:
             print('Skip triggering ingestion of {} to sandbox.'.format(event['feed']['feedname']))
     except:
@@ -40,5 +74,28 @@ def lambda_handler(event=None, context=None):
         print(event)
         raise
 
+
+def ingest_batch(event):
+    """
+    Ingests all feeds of a {'feeds': [feed, ...]} event concurrently. Each feed
+    may also have a 'timeout' in seconds.
+
+    """
+    feeds = [feed for feed in event['feeds'] if feed['pipedtosandbox'] == True]
+    for feed in event['feeds']:
+        if feed['pipedtosandbox'] != True:
+            print('Skip triggering ingestion of {} to sandbox.'.format(feed['feedname']))
+    print("Ingesting {} feeds".format(len(feeds)))
+    results = ingest_raw_feeds(feeds, bucket=BUCKET, max_workers=MAX_WORKERS,
+                    max_connections_per_host=MAX_CONNECTIONS_PER_HOST, timeout=FEED_TIMEOUT,
+                    timeouts={feed['feedname']: float(feed['timeout']) for feed in feeds if feed.get('timeout')},
+                    lambda_to_trigger=LAMBDA_TO_TRIGGER, socrata_lambda_to_trigger=SOCRATA_LAMBDA_TO_TRIGGER,
+                    compression=COMPRESSION, compression_level=COMPRESSION_LEVEL,
+                    conditional_fetch=CONDITIONAL_FETCH, state_bucket=STATE_BUCKET,
+                    dispatcher=create_dispatcher(), logger=logger)
+    for result in results:
+        logger.info(json.dumps(result))
+    return results
+
 if __name__ == '__main__':
     lambda_handler()
@@ -7,6 +7,7 @@ import logging
 import os
 import traceback
 
+from wzdx_sandbox.dispatch import batch_response, iter_work_items
 from wzdx_sandbox.wzdx_sandbox import WorkZoneSandbox
 
 
@@ -14,22 +15,61 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)  # necessary to make sure aws is logging
 
 BUCKET = os.environ.get('BUCKET')
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 0)) or None
+LAKE_LAYOUT = os.environ.get('LAKE_LAYOUT', 'ndjson')
+COMPRESSION = os.environ.get('COMPRESSION') or None
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', 0)) or None
+SPATIAL_INDEX = os.environ.get('SPATIAL_INDEX', '').lower() in ('1', 'true', 'yes')
+DEDUP_HEADERS = os.environ.get('DEDUP_HEADERS', '').lower() in ('1', 'true', 'yes')
+CONDITIONAL_WRITES = os.environ.get('CONDITIONAL_WRITES', '').lower() in ('1', 'true', 'yes')
+SKIP_REPLAYED = os.environ.get('SKIP_REPLAYED', '').lower() in ('1', 'true', 'yes')
+DIGEST_INDEX = os.environ.get('DIGEST_INDEX', '').lower() in ('1', 'true', 'yes')
+STATE_BUCKET = os.environ.get('STATE_BUCKET') or None
 
 if None in [BUCKET]:
     logger.error('Required ENV variable(s) not found. Please make sure you have specified the following ENV variables: BUCKET')
     exit()
+if DIGEST_INDEX and STATE_BUCKET is None:
+    logger.error('DIGEST_INDEX requires the STATE_BUCKET ENV variable.')
+    exit()
 
 
 def lambda_handler(event=None, context=None):
-    """AWS Lambda handler. """
-    try:
-        wzdx_sandbox = WorkZoneSandbox(feed=event['feed'], bucket=BUCKET, logger=logger)
-        datastream = wzdx_sandbox.s3helper.get_data_stream(event['bucket'], event['key'])
-        wzdx_sandbox.ingest(data=datastream._raw_stream.data.decode('utf-8'))
-    except:
-        print(traceback.format_exc())
-        print(event)
-        raise
+    """
+    AWS Lambda handler. The event is a single snapshot, a batch of snapshots
+    or an SQS event of batches (see wzdx_sandbox.dispatch). For an SQS event,
+    only the messages holding a snapshot that failed are returned as batch
+    item failures, to be delivered again.
+
+    """
+    sandboxes = {}
+    failures = []
+    failed_feeds = {}
+    # raw keys sort by feed, then by retrieval time, so each feed's snapshots are ingested in order
+    for message_id, feed, bucket, key in sorted(iter_work_items(event, with_message_ids=True), key=lambda item: item[3]):
+        if feed['feedname'] in failed_feeds:
+            # left for the redelivery, so that it is ingested after the snapshot that failed
+            failures.append((message_id, key, RuntimeError('{} failed'.format(failed_feeds[feed['feedname']]))))
+            continue
+        try:
+            if feed['feedname'] not in sandboxes:
+                sandboxes[feed['feedname']] = WorkZoneSandbox(feed=feed, bucket=BUCKET,
+                        max_workers=MAX_WORKERS, layout=LAKE_LAYOUT,
+                        compression=feed.get('compression') or COMPRESSION,
+                        compression_level=COMPRESSION_LEVEL, use_spatial_index=SPATIAL_INDEX,
+                        dedup_headers=DEDUP_HEADERS, conditional_writes=CONDITIONAL_WRITES,
+                        skip_replayed=SKIP_REPLAYED, use_digest_index=DIGEST_INDEX,
+                        state_bucket=STATE_BUCKET, logger=logger)
+            wzdx_sandbox = sandboxes[feed['feedname']]
+            datastream = wzdx_sandbox.s3helper.get_data_stream(bucket, key)
+            report = wzdx_sandbox.ingest_stream(datastream)
+            logger.info(json.dumps(dict(report.to_dict(), key=key)))
+        except Exception as e:
+            print(traceback.format_exc())
+            print(key)
+            failures.append((message_id, key, e))
+            failed_feeds[feed['feedname']] = key
+    return batch_response(event, failures)
 
 if __name__ == '__main__':
     lambda_handler()
@@ -7,74 +7,73 @@ import logging
 import os
 import traceback
 
+from wzdx_sandbox.dispatch import batch_response, iter_work_items
+from wzdx_sandbox.socrata_sync import sync_feed, DEFAULT_ROW_ID_FIELD, DEFAULT_UPSERT_BATCH_SIZE, DEFAULT_MAX_UPSERT_WORKERS
+from wzdx_sandbox.socrata_watermark import create_watermark_store, S3WatermarkStore, DEFAULT_WATERMARK_TTL
 from wzdx_sandbox.wzdx_sandbox import WorkZoneSandbox
-from sandbox_exporter.flattener import load_flattener
-from sandbox_exporter.socrata_util import SocrataDataset
-from sandbox_exporter.flattener_wzdx import WzdxV2Flattener, WzdxV3Flattener, WzdxV4Flattener
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)  # necessary to make sure aws is logging
 
 
 SOCRATA_PARAMS = json.loads(os.environ.get('SOCRATA_PARAMS', ''))
+SOCRATA_SYNC_MODE = os.environ.get('SOCRATA_SYNC_MODE', 'full')
+SOCRATA_STATE_BUCKET = os.environ.get('SOCRATA_STATE_BUCKET') or None
+SOCRATA_ROW_ID_FIELD = os.environ.get('SOCRATA_ROW_ID_FIELD', DEFAULT_ROW_ID_FIELD)
+SOCRATA_UPSERT_BATCH_SIZE = int(os.environ.get('SOCRATA_UPSERT_BATCH_SIZE', 0)) or DEFAULT_UPSERT_BATCH_SIZE
+SOCRATA_MAX_WORKERS = int(os.environ.get('SOCRATA_MAX_WORKERS', 0)) or DEFAULT_MAX_UPSERT_WORKERS
+SOCRATA_WATERMARK_STORE = os.environ.get('SOCRATA_WATERMARK_STORE') or None
+SOCRATA_WATERMARK_TTL = int(os.environ.get('SOCRATA_WATERMARK_TTL', DEFAULT_WATERMARK_TTL))
+
+if SOCRATA_SYNC_MODE == 'incremental' and SOCRATA_STATE_BUCKET is None:
+    logger.error('Incremental SOCRATA_SYNC_MODE requires the SOCRATA_STATE_BUCKET ENV variable.')
+    exit()
 
 
 def lambda_handler(event=None, context=None):
-    """AWS Lambda handler. """
-    try:
-        main(event, context)
-    except:
-        print(traceback.format_exc())
-        print(event)
-        raise
+    """
+    AWS Lambda handler. The event is a single snapshot, a batch of snapshots
+    or an SQS event of batches (see wzdx_sandbox.dispatch). Socrata datasets
+    only hold the current feed, so only the latest snapshot of each feed in
+    the event is read. If the event has 'refresh_watermark' set to true, the
+    watermarks of the datasets are read from Socrata again. For an SQS
+    event, only the messages holding the latest snapshot of a feed that
+    failed are returned as batch item failures, to be delivered again.
+
+    """
+    latest = {}
+    message_ids = {}
+    for message_id, feed, bucket, key in iter_work_items(event, with_message_ids=True):
+        if feed['feedname'] not in latest or key > latest[feed['feedname']]['key']:
+            latest[feed['feedname']] = {'feed': feed, 'bucket': bucket, 'key': key}
+            message_ids[feed['feedname']] = message_id
+    failures = []
+    for feed_event in latest.values():
+        try:
+            main(feed_event, context, refresh=bool(event.get('refresh_watermark')))
+        except Exception as e:
+            print(traceback.format_exc())
+            print(feed_event)
+            failures.append((message_ids[feed_event['feed']['feedname']], feed_event['key'], e))
+    return batch_response(event, failures)
 
-def main(event, context):
+def main(event, context, refresh=False):
     # load and parse data
     wzdx_sandbox = WorkZoneSandbox(feed=event['feed'], bucket=None, logger=logger)
     datastream = wzdx_sandbox.s3helper.get_data_stream(event['bucket'], event['key'])
-    data = wzdx_sandbox.parse_to_json(datastream.data.decode('utf-8'))
-
-    # load and initialize data flattener based on schema version
-    # flattener_class = load_flattener('wzdx/V{}'.format(event['feed']['version']))
-    if event['feed']['version'][0] == '2':
-        flattener_class = WzdxV2Flattener
-        current_updated_time = data['road_event_feed_info']['feed_update_date'][:19]
-    elif event['feed']['version'][0] == '3':
-        flattener_class = WzdxV3Flattener
-        current_updated_time = data['road_event_feed_info']['update_date'][:19]
-    elif event['feed']['version'][0] == '4':
-        flattener_class = WzdxV4Flattener
-        try:
-            current_updated_time = data['road_event_feed_info']['update_date'][:19]
-        except KeyError:
-            current_updated_time = data['feed_info']['update_date'][:19]
-    flattener = flattener_class()
+    data = wzdx_sandbox.parse_to_json(datastream.read())
 
-    # check if socrata data is stale
-    # section does not work for wzdx v1 feeds
-    dataset_id = event['feed']['socratadatasetid']
-    dataset = SocrataDataset(dataset_id=dataset_id, socrata_params=SOCRATA_PARAMS)
-    sample_current_records = dataset.client.get(dataset_id, limit=1)
-    if sample_current_records:
-        if event['feed']['version'][0] == '2':
-            last_updated_time = sample_current_records[0]['feed_update_date'][:19]
-        elif event['feed']['version'][0] >= '3':
-            last_updated_time = sample_current_records[0]['update_date'][:19]
-        if not current_updated_time > last_updated_time:
-            logger.info(f'No update needed - feed has not been updated since {last_updated_time}')
-            return
+    # without a watermark store or a state bucket, no watermarks are kept
+    watermarks = None
+    if SOCRATA_WATERMARK_STORE:
+        watermarks = create_watermark_store(SOCRATA_WATERMARK_STORE, wzdx_sandbox.s3helper)
+    elif SOCRATA_STATE_BUCKET:
+        watermarks = S3WatermarkStore(wzdx_sandbox.s3helper, SOCRATA_STATE_BUCKET)
+    sync_feed(event['feed'], data, SOCRATA_PARAMS, print_func=logger.info, mode=SOCRATA_SYNC_MODE,
+        s3helper=wzdx_sandbox.s3helper, state_bucket=SOCRATA_STATE_BUCKET,
+        row_id_field=SOCRATA_ROW_ID_FIELD, batch_size=SOCRATA_UPSERT_BATCH_SIZE, max_workers=SOCRATA_MAX_WORKERS,
+        watermarks=watermarks, watermark_ttl=SOCRATA_WATERMARK_TTL, refresh=refresh)
 
-    # feed content is newer than what is in Socrata
-    flattened_recs = flattener.process_and_split(data)
-    if flattened_recs:
-        working_id = dataset.create_new_draft()
-        response = dataset.clean_and_upsert(flattened_recs, working_id)
-        logger.info(response)
-        dataset.publish_draft(working_id)
-        logger.info(f'New draft for dataset {working_id} published.')
-    else:
-        logger.info(f'No records in feed - will not update Socrata dataset')
-    
 
 if __name__ == '__main__':
     lambda_handler()
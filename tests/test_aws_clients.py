@@ -0,0 +1,39 @@
+import unittest
+import os
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from wzdx_sandbox import aws_clients
+from wzdx_sandbox.s3_helper import S3Helper
+
+
+@mock.patch.dict(os.environ, {'AWS_DEFAULT_REGION': 'us-east-1'})
+class TestAwsClients(unittest.TestCase):
+    def setUp(self):
+        aws_clients.clear()
+
+    def test_clients_are_reused(self):
+        client = aws_clients.get_client('s3')
+        self.assertIs(aws_clients.get_client('s3'), client)
+        self.assertIs(S3Helper().client, client)
+        self.assertIsNot(aws_clients.get_client('lambda'), client)
+        self.assertEqual(client.meta.config.retries['mode'], 'adaptive')
+
+    def test_pool_size_is_part_of_the_key(self):
+        small = aws_clients.get_client('s3', max_pool_connections=4)
+        large = aws_clients.get_client('s3', max_pool_connections=32)
+        self.assertIs(small, aws_clients.get_client('s3'))
+        self.assertIsNot(small, large)
+        self.assertEqual(large.meta.config.max_pool_connections, 32)
+        self.assertIs(S3Helper(max_pool_connections=32).client, large)
+
+    def test_one_client_per_process(self):
+        with ThreadPoolExecutor(8) as executor:
+            clients = list(executor.map(lambda _: aws_clients.get_client('s3'), range(32)))
+        self.assertEqual(len(set(map(id, clients))), 1)
+        with mock.patch('os.getpid', return_value=-1):
+            self.assertIsNot(aws_clients.get_client('s3'), clients[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
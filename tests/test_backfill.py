@@ -0,0 +1,133 @@
+import unittest
+import json
+import os
+import tempfile
+
+from benchmarks.local_s3 import LocalS3Client
+from wzdx_sandbox import digest_index
+from wzdx_sandbox.backfill import (LocalCheckpointStore, backfill_feed, create_checkpoint_store, list_raw_snapshots,
+    parse_raw_key, run_backfill)
+from wzdx_sandbox.s3_helper import S3Helper
+from wzdx_sandbox.wzdx_sandbox import WorkZoneSandbox
+from test_wzdx_sandbox import FEED, make_v3_feed
+
+
+RAW_PREFIX = 'state=TS/feedName=testfeed/year=2021/month=03/'
+OTHER_FEED = dict(FEED, feedname='otherfeed')
+
+
+def make_snapshots(feed=FEED):
+    # hourly snapshots where work zone wz0 changes every other hour
+    snapshots = []
+    for hour in range(10, 20):
+        data = make_v3_feed(3, update_date='2021-03-01T{}:00:00Z'.format(hour))
+        data['features'][0]['properties']['direction'] = 'northbound' if hour < 15 else 'southbound'
+        data['features'][1]['properties']['description'] = 'lane {}'.format(hour // 2)
+        key = 'state=TS/feedName={}/year=2021/month=03/{}_2021-03-01 {}:00:00.123456'.format(
+            feed['feedname'], feed['feedname'], hour)
+        snapshots.append((key, json.dumps(data).encode('utf-8')))
+    return snapshots
+
+
+class TestBackfill(unittest.TestCase):
+    def setUp(self):
+        digest_index.clear_cache()
+        self.client = LocalS3Client()
+        self.s3helper = S3Helper(client=self.client)
+        for feed in [FEED, OTHER_FEED]:
+            for key, body in make_snapshots(feed):
+                self.s3helper.write_bytes(body, 'raw-bucket', key)
+        self.s3helper.write_bytes(b'{}', 'raw-bucket', RAW_PREFIX + 'testfeed_2021-03-01 20:00:00__UNCHANGED')
+        self.s3helper.write_bytes(b'{}', 'raw-bucket', 'state=TS/feedName=testfeed/_fetch_state.json')
+
+    def lake(self, bucket='lake-bucket'):
+        return {key: obj['Body'] for key, obj in self.client.objects.get(bucket, {}).items()}
+
+    def ingest_sequentially(self, feed=FEED, **kwargs):
+        sandbox = WorkZoneSandbox('sequential-bucket', feed=feed, s3helper=self.s3helper, **kwargs)
+        for _, body in make_snapshots(feed):
+            sandbox.ingest(body)
+        return self.lake('sequential-bucket')
+
+    def test_list_raw_snapshots(self):
+        self.assertIsNone(parse_raw_key(FEED, RAW_PREFIX + 'testfeed_2021-03-01 20:00:00__UNCHANGED'))
+        self.assertIsNone(parse_raw_key(FEED, 'state=TS/feedName=testfeed/_fetch_state.json'))
+        self.assertEqual(str(parse_raw_key(FEED, RAW_PREFIX + 'testfeed_2021-03-01 20:00:00.5.gz')),
+                         '2021-03-01 20:00:00.500000')
+        snapshots = list_raw_snapshots(self.s3helper, 'raw-bucket', FEED)
+        self.assertEqual([key for _, key in snapshots], [key for key, _ in make_snapshots()])
+        snapshots = list_raw_snapshots(self.s3helper, 'raw-bucket', FEED, '2021-03-01T12:00:00', '2021-03-01T14:00:00')
+        self.assertEqual([str(retrieved) for retrieved, _ in snapshots],
+                         ['2021-03-01 12:00:00.123456', '2021-03-01 13:00:00.123456'])
+
+    def test_matches_sequential_ingest(self):
+        expected = self.ingest_sequentially()
+        for flush_every in [1, 3, 100]:
+            self.client.objects.pop('lake-bucket', None)
+            digest_index.clear_cache()
+            result = backfill_feed(FEED, 'raw-bucket', 'lake-bucket', s3helper=self.s3helper,
+                flush_every=flush_every, print_func=lambda *args: None)
+            self.assertEqual(result['n_snapshots'], 10)
+            self.assertEqual(result['failures'], [])
+            self.assertEqual(self.lake(), expected)
+
+    def test_fewer_writes(self):
+        calls = dict(self.client.calls)
+        self.ingest_sequentially()
+        sequential_puts = self.client.calls['put_object'] - calls.get('put_object', 0)
+        calls = dict(self.client.calls)
+        result = backfill_feed(FEED, 'raw-bucket', 'lake-bucket', s3helper=self.s3helper, flush_every=100,
+            lake_args={'use_digest_index': True, 'state_bucket': 'state-bucket'}, print_func=lambda *args: None)
+        # one write per work zone file and one of the digest index
+        self.assertEqual(result['n_files_written'], 4)
+        self.assertEqual(self.client.calls['put_object'] - calls['put_object'], 5)
+        self.assertLess(5, sequential_puts)
+
+    def test_segmented_dedup_and_spatial_index(self):
+        lake_args = {'layout': 'segmented', 'dedup_headers': True, 'use_spatial_index': True}
+        expected = self.ingest_sequentially(**lake_args)
+        backfill_feed(FEED, 'raw-bucket', 'lake-bucket', s3helper=self.s3helper, flush_every=4,
+            lake_args=lake_args, print_func=lambda *args: None)
+        lake = self.lake()
+        self.assertEqual({key: expected[key] for key in lake}, lake)
+        # headers of statuses overwritten before they were flushed are never written
+        self.assertTrue(all('/_headers/' in key for key in set(expected) - set(lake)))
+
+    def test_resume_from_checkpoint(self):
+        expected = self.ingest_sequentially()
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoints = create_checkpoint_store(os.path.join(tmp, 'checkpoints'))
+            backfill_feed(FEED, 'raw-bucket', 'lake-bucket', end='2021-03-01T14:00:00', checkpoints=checkpoints,
+                s3helper=self.s3helper, flush_every=2, print_func=lambda *args: None)
+            self.assertEqual(checkpoints.get('testfeed')['last_key'], make_snapshots()[3][0])
+            result = backfill_feed(FEED, 'raw-bucket', 'lake-bucket', checkpoints=checkpoints,
+                s3helper=self.s3helper, flush_every=2, print_func=lambda *args: None)
+            self.assertEqual(result['n_snapshots'], 6)
+            self.assertEqual(self.lake(), expected)
+
+            # a run interrupted while flushing replays the snapshots since the last checkpoint,
+            # without appending the statuses that were flushed again
+            checkpoints.put('testfeed', {'last_key': make_snapshots()[5][0], 'flushing_key': make_snapshots()[-1][0]})
+            result = backfill_feed(FEED, 'raw-bucket', 'lake-bucket', checkpoints=checkpoints,
+                s3helper=self.s3helper, print_func=lambda *args: None)
+            self.assertEqual(result['outcomes']['skipped'], 12)
+            self.assertEqual(self.lake(), expected)
+            self.assertIsNone(checkpoints.get('testfeed')['flushing_key'])
+
+    def test_run_backfill(self):
+        expected = self.ingest_sequentially()
+        expected.update(self.ingest_sequentially(OTHER_FEED))
+        checkpoints = create_checkpoint_store('s3://checkpoint-bucket/runs/1', self.s3helper)
+        results = run_backfill([FEED, OTHER_FEED], 'raw-bucket', 'lake-bucket', checkpoints=checkpoints,
+            max_workers=2, s3helper=self.s3helper, print_func=lambda *args: None)
+        self.assertEqual([result['feedname'] for result in results], ['testfeed', 'otherfeed'])
+        self.assertEqual(self.lake(), expected)
+        self.assertEqual(sorted(self.lake('checkpoint-bucket')), ['runs/1/otherfeed.json', 'runs/1/testfeed.json'])
+
+    def test_local_checkpoint_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = create_checkpoint_store('file://' + tmp)
+            self.assertIsInstance(store, LocalCheckpointStore)
+            self.assertIsNone(store.get('testfeed'))
+            store.put('testfeed', {'last_key': 'a'})
+            self.assertEqual(store.get('testfeed'), {'last_key': 'a'})
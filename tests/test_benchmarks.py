@@ -0,0 +1,43 @@
+import unittest
+
+from benchmarks.bench_ingest import compare, run_scenario
+from benchmarks.feeds import churn, make_snapshot, to_bytes
+from wzdx_sandbox.spec_registry import resolve_feed
+
+
+class TestFeeds(unittest.TestCase):
+    def test_churn_keeps_size_and_advances_update_date(self):
+        for version, feed in [('1.1', {'version': '1'}), ('4.1', {'version': '4'})]:
+            snapshot = make_snapshot(version, 50)
+            layout = resolve_feed(feed, snapshot)
+            next_snapshot = churn(snapshot, 0.2, seed=1)
+            next_layout = resolve_feed(feed, next_snapshot)
+            self.assertEqual(len(next_layout.activities()), 50)
+            self.assertGreater(next_layout.update_time, layout.update_time)
+            self.assertTrue(to_bytes(next_snapshot))
+
+
+class TestBenchIngest(unittest.TestCase):
+    def test_run_scenario(self):
+        for version in ['1.1', '4.1']:
+            cold = run_scenario('cold', version, 10)
+            steady = run_scenario('steady', version, 10)
+            self.assertEqual(cold['n_timed'], 10)
+            self.assertEqual(steady['n_timed'], 0)
+            self.assertIn('put_object', cold['s3_calls'])
+            self.assertNotIn('put_object', steady['s3_calls'])
+
+    def test_compare(self):
+        base = {'scenario': 'cold', 'version': '4.1', 'n_features': 10, 'wall_seconds': 1.0,
+                'features_per_second': 10.0, 'p99_ms': 1.0, 'peak_rss_mb': 100.0, 's3_calls': {'put_object': 10}}
+        baseline = {'cold/v4.1/10': base}
+        self.assertEqual(compare([dict(base)], baseline), [])
+        worse = dict(base, features_per_second=4.0, s3_calls={'put_object': 11})
+        self.assertEqual(len(compare([worse], baseline)), 2)
+        # timings of short scenarios are not compared
+        baseline['cold/v4.1/10'] = dict(base, wall_seconds=0.001)
+        self.assertEqual(len(compare([worse], baseline)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import json
+import unittest
+from unittest import mock
+
+from wzdx_sandbox import codec
+
+
+RECORDS = [
+    {'type': 'Feature', 'properties': {'road_event_id': 'wz1', 'description': 'Fermé – voie de droite'},
+     'geometry': {'type': 'LineString', 'coordinates': [[-77.0, 38.0], [-77.123456789, 38.1]]}},
+    {'small': 0.00001, 'large': 1e16, 'neg': -1.5e-7, 'zero': 0.0, 'int': 10 ** 20},
+    {'nested': [None, True, False, '', 'a"b\\c\n'], 'num': 12.5},
+    {2: 'non-string key'},
+    {'nan': float('nan'), 'inf': [float('inf'), float('-inf')], 'null': None},
+    {'surrogate': '\ud800', 'text': 'Fermé'},
+]
+
+
+class TestCodec(unittest.TestCase):
+    def test_dumps_is_backend_independent(self):
+        for rec in RECORDS:
+            for sort_keys in (False, True):
+                out = codec.dumps(rec, sort_keys=sort_keys)
+                with mock.patch.object(codec, 'orjson', None):
+                    self.assertEqual(codec.dumps(rec, sort_keys=sort_keys), out)
+                try:
+                    expected = json.dumps(rec, ensure_ascii=False, separators=(',', ':'),
+                                          sort_keys=sort_keys).encode('utf-8')
+                except UnicodeEncodeError:
+                    expected = json.dumps(rec, separators=(',', ':'), sort_keys=sort_keys).encode('utf-8')
+                self.assertEqual(out, expected)
+
+    def test_non_finite_and_surrogates(self):
+        for backend in (codec.orjson, None):
+            with mock.patch.object(codec, 'orjson', backend):
+                self.assertEqual(codec.dumps({'a': float('nan')}), b'{"a":NaN}')
+                self.assertEqual(codec.dumps([float('inf'), None]), b'[Infinity,null]')
+                self.assertEqual(codec.dumps({'a': '\ud800'}), b'{"a":"\\ud800"}')
+                self.assertEqual(codec.loads(codec.dumps({'a': '\ud800'})), {'a': '\ud800'})
+
+    def test_dumps_record_keeps_json_format(self):
+        for backend in (codec.orjson, None):
+            with mock.patch.object(codec, 'orjson', backend):
+                for rec in RECORDS:
+                    self.assertEqual(codec.dumps_record(rec), json.dumps(rec).encode('utf-8'))
+
+    def test_round_trip(self):
+        for rec in RECORDS[:3]:
+            self.assertEqual(codec.loads(codec.dumps(rec)), rec)
+            self.assertEqual(codec.loads(codec.dumps(rec).decode('utf-8')), rec)
+
+    def test_loads_falls_back_to_json(self):
+        self.assertEqual(str(codec.loads('{"a": NaN}')['a']), 'nan')
+        with self.assertRaises(ValueError):
+            codec.loads('{"a": ')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import unittest
+import datetime
+import os
+import struct
+import tempfile
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+from benchmarks.local_s3 import LocalS3Client
+from wzdx_sandbox import digest_index
+from wzdx_sandbox.compaction import (LocalLakeFiles, S3LakeFiles, compact_lake, geojson_to_wkb, load_manifest,
+    parse_time, read_compacted)
+from wzdx_sandbox.s3_helper import S3Helper
+from wzdx_sandbox.wzdx_sandbox import WorkZoneSandbox
+from test_wzdx_sandbox import FEED, make_v3_feed
+
+
+NOW = datetime.datetime(2021, 4, 15, tzinfo=datetime.timezone.utc)
+MONTH_PREFIX = 'state=TS/feedName=testfeed/year=2021/month=03/'
+
+
+class TestCompactionHelpers(unittest.TestCase):
+    def test_parse_time(self):
+        utc = datetime.timezone.utc
+        self.assertEqual(parse_time('2021-03-01T12:00:00Z'), datetime.datetime(2021, 3, 1, 12, tzinfo=utc))
+        self.assertEqual(parse_time('2021-03-01T07:00:00.5-05:00'),
+                         datetime.datetime(2021, 3, 1, 12, 0, 0, 500000, tzinfo=utc))
+        self.assertEqual(parse_time('2021-03-01'), datetime.datetime(2021, 3, 1, tzinfo=utc))
+        self.assertIsNone(parse_time('yesterday'))
+
+    def test_geojson_to_wkb(self):
+        wkb = geojson_to_wkb({'type': 'LineString', 'coordinates': [[-77.0, 38.0, 5.0], [-77.1, 38.1]]})
+        self.assertEqual(wkb, struct.pack('<BII4d', 1, 2, 2, -77.0, 38.0, -77.1, 38.1))
+        wkb = geojson_to_wkb({'type': 'MultiPoint', 'coordinates': [[1.0, 2.0]]})
+        self.assertEqual(wkb, struct.pack('<BII', 1, 4, 1) + struct.pack('<BI2d', 1, 1, 1.0, 2.0))
+        self.assertIsNone(geojson_to_wkb(None))
+
+
+@unittest.skipIf(pyarrow is None, 'requires pyarrow')
+class TestCompaction(unittest.TestCase):
+    def setUp(self):
+        digest_index.clear_cache()
+        self.client = LocalS3Client()
+        self.files = S3LakeFiles(S3Helper(client=self.client), 'test-bucket')
+
+    def ingest(self, **kwargs):
+        sandbox = WorkZoneSandbox(bucket='test-bucket', feed=FEED, s3helper=S3Helper(client=self.client), **kwargs)
+        for hour, n in [(12, 3), (13, 4)]:
+            data = make_v3_feed(n, update_date='2021-03-01T{}:00:00Z'.format(hour))
+            for feature in data['features']:
+                feature['properties']['end_date'] = '2021-03-0{}'.format(hour - 10)
+            sandbox.ingest(data)
+
+    def test_compact_and_read(self):
+        self.ingest()
+        self.assertEqual(compact_lake(self.files, now=NOW, print_func=lambda *args: None), {MONTH_PREFIX: 'compacted'})
+        entry = load_manifest(self.files)['partitions'][MONTH_PREFIX]
+        self.assertEqual((entry['n_rows'], entry['n_work_zones']), (7, 4))
+        self.assertEqual(entry['files'], ['compacted/' + MONTH_PREFIX + 'part-00000.parquet'])
+
+        table = read_compacted(self.files)
+        self.assertEqual(table.num_rows, 7)
+        row = table.to_pylist()[0]
+        self.assertEqual((row['work_zone_id'], row['road_direction'], row['status_index']), ('wz0', 'northbound', 0))
+        self.assertEqual(row['header.version'], '3.0')
+        self.assertEqual(row['properties.end_date'], '2021-03-02')
+        self.assertEqual(row['geometry'], geojson_to_wkb(make_v3_feed(1)['features'][0]['geometry']))
+        self.assertEqual((row['state'], row['feedName'], row['month']), ('TS', 'testfeed', '03'))
+
+        table = read_compacted(self.files, work_zone_ids=['wz1', 'wz3'], start='2021-03-01T13:00:00Z',
+                               columns=['work_zone_id', 'update_time'])
+        self.assertEqual(sorted(table.column('work_zone_id').to_pylist()), ['wz1', 'wz3'])
+        self.assertEqual(read_compacted(self.files, feednames=['otherfeed']).num_rows, 0)
+        self.assertEqual(read_compacted(self.files, end='2021-03-01').num_rows, 0)
+
+        self.assertEqual(compact_lake(self.files, now=NOW), {MONTH_PREFIX: 'unchanged'})
+        self.assertEqual(compact_lake(self.files, now=NOW.replace(month=3)), {MONTH_PREFIX: 'open'})
+
+    def test_segmented_compressed_layout(self):
+        self.ingest(layout='segmented', compression='gzip')
+        compact_lake(self.files, now=NOW, print_func=lambda *args: None)
+        table = read_compacted(self.files)
+        self.assertEqual(table.num_rows, 7)
+        self.assertEqual(sorted(set(table.column('work_zone_id').to_pylist())), ['wz0', 'wz1', 'wz2', 'wz3'])
+
+    def test_deduplicated_headers(self):
+        self.ingest(dedup_headers=True)
+        compact_lake(self.files, now=NOW, print_func=lambda *args: None)
+        table = read_compacted(self.files, columns=['header.update_date'])
+        self.assertEqual(sorted(set(table.column('header.update_date').to_pylist())),
+                         ['2021-03-01T12:00:00Z', '2021-03-01T13:00:00Z'])
+
+    def test_local_directory(self):
+        self.ingest()
+        with tempfile.TemporaryDirectory() as root:
+            for key, obj in self.client.objects['test-bucket'].items():
+                os.makedirs(os.path.dirname(os.path.join(root, key)), exist_ok=True)
+                with open(os.path.join(root, key), 'wb') as out_f:
+                    out_f.write(obj['Body'])
+            files = LocalLakeFiles(root)
+            self.assertEqual(compact_lake(files, now=NOW, print_func=lambda *args: None),
+                             {MONTH_PREFIX: 'compacted'})
+            self.assertTrue(os.path.exists(os.path.join(root, 'compacted', '_manifest.json')))
+            self.assertEqual(read_compacted(files, states=['TS'], work_zone_ids=['wz3']).num_rows, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
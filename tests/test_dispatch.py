@@ -0,0 +1,100 @@
+import unittest
+import os
+import json
+import tempfile
+from unittest import mock
+
+from benchmarks.local_s3 import LocalS3Client
+from wzdx_sandbox.dispatch import (Dispatcher, MemoryQueue, SQLiteQueue, batch_response, create_queue, drain,
+    iter_work_items)
+from wzdx_sandbox.executor import TaskFailures
+from wzdx_sandbox.s3_helper import S3Helper
+from wzdx_sandbox.wzdx_sandbox import ingest_raw_feeds
+
+
+FEEDS = [{'feedname': 'feed{}'.format(i), 'state': 'TS', 'version': '3', 'format': 'geojson',
+          'pipedtosandbox': True, 'pipedtosocrata': i == 0} for i in range(3)]
+
+
+class FakeResponse(object):
+    status_code = 200
+    headers = {}
+
+    def iter_content(self, chunk_size=1):
+        yield b'{"features": []}'
+
+    def close(self):
+        pass
+
+
+class TestDispatch(unittest.TestCase):
+    def test_batches_send_each_feed_once(self):
+        queue = MemoryQueue()
+        dispatcher = Dispatcher({'lake': queue}, batch_size=4)
+        for i in range(10):
+            dispatcher.add('lake', FEEDS[i % 2], 'bucket', 'key{:02d}'.format(i))
+        self.assertEqual(dispatcher.flush(), {'lake': 3})
+        self.assertEqual(dispatcher.flush(), {'lake': 0})
+        messages = [message for _, message in queue.receive(10)]
+        self.assertEqual([len(message['items']) for message in messages], [4, 4, 2])
+        self.assertEqual(sorted(messages[0]['feeds']), ['feed0', 'feed1'])
+
+        # an SQS event of the same messages yields the same snapshots
+        sqs_event = {'Records': [{'body': json.dumps(message)} for message in messages]}
+        items = list(iter_work_items(sqs_event))
+        self.assertEqual([key for _, _, key in items], ['key{:02d}'.format(i) for i in range(10)])
+        self.assertEqual(items[1][0], FEEDS[1])
+        self.assertEqual(list(iter_work_items({'feed': FEEDS[0], 'bucket': 'b', 'key': 'k'})), [(FEEDS[0], 'b', 'k')])
+
+    def test_batch_response(self):
+        messages = [{'feeds': {'feed0': FEEDS[0]}, 'items': [{'feedname': 'feed0', 'bucket': 'b', 'key': key}]}
+                    for key in ['k1', 'k2', 'k3']]
+        sqs_event = {'Records': [{'messageId': 'm{}'.format(i), 'body': json.dumps(message)}
+                                 for i, message in enumerate(messages)]}
+        items = list(iter_work_items(sqs_event, with_message_ids=True))
+        self.assertEqual([(message_id, key) for message_id, _, _, key in items], [('m0', 'k1'), ('m1', 'k2'), ('m2', 'k3')])
+        self.assertEqual(list(iter_work_items(messages[0], with_message_ids=True)), [(None, FEEDS[0], 'b', 'k1')])
+
+        # only the messages holding a failed snapshot are delivered again
+        failures = [('m1', 'k2', RuntimeError('boom')), ('m1', 'k2b', RuntimeError('boom'))]
+        self.assertEqual(batch_response(sqs_event, failures), {'batchItemFailures': [{'itemIdentifier': 'm1'}]})
+        self.assertEqual(batch_response(sqs_event, []), {'batchItemFailures': []})
+        self.assertIsNone(batch_response(messages[0], []))
+        with self.assertRaises(TaskFailures):
+            batch_response(messages[0], [(None, 'k1', RuntimeError('boom'))])
+
+    def test_sqlite_queue(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'queue.db')
+            create_queue('sqlite:///' + path).send_batch([{'n': 1}, {'n': 2}])
+            queue = SQLiteQueue(path, visibility_timeout=60)
+            received = queue.receive(1)
+            self.assertEqual([message for _, message in received], [{'n': 1}])
+            # received messages are hidden until deleted or the visibility timeout passes
+            self.assertEqual([message for _, message in queue.receive(10)], [{'n': 2}])
+            self.assertEqual(queue.receive(10), [])
+            queue.delete([received[0][0]])
+            queue.visibility_timeout = 0
+            with mock.patch('time.time', return_value=1e12):
+                self.assertEqual([message for _, message in queue.receive(10)], [{'n': 2}])
+
+    def test_raw_ingest_dispatches_batches(self):
+        session = mock.Mock()
+        session.get.return_value = FakeResponse()
+        lambda_client = mock.Mock()
+        queues = {'lake': MemoryQueue()}
+        ingest_raw_feeds(FEEDS, 'raw-bucket', session=session, s3helper=S3Helper(client=LocalS3Client()),
+            url_dict={('TS', feed['feedname']): 'https://example.com/' for feed in FEEDS},
+            lambda_client=lambda_client, socrata_lambda_to_trigger='socrata', conditional_fetch=False,
+            dispatcher=Dispatcher(queues))
+
+        # no queue for socrata, so its lambda is still invoked
+        self.assertEqual([call[1]['FunctionName'] for call in lambda_client.invoke.call_args_list], ['socrata'])
+        handled = []
+        self.assertEqual(drain(queues['lake'], lambda message: handled.extend(iter_work_items(message))), 1)
+        self.assertEqual(sorted(feed['feedname'] for feed, _, _ in handled), ['feed0', 'feed1', 'feed2'])
+        self.assertEqual(queues['lake'].receive(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
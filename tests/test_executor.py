@@ -0,0 +1,46 @@
+import unittest
+import os
+import time
+
+from wzdx_sandbox.executor import create_executor, run_tasks, TaskFailures
+
+
+def _square(x):
+    return x * x
+
+
+def _fail_on_odd(x):
+    if x % 2:
+        raise ValueError(x)
+    return x
+
+
+class TestExecutor(unittest.TestCase):
+    def test_results_in_submission_order(self):
+        def slow_then_fast(i):
+            time.sleep(0.01 * (5 - i))
+            return i
+        with create_executor('thread', 3) as executor:
+            results = run_tasks(executor, slow_then_fast, [(i,) for i in range(5)])
+        self.assertEqual(results, [0, 1, 2, 3, 4])
+
+    def test_failures_are_ordered_and_do_not_stop_other_tasks(self):
+        done = []
+        def task(i):
+            done.append(i)
+            return _fail_on_odd(i)
+        with create_executor('thread', 2) as executor:
+            with self.assertRaises(TaskFailures) as cm:
+                run_tasks(executor, task, [(i,) for i in range(6)], task_ids=['k{}'.format(i) for i in range(6)])
+        self.assertEqual([task_id for task_id, _ in cm.exception.failures], ['k1', 'k3', 'k5'])
+        self.assertIsInstance(cm.exception.__cause__, ValueError)
+        self.assertEqual(sorted(done), list(range(6)))
+
+    def test_process_executor(self):
+        with create_executor('process', 2) as executor:
+            results = run_tasks(executor, _square, [(i,) for i in range(4)])
+        self.assertEqual(results, [0, 1, 4, 9])
+
+    def test_invalid_executor_type(self):
+        with self.assertRaises(ValueError):
+            create_executor('greenlet')
@@ -0,0 +1,72 @@
+import unittest
+import io
+import json
+
+import xmltodict
+
+from wzdx_sandbox.feed_stream import iter_json_feed, iter_xml_feed
+
+
+V1_XML = b'''<?xml version="1.0" encoding="UTF-8"?>
+<WZDx>
+  <Header><timeStampUpdate>2021-03-01T12:00:00Z</timeStampUpdate><versionNo>1.1</versionNo></Header>
+  <WorkZoneActivity><identifier>wz1</identifier><beginLocation><roadDirection>northbound</roadDirection></beginLocation></WorkZoneActivity>
+  <WorkZoneActivity><identifier>wz2</identifier><beginLocation><roadDirection>southbound</roadDirection></beginLocation>
+    <lanes><lane status="open">1</lane><lane status="closed">2</lane></lanes><empty/></WorkZoneActivity>
+</WZDx>'''
+
+NAMESPACED_XML = b'''<?xml version="1.0" encoding="UTF-8"?>
+<WZDx xmlns="http://www.its.dot.gov/wzdx/1.1" xmlns:ext="http://example.com/ext" ext:source="TS">
+  <Header><timeStampUpdate>2021-03-01T12:00:00Z</timeStampUpdate><versionNo>1.1</versionNo></Header>
+  <WorkZoneActivity ext:id="1" id="a"><identifier>wz1</identifier>
+    <beginLocation><roadDirection>northbound</roadDirection></beginLocation>
+    <ext:note xml:lang="en">lane <ext:b>1</ext:b> closed</ext:note><note>other</note></WorkZoneActivity>
+  <WorkZoneActivity xmlns:alt="http://example.com/ext"><identifier>wz2</identifier>
+    <beginLocation><roadDirection>southbound</roadDirection></beginLocation><alt:note>alt</alt:note><ext:note>ext</ext:note></WorkZoneActivity>
+</WZDx>'''
+
+
+def collect(events):
+    activities = []
+    for event, value in events:
+        if event == 'header':
+            header = json.loads(json.dumps(value))
+        elif event == 'activity':
+            activities.append(value)
+        else:
+            doc = value
+    return header, activities, doc
+
+
+class TestFeedStream(unittest.TestCase):
+    def test_json_feed(self):
+        data = {
+            'road_event_feed_info': {'update_date': '2021-03-01T12:00:00Z', 'version': '3.0', 'n': 123456789},
+            'type': 'FeatureCollection',
+            'features': [{'id': i, 'properties': {'name': 'é' * i}} for i in range(20)],
+            'bbox': [1.5, 2.25]
+        }
+        header, activities, doc = collect(iter_json_feed(io.BytesIO(json.dumps(data).encode('utf-8')), chunk_size=5))
+        self.assertEqual(header, {'road_event_feed_info': data['road_event_feed_info'], 'type': 'FeatureCollection', 'features': []})
+        self.assertEqual(activities, data['features'])
+        self.assertEqual(dict(doc, features=activities), data)
+
+    def test_json_feed_empty_and_invalid(self):
+        header, activities, doc = collect(iter_json_feed(io.BytesIO(b'{"features": [], "type": "x"}')))
+        self.assertEqual((header, activities, doc), ({'features': []}, [], {'features': [], 'type': 'x'}))
+        with self.assertRaises(ValueError):
+            collect(iter_json_feed(io.BytesIO(b'{"features": [{"a": 1} {"b": 2}]}')))
+
+    def test_xml_feed_matches_xmltodict(self):
+        header, activities, doc = collect(iter_xml_feed(io.BytesIO(V1_XML)))
+        expected = xmltodict.parse(V1_XML, dict_constructor=dict)
+        self.assertEqual(header['WZDx']['Header'], expected['WZDx']['Header'])
+        self.assertEqual(activities, expected['WZDx']['WorkZoneActivity'])
+
+    def test_namespaced_xml_feed_matches_xmltodict(self):
+        header, activities, doc = collect(iter_xml_feed(io.BytesIO(NAMESPACED_XML)))
+        expected = xmltodict.parse(NAMESPACED_XML, dict_constructor=dict)
+        self.assertEqual(header, dict(expected, WZDx=dict(expected['WZDx'], WorkZoneActivity=[])))
+        self.assertEqual(activities, expected['WZDx']['WorkZoneActivity'])
+        self.assertEqual(activities[0]['@ext:id'], '1')
+        self.assertEqual(activities[1]['alt:note'], 'alt')
@@ -0,0 +1,150 @@
+import unittest
+import json
+import threading
+from unittest import mock
+
+from benchmarks.local_s3 import LocalS3Client
+from wzdx_sandbox import digest_index
+from wzdx_sandbox.executor import TaskFailures
+from wzdx_sandbox.pipeline import StageGraph, run_single_pass
+from wzdx_sandbox.s3_helper import S3Helper
+from test_wzdx_sandbox import FEED, FakeResponse, make_v3_feed
+
+
+class TestStageGraph(unittest.TestCase):
+    def test_fan_out(self):
+        graph = StageGraph(max_queue=1)
+        graph.add_stage('double', lambda x: x * 2, workers=3)
+        graph.add_stage('odd_only', lambda x: x if x % 4 else None, upstream=['double'])
+        graph.add_stage('plus', lambda x: x + 1, upstream=['odd_only'])
+        graph.add_stage('minus', lambda x: x - 1, upstream=['odd_only'], workers=2)
+        results = graph.run(range(10))
+        self.assertEqual(set(results), {'plus', 'minus'})
+        self.assertEqual(results['plus'], [(1, 3), (3, 7), (5, 11), (7, 15), (9, 19)])
+        self.assertEqual(results['minus'], [(1, 1), (3, 5), (5, 9), (7, 13), (9, 17)])
+
+    def test_failures_do_not_stop_other_items(self):
+        def fail_on_three(x):
+            if x == 3:
+                raise ValueError('three')
+            return x
+
+        graph = StageGraph()
+        graph.add_stage('source', lambda x: x)
+        graph.add_stage('check', fail_on_three, upstream=['source'], workers=2)
+        with self.assertRaises(TaskFailures) as cm:
+            graph.run(range(5))
+        self.assertEqual(cm.exception.failures[0][0], ('check', 3))
+        self.assertEqual([i for i, _ in cm.exception.results['check']], [0, 1, 2, 4])
+
+    def test_queues_are_bounded(self):
+        release = threading.Event()
+        n_fed = []
+
+        def items():
+            for i in range(10):
+                n_fed.append(i)
+                yield i
+
+        graph = StageGraph(max_queue=2)
+        graph.add_stage('slow', lambda x: release.wait() and x)
+        runner = threading.Thread(target=graph.run, args=(items(),))
+        runner.start()
+        runner.join(0.2)
+        # one item being processed, two queued, one waiting to be queued
+        self.assertLessEqual(len(n_fed), 4)
+        release.set()
+        runner.join()
+        self.assertEqual(len(n_fed), 10)
+
+    def test_unknown_upstream(self):
+        graph = StageGraph()
+        with self.assertRaises(ValueError):
+            graph.add_stage('lake', lambda x: x, upstream=['parse'])
+
+
+class TestSinglePass(unittest.TestCase):
+    def setUp(self):
+        digest_index.clear_cache()
+        self.client = LocalS3Client()
+        self.s3helper = S3Helper(client=self.client)
+        self.feeds = [dict(FEED, feedname='feed{}'.format(i), pipedtosocrata=(i == 0)) for i in range(3)]
+        self.url_dict = {('TS', feed['feedname']): 'https://example.com/' + feed['feedname'] for feed in self.feeds}
+        self.session = mock.Mock()
+        self.session.get.side_effect = self.fake_get
+        self.synced = []
+
+    def fake_get(self, url, headers=None, timeout=None, stream=False):
+        if url.endswith('feed2'):
+            return FakeResponse(503)
+        return FakeResponse(200, json.dumps(make_v3_feed(3)).encode('utf-8'))
+
+    def fake_sync(self, feed, data, socrata_params, print_func=print, **kwargs):
+        self.synced.append((feed['feedname'], len(data['features']), socrata_params))
+        return 'published'
+
+    def run_single_pass(self):
+        return run_single_pass(self.feeds, 'raw-bucket', 'lake-bucket', socrata_params={'token': 't'},
+            session=self.session, s3helper=self.s3helper, url_dict=self.url_dict, sync=self.fake_sync,
+            state_bucket='state-bucket')
+
+    def test_snapshot_parsed_once_and_not_read_back(self):
+        get_object = mock.Mock(wraps=self.client.get_object)
+        with mock.patch('wzdx_sandbox.wzdx_sandbox.codec.loads', wraps=json.loads) as loads, \
+                mock.patch.object(self.client, 'get_object', get_object):
+            results = self.run_single_pass()
+            # one parse per new snapshot, fetch state reads not included
+            feed_loads = [call for call in loads.call_args_list if b'features' in call[0][0]]
+            self.assertEqual(len(feed_loads), 2)
+
+        self.assertEqual([result['feedname'] for result in results], ['feed0', 'feed1', 'feed2'])
+        self.assertTrue(results[0]['key'].startswith('state=TS/feedName=feed0/'))
+        self.assertEqual(results[0]['lake'].outcomes['new_fp'], 3)
+        self.assertEqual(results[1]['lake'].outcomes['new_fp'], 3)
+        self.assertEqual(results[0]['socrata'], 'published')
+        self.assertIsNone(results[1]['socrata'])
+        self.assertIsNone(results[2]['key'])
+        self.assertIsNone(results[2]['lake'])
+        self.assertEqual(self.synced, [('feed0', 3, {'token': 't'})])
+        # raw snapshots are never read back from S3
+        raw_keys = {result['key'] for result in results if result['key']}
+        self.assertFalse(raw_keys & {call[1]['Key'] for call in get_object.call_args_list})
+        lake_keys = [k for k in self.client.objects['lake-bucket'] if 'feedName=feed0' in k]
+        self.assertEqual(len(lake_keys), 3)
+
+    def test_unchanged_snapshot_skips_downstream_stages(self):
+        self.run_single_pass()
+        results = self.run_single_pass()
+        self.assertTrue(results[0]['key'].endswith('__UNCHANGED'))
+        self.assertIsNone(results[0]['lake'])
+        self.assertEqual(len(self.synced), 1)
+
+    def test_no_state_without_state_bucket(self):
+        sync_args = []
+
+        def recording_sync(feed, data, socrata_params, print_func=print, **kwargs):
+            sync_args.append(kwargs)
+            return 'published'
+
+        run_single_pass(self.feeds, 'raw-bucket', 'lake-bucket', socrata_params={},
+            session=self.session, s3helper=self.s3helper, url_dict=self.url_dict, sync=recording_sync)
+        self.assertNotIn('watermarks', sync_args[0])
+        self.assertNotIn('state_bucket', sync_args[0])
+        # no fetch state, digests or watermarks in the public buckets
+        self.assertEqual(sorted(self.client.objects), ['lake-bucket', 'raw-bucket'])
+        self.assertFalse([k for k in self.client.objects['raw-bucket'] if '/_' in k or k.startswith('socrata/')])
+
+    def test_failed_stage_is_reported(self):
+        def failing_sync(feed, data, socrata_params, print_func=print, **kwargs):
+            raise RuntimeError('socrata down')
+
+        results = run_single_pass(self.feeds, 'raw-bucket', 'lake-bucket', socrata_params={},
+            session=self.session, s3helper=self.s3helper, url_dict=self.url_dict, sync=failing_sync)
+        self.assertIn('socrata down', results[0]['error'])
+        # the lake stage still ran
+        self.assertEqual(results[0]['lake'].outcomes['new_fp'], 3)
+        self.assertIsNone(results[1]['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+import os
+
+from wzdx_sandbox.record_diff import canonical_hash, compile_paths, diff_records, DEFAULT_IGNORE_PATHS, GEOJSON_UPDATE_DATE_PATHS
+
+
+IGNORE_PATHS = DEFAULT_IGNORE_PATHS + GEOJSON_UPDATE_DATE_PATHS
+
+
+ACTIVITY = {
+    'type': 'Feature',
+    'properties': {'road_event_id': 'wz1', 'update_date': '2021-03-01T12:00:00Z',
+                   'core_details': {'direction': 'northbound', 'update_date': '2021-03-01T12:00:00Z'}},
+    'geometry': {'type': 'LineString', 'coordinates': [[-77.0, 38.0], [-77.1, 38.1]]}
+}
+
+
+class TestRecordDiff(unittest.TestCase):
+    def test_hash_ignores_key_order(self):
+        reordered = {k: ACTIVITY[k] for k in reversed(list(ACTIVITY))}
+        self.assertEqual(canonical_hash(ACTIVITY), canonical_hash(reordered))
+
+    def test_hash_ignores_nested_paths(self):
+        changed = {'type': 'Feature', 'geometry': ACTIVITY['geometry'],
+                   'properties': {'road_event_id': 'wz1', 'update_date': '2021-03-02T00:00:00Z',
+                                  'core_details': {'direction': 'northbound', 'update_date': '2021-03-02T00:00:00Z'}}}
+        self.assertNotEqual(canonical_hash(ACTIVITY), canonical_hash(changed))
+        self.assertNotEqual(canonical_hash(ACTIVITY, DEFAULT_IGNORE_PATHS), canonical_hash(changed, DEFAULT_IGNORE_PATHS))
+        self.assertEqual(canonical_hash(ACTIVITY, IGNORE_PATHS), canonical_hash(changed, IGNORE_PATHS))
+        self.assertEqual(canonical_hash(ACTIVITY, compile_paths(IGNORE_PATHS)),
+                         canonical_hash(ACTIVITY, IGNORE_PATHS))
+
+    def test_diff_records(self):
+        changed = {'type': 'Feature',
+                   'properties': {'road_event_id': 'wz1', 'update_date': '2021-03-02T00:00:00Z',
+                                  'core_details': {'direction': 'southbound', 'update_date': '2021-03-02T00:00:00Z'},
+                                  'end_date': '2021-04-01'},
+                   'geometry': {'type': 'LineString', 'coordinates': [[-77.0, 38.0], [-77.2, 38.2]]}}
+        diffs = diff_records(ACTIVITY, changed, IGNORE_PATHS)
+        self.assertEqual([d['path'] for d in diffs],
+            ['properties.core_details.direction', 'properties.end_date', 'geometry.coordinates'])
+        self.assertEqual(diffs[0], {'path': 'properties.core_details.direction', 'old': 'northbound', 'new': 'southbound'})
+        self.assertEqual(diffs[1]['old'], None)
+        self.assertEqual(set(diffs[2]['old']), {'hash'})
+        self.assertEqual(diff_records(ACTIVITY, ACTIVITY), [])
@@ -0,0 +1,131 @@
+import json
+import unittest
+import os
+
+from benchmarks.local_s3 import LocalS3Client
+from wzdx_sandbox.ingest_report import IngestReport
+from wzdx_sandbox import digest_index, record_store
+from wzdx_sandbox.record_store import create_record_store, SegmentedRecordStore
+from wzdx_sandbox.s3_helper import S3Helper
+from wzdx_sandbox.wzdx_sandbox import WorkZoneSandbox
+from test_wzdx_sandbox import FEED, make_v3_feed
+
+
+KEY = 'state=TS/feedName=testfeed/year=2021/month=03/wz1_northbound_202103_v3.0'
+
+
+class TestRecordStores(unittest.TestCase):
+    def setUp(self):
+        self.client = LocalS3Client()
+        self.s3helper = S3Helper(client=self.client)
+
+    def write_history(self, store):
+        store.append(KEY, {'n': 0})
+        for i in range(1, 6):
+            tail = store.read_tail(KEY)
+            if i % 2:
+                store.append(KEY, {'n': i}, tail)
+            else:
+                store.replace_last(KEY, {'n': i}, tail)
+        return store.read_recs(KEY)
+
+    def test_layouts_reconstruct_same_history(self):
+        ndjson = create_record_store('ndjson', self.s3helper, 'ndjson-bucket')
+        segmented = create_record_store('segmented', self.s3helper, 'segmented-bucket')
+        expected = [{'n': 0}, {'n': 2}, {'n': 4}, {'n': 5}]
+        self.assertEqual(self.write_history(ndjson), expected)
+        self.assertEqual(self.write_history(segmented), expected)
+        tail = segmented.read_tail(KEY)
+        self.assertEqual(tail.recs, [{'n': 4}, {'n': 5}])
+        self.assertEqual(tail.n_recs, 4)
+
+    def test_appended_lines_match_existing_lines(self):
+        # work zone files written before the codec was introduced
+        recs = [{'n': 0, 'description': 'Fermé'}, {'n': 1, 'description': 'Fermé'}]
+        self.client.put_object(Bucket='bucket', Key=KEY,
+                               Body='\n'.join(json.dumps(rec) for rec in recs[:1]).encode('utf-8'))
+        store = create_record_store('ndjson', self.s3helper, 'bucket')
+        store.append(KEY, recs[1], store.read_tail(KEY))
+        self.assertEqual(self.client.objects['bucket'][KEY]['Body'],
+                         '\n'.join(json.dumps(rec) for rec in recs).encode('utf-8'))
+        store.replace_last(KEY, recs[0], store.read_tail(KEY))
+        self.assertEqual(self.client.objects['bucket'][KEY]['Body'],
+                         '\n'.join(json.dumps(rec) for rec in recs[:1] * 2).encode('utf-8'))
+
+    def test_compressed_layouts(self):
+        expected = [{'n': 0}, {'n': 2}, {'n': 4}, {'n': 5}]
+        for layout in ['ndjson', 'segmented']:
+            store = create_record_store(layout, self.s3helper, layout, compression='gzip')
+            self.assertEqual(self.write_history(store), expected)
+            self.assertTrue(store.exists(KEY, self.s3helper.list_prefix(layout, KEY[:KEY.rindex('/')+1], delimiter='/')))
+            for key, obj in self.client.objects[layout].items():
+                if not key.endswith(SegmentedRecordStore.manifest_suffix):
+                    self.assertTrue(key.endswith('.gz'))
+                    self.assertEqual(obj['Body'][:2], b'\x1f\x8b')
+
+    def test_segmented_tail_reads_only_manifest(self):
+        store = create_record_store('segmented', self.s3helper, 'bucket')
+        for i in range(50):
+            tail = store.read_tail(KEY) if i else None
+            store.append(KEY, {'n': i, 'payload': 'x' * 100}, tail)
+        self.client.calls.clear()
+        tail = store.read_tail(KEY)
+        self.assertEqual(self.client.calls, {'get_object': 1})
+        manifest = self.client.objects['bucket'][KEY + SegmentedRecordStore.manifest_suffix]['Body']
+        self.assertLess(len(manifest), 400)
+        self.assertIn('state=TS/feedName=testfeed/year=2021/month=03/_parts/wz1_northbound_202103_v3.0/000049.ndjson',
+            self.client.objects['bucket'])
+        listing = self.s3helper.list_prefix('bucket', 'state=TS/feedName=testfeed/year=2021/month=03/', delimiter='/')
+        self.assertEqual(list(listing), [KEY + SegmentedRecordStore.manifest_suffix])
+
+    def test_ndjson_tail_read_is_ranged(self):
+        store = create_record_store('ndjson', self.s3helper, 'bucket')
+        self.s3helper.write_recs([{'n': i, 'payload': 'x' * 1000} for i in range(500)], 'bucket', KEY)
+        with self.s3helper.collect(IngestReport()) as report:
+            tail = store.read_tail(KEY)
+        self.assertEqual([rec['n'] for rec in tail.recs], [498, 499])
+        self.assertLess(report.bytes_read, 70000)
+        store.replace_last(KEY, {'n': 'last'}, tail)
+        recs = store.read_recs(KEY)
+        self.assertEqual(len(recs), 500)
+        self.assertEqual(recs[-1], {'n': 'last'})
+
+    def test_header_dedup(self):
+        header = {'update_date': '2021-03-01T12:00:00Z', 'version': '3.0', 'contact': 'x' * 1000}
+        for layout in ['ndjson', 'segmented']:
+            record_store.clear_header_cache()
+            bucket = layout + '-bucket'
+            store = create_record_store(layout, self.s3helper, bucket, dedup_headers=True,
+                header_field_names=['road_event_feed_info'])
+            self.assertEqual(self.write_history(store), [{'n': 0}, {'n': 2}, {'n': 4}, {'n': 5}])
+            recs = [{'road_event_feed_info': dict(header, update_date=str(i)), 'features': [{'n': i}]} for i in range(2)]
+            store.append(KEY, recs[0], store.read_tail(KEY))
+            store.append(KEY, recs[1], store.read_tail(KEY))
+            store.append(KEY, recs[1], store.read_tail(KEY))
+            headers = [key for key in self.client.objects[bucket] if '/_headers/' in key]
+            self.assertEqual(len(headers), 2)
+            # records are read back whole, also once the headers are no longer cached
+            record_store.clear_header_cache()
+            self.assertEqual(store.read_recs(KEY)[-3:], [recs[0], recs[1], recs[1]])
+            self.assertEqual(store.read_tail(KEY).recs, [recs[1], recs[1]])
+            stored = create_record_store(layout, self.s3helper, bucket).read_recs(KEY)[-1]
+            self.assertEqual(list(stored['road_event_feed_info']), ['$ref'])
+            self.assertIn(store.header_key(KEY, stored['road_event_feed_info']['$ref']), headers)
+
+    def test_sandbox_with_header_dedup(self):
+        digest_index.clear_cache()
+        record_store.clear_header_cache()
+        sandbox = WorkZoneSandbox(bucket='test-bucket', feed=FEED, dedup_headers=True, s3helper=self.s3helper)
+        for hour in [12, 13, 14, 14]:
+            sandbox.ingest(make_v3_feed(3, update_date='2021-03-01T{}:00:00Z'.format(hour)))
+        self.assertEqual(sandbox.n_skipped, 3)
+        key = 'state=TS/feedName=testfeed/year=2021/month=03/wz1_northbound_202103_v3.0'
+        recs = sandbox.read_recs(key)
+        self.assertEqual([rec['road_event_feed_info']['update_date'] for rec in recs],
+                         ['2021-03-01T12:00:00Z', '2021-03-01T14:00:00Z'])
+        self.assertEqual(recs[-1], dict(make_v3_feed(3, update_date='2021-03-01T14:00:00Z'),
+                                        features=[make_v3_feed(3)['features'][1]]))
+
+    def test_unknown_layout(self):
+        with self.assertRaises(ValueError):
+            create_record_store('csv', self.s3helper, 'bucket')
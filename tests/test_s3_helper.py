@@ -1,7 +1,17 @@
 import unittest
 import os
+import hashlib
+import json
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from benchmarks.local_s3 import LocalS3Client
+from wzdx_sandbox.compression import COMPRESSIONS
 from wzdx_sandbox.s3_helper import S3Helper
+from wzdx_sandbox.s3_helper import WriteConflict, retry_on_conflict
 
 
 class TestS3Helper(unittest.TestCase):
@@ -15,3 +25,123 @@ class TestS3Helper(unittest.TestCase):
         except:
             self.assertIsNone(test_s3_helper)
             raise
+
+
+class TestS3HelperLocal(unittest.TestCase):
+    def setUp(self):
+        self.client = LocalS3Client()
+        self.s3helper = S3Helper(client=self.client)
+
+    def test_list_prefix(self):
+        for i in range(2500):
+            self.s3helper.write_bytes(b'x' * i, 'bucket', 'state=TS/month=01/wz{}'.format(i))
+        self.s3helper.write_bytes(b'y', 'bucket', 'state=TS/month=02/wz0')
+        listing = self.s3helper.list_prefix('bucket', 'state=TS/month=01/')
+        self.assertEqual(len(listing), 2500)
+        self.assertEqual(listing['state=TS/month=01/wz7']['Size'], 7)
+        self.assertIn('ETag', listing['state=TS/month=01/wz7'])
+        self.assertEqual(self.client.calls['list_objects_v2'], 3)
+        self.assertTrue(self.s3helper.path_exists('bucket', 'state=TS/month=02/wz0'))
+        self.assertFalse(self.s3helper.path_exists('bucket', 'state=TS/month=02/wz1'))
+
+    def test_get_tail_recs(self):
+        recs = [{'n': i, 'payload': 'x' * (10 * i)} for i in range(200)]
+        self.s3helper.write_recs(recs, 'bucket', 'wz')
+        tail, offsets, body = self.s3helper.get_tail_recs('bucket', 'wz', n=2, window=64)
+        self.assertEqual(tail, recs[-2:])
+        self.assertIsNone(body)
+        whole = self.client.objects['bucket']['wz']['Body']
+        self.assertEqual(json.loads(whole[offsets[-1]:]), recs[-1])
+        self.assertGreater(self.client.calls['get_object'], 1)
+
+        self.s3helper.write_recs(recs[:1], 'bucket', 'wz1')
+        tail, offsets, body = self.s3helper.get_tail_recs('bucket', 'wz1', n=2)
+        self.assertEqual(tail, recs[:1])
+        self.assertEqual(offsets, [0])
+        self.assertEqual(body, self.client.objects['bucket']['wz1']['Body'])
+
+    def test_conditional_writes(self):
+        etag = self.s3helper.write_bytes(b'a', 'bucket', 'wz', if_none_match=True)['ETag']
+        with self.assertRaises(WriteConflict):
+            self.s3helper.write_bytes(b'b', 'bucket', 'wz', if_none_match=True)
+        etag = self.s3helper.write_bytes(b'{"n": 0}', 'bucket', 'wz', if_match=etag)['ETag']
+        with self.assertRaises(WriteConflict):
+            self.s3helper.write_recs([{'n': 1}], 'bucket', 'wz', if_match='"stale"')
+        with self.assertRaises(WriteConflict):
+            self.s3helper.write_bytes(b'c', 'bucket', 'missing', if_match=etag)
+        self.assertEqual(self.s3helper.get_bytes('bucket', 'wz'), (b'{"n": 0}', etag))
+        recs, offsets, body, tail_etag = self.s3helper.get_tail_recs('bucket', 'wz', with_etag=True)
+        self.assertEqual(tail_etag, etag)
+
+    def test_retry_on_conflict(self):
+        attempts = []
+
+        def write(attempt):
+            attempts.append(attempt)
+            # another writer changes the object between this writer's read and write, twice
+            data, etag = self.s3helper.get_bytes('bucket', 'counter')
+            if attempt < 2:
+                self.s3helper.write_bytes(str(int(data) + 1), 'bucket', 'counter')
+            return self.s3helper.write_bytes(str(int(data) + 1), 'bucket', 'counter', if_match=etag)
+
+        self.s3helper.write_bytes(b'0', 'bucket', 'counter')
+        retry_on_conflict(write, delay=0)
+        self.assertEqual(attempts, [0, 1, 2])
+        self.assertEqual(self.s3helper.get_bytes('bucket', 'counter')[0], b'3')
+        with self.assertRaises(WriteConflict):
+            retry_on_conflict(write, max_attempts=2, delay=0)
+
+    def test_compressed_objects(self):
+        recs = [{'n': i, 'road_event_id': 'wz{}'.format(i % 5), 'direction': 'northbound'} for i in range(1000)]
+        for compression in (['gzip', 'zstd'] if zstandard else ['gzip']):
+            key = 'wz' + COMPRESSIONS[compression].extension
+            self.s3helper.write_recs(recs, 'bucket', key, compression=compression, level=3)
+            obj = self.client.objects['bucket'][key]
+            self.assertEqual(obj['Headers'], {'ContentEncoding': COMPRESSIONS[compression].content_encoding})
+            self.assertLess(len(obj['Body']) * 10, len(b'\n'.join(json.dumps(rec).encode('utf-8') for rec in recs)))
+            self.assertEqual(list(self.s3helper.newline_json_rec_generator(
+                self.s3helper.get_data_stream('bucket', key))), recs)
+            tail, offsets, body = self.s3helper.get_tail_recs('bucket', key, n=2)
+            self.assertEqual(tail, recs[-2:])
+            self.assertEqual(json.loads(body[offsets[-1]:]), recs[-1])
+
+        # the Content-Encoding is enough to recognize a compressed object
+        self.s3helper.write_bytes(b'{"a": 1}', 'bucket', 'no_extension', compression='gzip')
+        self.assertEqual(json.loads(self.s3helper.get_data_stream('bucket', 'no_extension').read()), {'a': 1})
+        with self.assertRaises(ValueError):
+            self.s3helper.write_bytes(b'', 'bucket', 'wz.bz2', compression='bz2')
+
+    def test_write_stream(self):
+        content = b''.join(json.dumps({'n': i, 'payload': 'x' * 100}).encode('utf-8') + b'\n' for i in range(100000))
+        chunks = (content[i:i+65536] for i in range(0, len(content), 65536))
+        result = self.s3helper.write_stream(chunks, 'bucket', 'raw', part_size=5 * 1024 * 1024)
+        self.assertTrue(result['committed'])
+        self.assertEqual(result['sha256'], hashlib.sha256(content).hexdigest())
+        self.assertEqual(result['n_bytes'], len(content))
+        self.assertEqual(self.client.objects['bucket']['raw']['Body'], content)
+        self.assertTrue(result['ETag'].endswith('-3"'))
+        self.assertEqual(self.client.calls['upload_part'], 3)
+
+        # small content is written with one put_object call, compressed as it streams
+        result = self.s3helper.write_stream([content[:1000], content[1000:2000]], 'bucket', 'raw.gz', compression='gzip')
+        self.assertEqual(self.s3helper.get_data_stream('bucket', 'raw.gz').read(), content[:2000])
+        self.assertLess(result['n_bytes_written'], 500)
+        self.assertEqual(self.client.calls['put_object'], 1)
+
+    def test_write_stream_abandoned(self):
+        content = b'x' * (6 * 1024 * 1024)
+        result = self.s3helper.write_stream([content, b'y'], 'bucket', 'raw', part_size=5 * 1024 * 1024,
+            commit=lambda digest: digest != hashlib.sha256(content + b'y').hexdigest())
+        self.assertFalse(result['committed'])
+        self.assertNotIn('raw', self.client.objects.get('bucket', {}))
+        self.assertEqual(self.client.calls['abort_multipart_upload'], 1)
+        self.assertEqual(self.client.uploads, {})
+
+        def failing_chunks():
+            yield content
+            raise IOError('connection reset')
+        with self.assertRaises(IOError):
+            self.s3helper.write_stream(failing_chunks(), 'bucket', 'raw', part_size=5 * 1024 * 1024)
+        self.assertEqual(self.client.calls['abort_multipart_upload'], 2)
+        self.assertEqual(self.client.uploads, {})
+
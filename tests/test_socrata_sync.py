@@ -0,0 +1,111 @@
+import unittest
+from unittest import mock
+
+from benchmarks.local_s3 import LocalS3Client
+from wzdx_sandbox.executor import TaskFailures
+from wzdx_sandbox.s3_helper import S3Helper
+from wzdx_sandbox.socrata_sync import SocrataDigestIndex, get_feed_update_time, sync_feed
+from test_wzdx_sandbox import make_v3_feed
+
+
+FEED = {'feedname': 'testfeed', 'version': '3', 'socratadatasetid': 'abcd-1234'}
+
+
+class TestSyncFeed(unittest.TestCase):
+    def setUp(self):
+        self.dataset = mock.Mock()
+        self.dataset.create_new_draft.return_value = 'draft-id'
+        self.flattener = mock.Mock()
+        self.flattener.process_and_split.return_value = [{'road_event_id': 'wz0'}]
+
+    def sync(self, data):
+        return sync_feed(FEED, data, {}, dataset=self.dataset, flattener=self.flattener, print_func=lambda msg: None)
+
+    def test_publishes_newer_feed(self):
+        self.dataset.client.get.return_value = [{'update_date': '2021-03-01T11:00:00.000'}]
+        self.assertEqual(self.sync(make_v3_feed(1)), 'published')
+        self.dataset.clean_and_upsert.assert_called_once_with([{'road_event_id': 'wz0'}], 'draft-id')
+        self.dataset.publish_draft.assert_called_once_with('draft-id')
+
+    def test_skips_stale_feed(self):
+        self.dataset.client.get.return_value = [{'update_date': '2021-03-01T12:00:00.000'}]
+        self.assertEqual(self.sync(make_v3_feed(1)), 'stale')
+        self.dataset.create_new_draft.assert_not_called()
+
+    def test_skips_empty_feed(self):
+        self.dataset.client.get.return_value = []
+        self.flattener.process_and_split.return_value = []
+        self.assertEqual(self.sync(make_v3_feed(0)), 'empty')
+        self.dataset.create_new_draft.assert_not_called()
+
+    def test_feed_update_time(self):
+        self.assertEqual(get_feed_update_time(dict(FEED, version='4.1'),
+            {'feed_info': {'update_date': '2021-03-01T12:00:00Z', 'version': '4.1'}, 'type': 'FeatureCollection'}),
+            '2021-03-01T12:00:00')
+        self.assertEqual(get_feed_update_time(dict(FEED, version='2'),
+            {'road_event_feed_info': {'feed_update_date': '2021-03-01T12:00:00Z', 'version': '2.0'},
+             'type': 'FeatureCollection'}),
+            '2021-03-01T12:00:00')
+
+
+class TestIncrementalSync(unittest.TestCase):
+    def setUp(self):
+        self.s3helper = S3Helper(client=LocalS3Client())
+        self.dataset = mock.Mock()
+        self.dataset.client.get.return_value = []
+        self.dataset.create_new_draft.return_value = 'draft-id'
+        self.flattener = mock.Mock()
+
+    def sync(self, recs, **kwargs):
+        self.dataset.reset_mock()
+        self.dataset.client.get.return_value = []
+        self.flattener.process_and_split.return_value = recs
+        return sync_feed(FEED, make_v3_feed(1), {}, dataset=self.dataset, flattener=self.flattener,
+            print_func=lambda msg: None, mode='incremental', s3helper=self.s3helper,
+            state_bucket='state-bucket', **kwargs)
+
+    def test_incremental_sync_requires_state_bucket(self):
+        self.flattener.process_and_split.return_value = [{'road_event_id': 'wz0'}]
+        with self.assertRaises(ValueError):
+            sync_feed(FEED, make_v3_feed(1), {}, dataset=self.dataset, flattener=self.flattener,
+                print_func=lambda msg: None, mode='incremental', s3helper=self.s3helper)
+        self.assertFalse(self.s3helper.client.objects)
+
+    def test_delta_is_upserted(self):
+        recs = [{'road_event_id': 'wz{}'.format(i), 'direction': 'northbound'} for i in range(5)]
+        # no index yet, so the dataset is replaced
+        self.assertEqual(self.sync(recs), 'published')
+        self.dataset.publish_draft.assert_called_once_with('draft-id')
+        self.assertEqual(self.sync(recs), 'unchanged')
+        self.dataset.clean_and_upsert.assert_not_called()
+
+        recs = [dict(rec) for rec in recs[1:]] + [{'road_event_id': 'wz5', 'direction': 'southbound'}]
+        recs[0]['direction'] = 'southbound'
+        self.assertEqual(self.sync(recs, batch_size=1), 'updated')
+        self.dataset.create_new_draft.assert_not_called()
+        upserted = sorted(call[0][0][0]['road_event_id'] for call in self.dataset.clean_and_upsert.call_args_list)
+        self.assertEqual(upserted, ['wz1', 'wz5'])
+        self.dataset.client.upsert.assert_called_once_with('abcd-1234', [{'road_event_id': 'wz0', ':deleted': True}])
+        index = SocrataDigestIndex(self.s3helper, 'state-bucket', 'abcd-1234').load()
+        self.assertEqual(sorted(index.digests), ['wz1', 'wz2', 'wz3', 'wz4', 'wz5'])
+
+    def test_duplicate_row_ids_fall_back_to_full_replace(self):
+        recs = [{'road_event_id': 'wz0', 'lane': 1}, {'road_event_id': 'wz1', 'lane': 1}]
+        self.sync(recs)
+        self.assertEqual(self.sync(recs + [{'road_event_id': 'wz0', 'lane': 2}]), 'published')
+        # the index no longer matches the dataset, so the next sync replaces it again
+        self.assertEqual(self.sync(recs), 'published')
+        self.assertEqual(self.sync(recs), 'unchanged')
+
+    def test_failed_batch_keeps_index(self):
+        recs = [{'road_event_id': 'wz0', 'lane': 1}]
+        self.sync(recs)
+        self.dataset.clean_and_upsert.side_effect = IOError('throttled')
+        with self.assertRaises(TaskFailures):
+            self.sync([{'road_event_id': 'wz0', 'lane': 2}])
+        self.dataset.clean_and_upsert.side_effect = None
+        self.assertEqual(self.sync([{'road_event_id': 'wz0', 'lane': 2}]), 'updated')
+
+
+if __name__ == '__main__':
+    unittest.main()
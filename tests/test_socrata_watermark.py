@@ -0,0 +1,81 @@
+import unittest
+import tempfile
+from unittest import mock
+
+from benchmarks.local_s3 import LocalS3Client
+from wzdx_sandbox.s3_helper import S3Helper
+from wzdx_sandbox.socrata_sync import sync_feed
+from wzdx_sandbox.socrata_watermark import (LocalWatermarkStore, S3WatermarkStore, create_watermark_store,
+    make_watermark)
+from test_wzdx_sandbox import make_v3_feed
+
+
+FEED = {'feedname': 'testfeed', 'version': '3', 'socratadatasetid': 'abcd-1234'}
+
+
+class TestWatermarkStores(unittest.TestCase):
+    def test_local_store(self):
+        with tempfile.TemporaryDirectory() as path:
+            store = create_watermark_store('file://' + path)
+            self.assertIsInstance(store, LocalWatermarkStore)
+            self.assertIsNone(store.get('abcd-1234'))
+            store.put('abcd-1234', make_watermark('2021-03-01T12:00:00', 'hash', 10))
+            self.assertEqual(LocalWatermarkStore(path).get('abcd-1234'),
+                {'update_time': '2021-03-01T12:00:00', 'sha256': 'hash', 'checked_at': 10})
+
+    def test_s3_store(self):
+        s3helper = S3Helper(client=LocalS3Client())
+        store = create_watermark_store('s3://state-bucket/watermarks', s3helper)
+        self.assertIsInstance(store, S3WatermarkStore)
+        self.assertIsNone(store.get('abcd-1234'))
+        store.put('abcd-1234', make_watermark('2021-03-01T12:00:00'))
+        self.assertIn('watermarks/datasetId=abcd-1234/_watermark.json', s3helper.client.objects['state-bucket'])
+        self.assertEqual(store.get('abcd-1234')['update_time'], '2021-03-01T12:00:00')
+
+
+class TestWatermarkStaleness(unittest.TestCase):
+    def setUp(self):
+        self.watermarks = S3WatermarkStore(S3Helper(client=LocalS3Client()), 'state-bucket')
+        self.dataset = mock.Mock()
+        self.dataset.client.get.return_value = [{'update_date': '2021-03-01T11:00:00.000'}]
+        self.flattener = mock.Mock()
+        self.flattener.process_and_split.return_value = [{'road_event_id': 'wz0'}]
+
+    def sync(self, data, **kwargs):
+        return sync_feed(FEED, data, {}, dataset=self.dataset, flattener=self.flattener,
+            print_func=lambda msg: None, watermarks=self.watermarks, **kwargs)
+
+    def test_watermark_replaces_socrata_query(self):
+        self.assertEqual(self.sync(make_v3_feed(1)), 'published')
+        # the most recent row is read, not an arbitrary one
+        self.dataset.client.get.assert_called_once_with('abcd-1234', limit=1, order='update_date DESC')
+        self.assertEqual(self.watermarks.get('abcd-1234')['update_time'], '2021-03-01T12:00:00')
+
+        self.dataset.client.get.reset_mock()
+        self.assertEqual(self.sync(make_v3_feed(1)), 'stale')
+        self.assertEqual(self.sync(make_v3_feed(1, update_date='2021-03-01T13:00:00Z')), 'published')
+        self.dataset.client.get.assert_not_called()
+
+    def test_same_content_is_stale(self):
+        self.sync(make_v3_feed(1))
+        self.watermarks.put('abcd-1234', dict(self.watermarks.get('abcd-1234'), update_time='2021-03-01T13:00:00'))
+        self.assertEqual(self.sync(make_v3_feed(1)), 'stale')
+
+    def test_expired_watermark_is_reconciled(self):
+        self.watermarks.put('abcd-1234', make_watermark('2021-03-01T10:00:00', checked_at=0))
+        # another process published a more recent feed in the meantime
+        self.dataset.client.get.return_value = [{'update_date': '2021-03-01T12:00:00.000'}]
+        self.assertEqual(self.sync(make_v3_feed(1)), 'stale')
+        self.assertEqual(self.dataset.client.get.call_count, 1)
+        self.assertEqual(self.watermarks.get('abcd-1234')['update_time'], '2021-03-01T12:00:00')
+
+    def test_refresh(self):
+        self.watermarks.put('abcd-1234', make_watermark('2021-03-01T10:00:00'))
+        self.dataset.client.get.return_value = [{'update_date': '2021-03-01T12:00:00.000'}]
+        self.assertEqual(self.sync(make_v3_feed(1)), 'published')
+        self.watermarks.put('abcd-1234', make_watermark('2021-03-01T10:00:00'))
+        self.assertEqual(self.sync(make_v3_feed(1), refresh=True), 'stale')
+
+
+if __name__ == '__main__':
+    unittest.main()
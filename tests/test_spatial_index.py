@@ -0,0 +1,137 @@
+import unittest
+import io
+
+from benchmarks.local_s3 import LocalS3Client
+from wzdx_sandbox import digest_index
+from wzdx_sandbox.s3_helper import S3Helper
+from wzdx_sandbox.spatial_index import FeedSpatialIndex, month_prefixes, to_epoch
+from wzdx_sandbox.spec_registry import WzdxV1Spec, geometry_bbox
+from wzdx_sandbox.wzdx_sandbox import WorkZoneSandbox
+from test_wzdx_sandbox import FEED, make_v3_feed
+
+
+PREFIX = 'state=TS/feedName=testfeed/year=2021/month=03/'
+
+
+def make_feed(update_date, n=3):
+    data = make_v3_feed(n, update_date=update_date)
+    for i, feature in enumerate(data['features']):
+        feature['geometry']['coordinates'] = [[-77.0 + i, 38.0], [-77.1 + i, 38.1]]
+        feature['properties']['start_date'] = '2021-03-0{}T00:00:00Z'.format(i + 1)
+        feature['properties']['end_date'] = '2021-03-0{}T00:00:00Z'.format(i + 2)
+    return data
+
+
+class TestSpatialIndex(unittest.TestCase):
+    def setUp(self):
+        digest_index.clear_cache()
+        self.client = LocalS3Client()
+        self.sandbox = WorkZoneSandbox(bucket='test-bucket', feed=FEED, use_spatial_index=True,
+            s3helper=S3Helper(client=self.client))
+
+    def test_bboxes(self):
+        self.assertEqual(geometry_bbox({'type': 'MultiLineString', 'coordinates': [[[1, 5], [2, 3]], [[0, 4]]]}),
+                         (0, 3, 2, 5))
+        self.assertIsNone(geometry_bbox(None))
+        activity = {'beginLocation': {'latitude': '38.5', 'longitude': '-77.5'},
+                    'endLocation': {'latitude': '38.0', 'longitude': '-77.0'}}
+        self.assertEqual(WzdxV1Spec().get_bbox(activity), (-77.5, 38.0, -77.0, 38.5))
+        self.assertIsNone(WzdxV1Spec().get_bbox({'beginLocation': {'roadDirection': 'northbound'}}))
+
+    def test_index_follows_ingest(self):
+        self.sandbox.ingest(make_feed('2021-03-01T12:00:00Z'))
+        self.sandbox.ingest(make_feed('2021-03-01T12:00:00Z'))
+        index = FeedSpatialIndex(self.sandbox.s3helper, 'test-bucket', PREFIX).load()
+        self.assertEqual(index.entries['wz1_northbound_202103_v3.0'],
+            [[0, -76.1, 38.0, -76.0, 38.1, to_epoch('2021-03-02'), to_epoch('2021-03-03'),
+              to_epoch('2021-03-01T12:00:00Z')]])
+
+        data = make_feed('2021-03-01T13:00:00Z')
+        data['features'][1]['properties']['end_date'] = '2021-03-20T00:00:00Z'
+        self.sandbox.ingest(data)
+        data = make_feed('2021-03-01T14:00:00Z')
+        data['features'][1]['properties']['end_date'] = '2021-03-20T00:00:00Z'
+        self.sandbox.ingest(data)
+        index.load()
+        # the second status was overwritten by the third
+        entries = index.entries['wz1_northbound_202103_v3.0']
+        self.assertEqual([entry[0] for entry in entries], [0, 1])
+        self.assertEqual(entries[1][-2:], [to_epoch('2021-03-20'), to_epoch('2021-03-01T14:00:00Z')])
+        self.assertEqual(len(self.sandbox.read_recs(PREFIX + 'wz1_northbound_202103_v3.0')), 2)
+
+    def test_ingest_reads_and_writes_only_its_day(self):
+        self.sandbox.ingest(make_feed('2021-03-01T12:00:00Z'))
+        data = make_feed('2021-03-02T12:00:00Z', n=1)
+        data['features'][0]['properties']['end_date'] = '2021-03-20T00:00:00Z'
+        shard = self.client.objects['test-bucket'][PREFIX + '_spatial_index/01.json']
+        get_object = self.client.get_object
+        keys_read = []
+
+        def recording_get_object(**kwargs):
+            keys_read.append(kwargs['Key'])
+            return get_object(**kwargs)
+
+        self.client.get_object = recording_get_object
+        self.sandbox.ingest(data)
+        self.assertIn(PREFIX + '_spatial_index/02.json', keys_read)
+        self.assertNotIn(PREFIX + '_spatial_index/01.json', keys_read)
+        self.assertIs(self.client.objects['test-bucket'][PREFIX + '_spatial_index/01.json'], shard)
+        index = FeedSpatialIndex(self.sandbox.s3helper, 'test-bucket', PREFIX).load()
+        self.assertEqual(sorted(index.shards), ['01', '02'])
+        self.assertEqual([entry[0] for entry in index.entries['wz0_northbound_202103_v3.0']], [0, 1])
+        results = list(self.sandbox.query(start='2021-03-15', end='2021-03-31'))
+        self.assertEqual([(key, offset) for key, offset, _ in results], [(PREFIX + 'wz0_northbound_202103_v3.0', 1)])
+
+    def test_query(self):
+        self.sandbox.ingest(make_feed('2021-03-01T12:00:00Z'))
+        self.client.calls.clear()
+        results = list(self.sandbox.query(bbox=(-76.5, 37.5, -75.5, 38.5), start='2021-03-02T12:00:00Z',
+                                          end='2021-03-31'))
+        self.assertEqual([(key, offset) for key, offset, _ in results], [(PREFIX + 'wz1_northbound_202103_v3.0', 0)])
+        self.assertEqual(results[0][2]['features'][0]['properties']['road_event_id'], 'wz1')
+        # the index and the one matching work zone file
+        self.assertEqual(self.client.calls['get_object'], 2)
+        self.assertEqual(list(self.sandbox.query(start='2021-03-10', end='2021-03-31')), [])
+        self.assertEqual(len(list(self.sandbox.query(start='2021-03-01', end='2021-03-31'))), 3)
+        with self.assertRaises(ValueError):
+            self.sandbox.query(bbox=(0, 0, 1, 1))
+
+    def test_files_written_before_the_index(self):
+        sandbox = WorkZoneSandbox(bucket='test-bucket', feed=FEED, s3helper=S3Helper(client=self.client))
+        sandbox.ingest(make_feed('2021-03-01T12:00:00Z'))
+        sandbox.ingest(make_feed('2021-03-01T13:00:00Z', n=1))
+        data = make_feed('2021-03-01T14:00:00Z', n=1)
+        data['features'][0]['properties']['end_date'] = '2021-03-25T00:00:00Z'
+        self.sandbox.ingest(data)
+        index = FeedSpatialIndex(self.sandbox.s3helper, 'test-bucket', PREFIX).load()
+        self.assertEqual(list(index.entries), ['wz0_northbound_202103_v3.0'])
+        # the offset of the status comes from the work zone file
+        self.assertEqual(index.entries['wz0_northbound_202103_v3.0'][0][0], 2)
+        results = list(self.sandbox.query(start='2021-03-24', end='2021-03-31'))
+        self.assertEqual([offset for _, offset, _ in results], [2])
+
+    def test_conditional_save_merges(self):
+        indexes = [FeedSpatialIndex(self.sandbox.s3helper, 'test-bucket', PREFIX, conditional=True).load()
+                   for _ in range(2)]
+        entry = [-77.0, 38.0, -76.9, 38.1, None, None, 0]
+        indexes[0].update(PREFIX + 'wz0', 'new_fp', entry)
+        indexes[0].update(PREFIX + 'wz1', 'new_fp', entry)
+        indexes[1].update(PREFIX + 'wz1', 'new_fp', [0, 0, 1, 1, None, None, 1])
+        indexes[1].update(PREFIX + 'wz2', 'new_fp', entry)
+        indexes[0].save()
+        indexes[1].save()
+        saved = FeedSpatialIndex(self.sandbox.s3helper, 'test-bucket', PREFIX).load().entries
+        self.assertEqual(saved['wz0'], [[0] + entry])
+        self.assertEqual(saved['wz2'], [[0] + entry])
+        # both wrote wz1: both entries are kept, with unknown offsets
+        self.assertEqual(saved['wz1'], [[None] + entry, [None, 0, 0, 1, 1, None, None, 1]])
+
+    def test_month_prefixes(self):
+        self.assertEqual(month_prefixes(self.sandbox.prefix_template, FEED, '2021-12-15', '2022-02-01'), [
+            'state=TS/feedName=testfeed/year=2021/month=12/',
+            'state=TS/feedName=testfeed/year=2022/month=01/',
+            'state=TS/feedName=testfeed/year=2022/month=02/'])
+
+
+if __name__ == '__main__':
+    unittest.main()
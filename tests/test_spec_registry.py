@@ -0,0 +1,73 @@
+import unittest
+
+from benchmarks.local_s3 import LocalS3Client
+from wzdx_sandbox import digest_index, spec_registry
+from wzdx_sandbox.s3_helper import S3Helper
+from wzdx_sandbox.spec_registry import SpecVersion, WzdxV4Spec, find_spec, get_spec, register_spec, resolve_feed
+from wzdx_sandbox.wzdx_sandbox import WorkZoneSandbox
+
+
+def make_v41_feed():
+    return {
+        'feed_info': {'update_date': '2021-06-01T12:00:00Z', 'version': '4.1'},
+        'type': 'FeatureCollection',
+        'features': [
+            {'id': 'wz0', 'type': 'Feature',
+             'properties': {'core_details': {'direction': 'eastbound'}}}
+        ]
+    }
+
+
+class WzdxDeviceSpec(SpecVersion):
+    feed_type = 'wzdx_device'
+    header_field_names = ('feed_info',)
+    update_time_field_name = 'update_date'
+    road_direction_path = ('properties', 'core_details', 'device_type')
+
+
+class TestSpecRegistry(unittest.TestCase):
+    def tearDown(self):
+        spec_registry._specs.pop(('wzdx_device', '4'), None)
+
+    def test_versions_resolve_by_prefix(self):
+        self.assertIsInstance(find_spec('wzdx', '4.1'), WzdxV4Spec)
+        self.assertIs(find_spec('wzdx', '3.1'), find_spec('wzdx', '3'))
+        self.assertIsNone(find_spec('wzdx', '5'))
+
+    def test_unregistered_version_falls_back_to_latest(self):
+        spec_registry._fallbacks_warned.clear()
+        with self.assertLogs('wzdx_sandbox.spec_registry', level='WARNING') as logs:
+            layout = resolve_feed({'version': '5'}, make_v41_feed())
+            resolve_feed({'version': '5'}, make_v41_feed())
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('version 5', logs.output[0])
+        self.assertEqual(layout.field_name_tuple, ('feed_info', 'update_date', 'features'))
+        self.assertIsInstance(get_spec({'version': '5.0'}), WzdxV4Spec)
+        with self.assertRaises(ValueError):
+            get_spec({'version': '1', 'feedtype': 'unknown'})
+
+    def test_layout(self):
+        layout = resolve_feed({'version': '4.1'}, make_v41_feed())
+        self.assertEqual(layout.field_name_tuple, ('feed_info', 'update_date', 'features'))
+        activity = layout.activities()[0]
+        self.assertEqual(layout.get_identifier(activity), 'wz0')
+        self.assertEqual(layout.get_road_direction(activity), 'eastbound')
+        self.assertEqual(layout.generate_out_rec(activity),
+            {'feed_info': make_v41_feed()['feed_info'], 'features': [activity], 'type': 'FeatureCollection'})
+
+    def test_new_feed_type_without_sandbox_changes(self):
+        digest_index.clear_cache()
+        register_spec(WzdxDeviceSpec(), '4')
+        feed = {'feedname': 'devices', 'state': 'TS', 'version': '4.1', 'format': 'geojson', 'feedtype': 'wzdx_device'}
+        data = make_v41_feed()
+        data['features'][0]['properties']['core_details'] = {'device_type': 'arrow-board'}
+        client = LocalS3Client()
+        sandbox = WorkZoneSandbox(bucket='test-bucket', feed=feed, s3helper=S3Helper(client=client))
+        report = sandbox.ingest(data)
+        self.assertEqual(report.outcomes['new_fp'], 1)
+        self.assertIn('state=TS/feedName=devices/year=2021/month=06/wz0_arrow-board_202106_v4.1',
+            client.objects['test-bucket'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,417 @@
 import unittest
 import os
+import io
+import json
+from unittest import mock
+
+from benchmarks.local_s3 import LocalS3Client
+from wzdx_sandbox import digest_index
+from wzdx_sandbox.executor import TaskFailures
+from wzdx_sandbox.ingest_report import IngestReport
+from wzdx_sandbox.record_diff import DEFAULT_IGNORE_PATHS, GEOJSON_UPDATE_DATE_PATHS
+from wzdx_sandbox.s3_helper import S3Helper
+from wzdx_sandbox.wzdx_sandbox import WorkZoneRawSandbox, WorkZoneSandbox, ingest_raw_feeds
+from test_feed_stream import NAMESPACED_XML, V1_XML
+
+
+FEED = {'feedname': 'testfeed', 'state': 'TS', 'version': '3', 'format': 'geojson'}
+
+
+def make_v3_feed(n, update_date='2021-03-01T12:00:00Z'):
+    return {
+        'road_event_feed_info': {'update_date': update_date, 'version': '3.0'},
+        'type': 'FeatureCollection',
+        'features': [
+            {'type': 'Feature',
+             'properties': {'road_event_id': 'wz{}'.format(i), 'direction': 'northbound'},
+             'geometry': {'type': 'LineString', 'coordinates': [[-77.0, 38.0], [-77.1, 38.1]]}}
+            for i in range(n)
+        ]
+    }
 
 
 class TestWZDxSandboxImports(unittest.TestCase):
     def test_imports(self):
-        from wzdx_sandbox.wzdx_sandbox import ITSSandbox, WorkZoneSandbox, WorkZoneRawSandbox
\ No newline at end of file
+        from wzdx_sandbox.wzdx_sandbox import ITSSandbox, WorkZoneSandbox, WorkZoneRawSandbox
+
+
+class TestWorkZoneSandboxIngest(unittest.TestCase):
+    def setUp(self):
+        digest_index.clear_cache()
+        self.client = LocalS3Client()
+        self.sandbox = WorkZoneSandbox(bucket='test-bucket', feed=FEED, use_digest_index=True,
+            state_bucket='state-bucket', s3helper=S3Helper(client=self.client))
+
+    def test_ingest_report_outcomes(self):
+        report = self.sandbox.ingest(make_v3_feed(3))
+        self.assertEqual(report.outcomes, {'skipped': 0, 'overwrite': 0, 'new_status': 0, 'new_fp': 3})
+        # three work zone files and the digest index, which is kept out of the lake bucket
+        self.assertEqual(report.s3_calls, {'head_object': 1, 'list_objects_v2': 1, 'put_object': 4})
+        self.assertEqual(list(self.client.objects['state-bucket']),
+                         ['state=TS/feedName=testfeed/year=2021/month=03/_digests.json'])
+        self.assertEqual(report.bytes_read, 0)
+        self.assertEqual(report.bytes_written,
+            sum(len(obj['Body']) for objects in self.client.objects.values() for obj in objects.values()))
+
+        report = self.sandbox.ingest(make_v3_feed(3))
+        self.assertEqual(report.outcomes['skipped'], 3)
+        self.assertEqual(report.s3_calls, {'head_object': 1, 'list_objects_v2': 1})
+
+        # the digest covers the work zone activity, so a new feed update time alone is no change
+        report = self.sandbox.ingest(make_v3_feed(3, update_date='2021-03-01T13:00:00Z'))
+        self.assertEqual(report.outcomes['skipped'], 3)
+        data = make_v3_feed(3, update_date='2021-03-01T14:00:00Z')
+        data['features'][0]['properties']['description'] = 'lane 1'
+        report = self.sandbox.ingest(data)
+        self.assertEqual(report.outcomes['new_status'], 1)
+        self.assertEqual(report.outcomes['skipped'], 2)
+
+        report_dict = report.to_dict()
+        self.assertEqual(report_dict['n_statuses'], 3)
+        self.assertEqual(set(report_dict['phase_cpu_seconds']), set(IngestReport.PHASES))
+
+    def test_skip_replayed_snapshots(self):
+        for skip_replayed, expected in [(False, ['12:00', '12:05', '12:00']), (True, ['12:00', '12:05'])]:
+            digest_index.clear_cache()
+            client = LocalS3Client()
+            sandbox = WorkZoneSandbox(bucket='test-bucket', feed=FEED, skip_replayed=skip_replayed,
+                s3helper=S3Helper(client=client))
+            # the first snapshot is delivered again after the second one
+            for update_date, description in [('12:00', 'lane 1'), ('12:05', 'lane 2'), ('12:00', 'lane 1')]:
+                data = make_v3_feed(1, update_date='2021-03-01T{}:00Z'.format(update_date))
+                data['features'][0]['properties']['description'] = description
+                report = sandbox.ingest(data)
+            key = next(key for key in client.objects['test-bucket'] if '/wz0_' in key)
+            history = [rec['road_event_feed_info']['update_date'][11:16] for rec in sandbox.read_recs(key)]
+            self.assertEqual(history, expected)
+            self.assertEqual(report.outcomes['skipped'], int(skip_replayed))
+
+    def test_skip_replayed_with_mixed_time_zones(self):
+        sandbox = WorkZoneSandbox(bucket='test-bucket', feed=FEED, skip_replayed=True,
+            s3helper=S3Helper(client=self.client))
+        sandbox.ingest(make_v3_feed(1, update_date='2021-03-01T12:00:00Z'))
+        data = make_v3_feed(1, update_date='2021-03-01T11:00:00')
+        data['features'][0]['properties']['description'] = 'lane 1'
+        self.assertEqual(sandbox.ingest(data).outcomes['skipped'], 1)
+        data = make_v3_feed(1, update_date='2021-03-01T13:00:00')
+        data['features'][0]['properties']['description'] = 'lane 1'
+        self.assertEqual(sandbox.ingest(data).outcomes['new_status'], 1)
+
+    def test_changed_fields_and_ignored_update_date(self):
+        self.sandbox = WorkZoneSandbox(bucket='test-bucket', feed=FEED, s3helper=S3Helper(client=self.client),
+            ignore_paths=DEFAULT_IGNORE_PATHS + GEOJSON_UPDATE_DATE_PATHS)
+        self.sandbox.ingest(make_v3_feed(2, update_date='2021-03-01T12:00:00Z'))
+        self.sandbox.ingest(make_v3_feed(2, update_date='2021-03-01T13:00:00Z'))
+        data = make_v3_feed(2, update_date='2021-03-01T14:00:00Z')
+        for feature in data['features']:
+            feature['properties']['update_date'] = '2021-03-01T14:00:00Z'
+        report = self.sandbox.ingest(data)
+        self.assertEqual(report.outcomes['overwrite'], 2)
+        data['features'][0]['properties']['direction'] = 'southbound'
+        data['features'][1]['properties']['end_date'] = '2021-03-02'
+        report = self.sandbox.ingest(data)
+        self.assertEqual(report.outcomes['new_status'], 1)
+        self.assertEqual(report.outcomes['new_fp'], 1)
+        self.assertEqual(report.changed_fields, {'properties.end_date': 1})
+
+    def test_ingest_stream_matches_ingest(self):
+        data = make_v3_feed(20)
+        # feed header after the activity list
+        trailing_header = {'type': data['type'], 'features': data['features'],
+                           'road_event_feed_info': data['road_event_feed_info']}
+        for i, feed in enumerate([data, trailing_header]):
+            stream_client = LocalS3Client()
+            stream_sandbox = WorkZoneSandbox(bucket='test-bucket', feed=FEED, s3helper=S3Helper(client=stream_client))
+            report = stream_sandbox.ingest_stream(io.BytesIO(json.dumps(feed).encode('utf-8')), chunk_size=64)
+            self.assertEqual(report.outcomes['new_fp'], 20)
+            self.assertGreater(report.phase_cpu_seconds['parse'], 0)
+            if i == 0:
+                self.sandbox.ingest(json.dumps(data))
+            self.assertEqual(
+                {k: v['Body'] for k, v in stream_client.objects['test-bucket'].items()},
+                {k: v['Body'] for k, v in self.client.objects['test-bucket'].items()})
+
+    def test_ingest_stream_v1_xml(self):
+        feed = {'feedname': 'testfeed', 'state': 'TS', 'version': '1', 'format': 'xml'}
+        sandbox = WorkZoneSandbox(bucket='test-bucket', feed=feed, s3helper=S3Helper(client=self.client))
+        report = sandbox.ingest_stream(io.BytesIO(V1_XML))
+        self.assertEqual(report.outcomes['new_fp'], 2)
+        recs = sandbox.read_recs('state=TS/feedName=testfeed/year=2021/month=03/wz2_southbound_202103_v1.1')
+        self.assertEqual(recs[0]['WorkZoneActivity'][0]['lanes']['lane'][1], {'@status': 'closed', '#text': '2'})
+        report = sandbox.ingest(V1_XML)
+        self.assertEqual(report.outcomes['skipped'], 2)
+
+    def test_ingest_stream_namespaces_and_duplicates_match_ingest(self):
+        v1_feed = {'feedname': 'testfeed', 'state': 'TS', 'version': '1', 'format': 'xml'}
+        duplicated = make_v3_feed(3)
+        # wz0 appears twice, its last status is kept
+        duplicated['features'].append(json.loads(json.dumps(duplicated['features'][0])))
+        duplicated['features'][-1]['properties']['description'] = 'later'
+        for feed, data in [(v1_feed, NAMESPACED_XML), (FEED, json.dumps(duplicated).encode('utf-8'))]:
+            clients = [LocalS3Client(), LocalS3Client()]
+            sandboxes = [WorkZoneSandbox(bucket='test-bucket', feed=feed, s3helper=S3Helper(client=client))
+                         for client in clients]
+            reports = [sandboxes[0].ingest(data), sandboxes[1].ingest_stream(io.BytesIO(data), chunk_size=64)]
+            self.assertEqual(reports[0].outcomes, reports[1].outcomes)
+            self.assertEqual(reports[0].n_statuses, reports[1].n_statuses)
+            self.assertEqual(*[{k: v['Body'] for k, v in client.objects['test-bucket'].items()} for client in clients])
+            if feed is v1_feed:
+                recs = sandboxes[1].read_recs('state=TS/feedName=testfeed/year=2021/month=03/wz1_northbound_202103_v1.1')
+                self.assertEqual(recs[0]['WorkZoneActivity'][0]['@ext:id'], '1')
+        recs = sandboxes[1].read_recs('state=TS/feedName=testfeed/year=2021/month=03/wz0_northbound_202103_v3.0')
+        self.assertEqual([rec['features'][0]['properties'].get('description') for rec in recs], ['later'])
+
+    def test_ingest_without_digest_index(self):
+        sandbox = WorkZoneSandbox(bucket='test-bucket', feed=FEED, use_digest_index=False,
+            s3helper=S3Helper(client=self.client))
+        sandbox.ingest(make_v3_feed(3))
+        report = sandbox.ingest(make_v3_feed(3))
+        self.assertEqual(report.outcomes['skipped'], 3)
+        self.assertEqual(report.s3_calls, {'list_objects_v2': 1, 'get_object': 3})
+        self.assertGreater(report.bytes_read, 0)
+
+        report = sandbox.ingest(make_v3_feed(3, update_date='2021-03-01T13:00:00Z'))
+        self.assertEqual(report.outcomes['new_status'], 3)
+        report = sandbox.ingest(make_v3_feed(3, update_date='2021-03-01T14:00:00Z'))
+        self.assertEqual(report.outcomes['overwrite'], 3)
+        self.assertEqual(sandbox.n_overwrite, 3)
+        with self.assertRaises(ValueError):
+            WorkZoneSandbox(bucket='test-bucket', feed=FEED, use_digest_index=True)
+
+    def test_digest_index_cold_container(self):
+        self.sandbox.ingest(make_v3_feed(3))
+        digest_index.clear_cache()
+        report = self.sandbox.ingest(make_v3_feed(3))
+        self.assertEqual(report.outcomes['skipped'], 3)
+        self.assertEqual(report.s3_calls, {'head_object': 1, 'list_objects_v2': 1, 'get_object': 1})
+
+    def test_digest_index_updated_after_partial_failure(self):
+        class FlakySandbox(WorkZoneSandbox):
+            def process_records(self, key, out_rec, field_name_tuple, listing=None, digest=None):
+                if 'wz1_' in key:
+                    raise RuntimeError('boom')
+                return super(FlakySandbox, self).process_records(key, out_rec, field_name_tuple, listing, digest)
+
+        sandbox = FlakySandbox(bucket='test-bucket', feed=FEED, use_digest_index=True, state_bucket='state-bucket',
+            s3helper=S3Helper(client=self.client))
+        with self.assertRaises(TaskFailures):
+            sandbox.ingest(make_v3_feed(3))
+        report = self.sandbox.ingest(make_v3_feed(3))
+        self.assertEqual(report.outcomes, {'skipped': 2, 'overwrite': 0, 'new_status': 0, 'new_fp': 1})
+
+    def test_layouts_store_same_history(self):
+        histories = []
+        for layout in ['ndjson', 'segmented']:
+            sandbox = WorkZoneSandbox(bucket=layout, feed=FEED, layout=layout,
+                s3helper=S3Helper(client=self.client))
+            for hour in [12, 12, 13, 14, 15]:
+                sandbox.ingest(make_v3_feed(2, update_date='2021-03-01T{}:00:00Z'.format(hour)))
+            histories.append(sandbox.read_recs('state=TS/feedName=testfeed/year=2021/month=03/wz1_northbound_202103_v3.0'))
+        self.assertEqual(histories[0], histories[1])
+        self.assertEqual([rec['road_event_feed_info']['update_date'][11:13] for rec in histories[0]], ['12', '15'])
+
+    def test_compressed_work_zone_files(self):
+        key = 'state=TS/feedName=testfeed/year=2021/month=03/wz1_northbound_202103_v3.0'
+        plain = WorkZoneSandbox(bucket='test-bucket', feed=FEED, s3helper=S3Helper(client=self.client))
+        sandbox = WorkZoneSandbox(bucket='gzip-bucket', feed=FEED, compression='gzip',
+            s3helper=S3Helper(client=self.client))
+        for hour in [12, 12, 13, 14, 15]:
+            plain.ingest(make_v3_feed(2, update_date='2021-03-01T{}:00:00Z'.format(hour)))
+            sandbox.ingest(make_v3_feed(2, update_date='2021-03-01T{}:00:00Z'.format(hour)))
+        self.assertEqual(sandbox.read_recs(key), plain.read_recs(key))
+        self.assertIn(key + '.gz', self.client.objects['gzip-bucket'])
+        self.assertNotIn(key, self.client.objects['gzip-bucket'])
+
+    def test_ingest_propagates_worker_errors(self):
+        class FailingSandbox(WorkZoneSandbox):
+            def process_records(self, key, out_rec, field_name_tuple, listing=None, digest=None):
+                if key.split('/')[-1].startswith('wz2_'):
+                    raise RuntimeError('boom')
+                return IngestReport()
+
+        sandbox = FailingSandbox(bucket='test-bucket', feed=FEED, max_workers=2,
+            s3helper=S3Helper(client=self.client))
+        with self.assertRaises(TaskFailures) as cm:
+            sandbox.ingest(make_v3_feed(5))
+        self.assertEqual(len(cm.exception.failures), 1)
+        self.assertIn('wz2_northbound_202103_v3.0', cm.exception.failures[0][0])
+
+
+class TestConcurrentIngest(unittest.TestCase):
+    key = 'state=TS/feedName=testfeed/year=2021/month=03/wz1_northbound_202103_v3.0'
+
+    def setUp(self):
+        digest_index.clear_cache()
+        self.client = LocalS3Client()
+
+    def make_feed(self, hour, description, n=2):
+        data = make_v3_feed(n, update_date='2021-03-01T{}Z'.format(hour))
+        data['features'][1]['properties']['description'] = description
+        return data
+
+    def ingest_overlapping(self, **kwargs):
+        # another ingest of the feed writes the work zone file between this ingest's read and write
+        sandbox = WorkZoneSandbox(bucket='test-bucket', feed=FEED, s3helper=S3Helper(client=self.client), **kwargs)
+        other = WorkZoneSandbox(bucket='test-bucket', feed=FEED, s3helper=S3Helper(client=self.client), **kwargs)
+        sandbox.ingest(self.make_feed('12:00:00', 'first'))
+        read_tail = sandbox.record_store.read_tail
+
+        def read_tail_then_overlap(key, n=2):
+            tail = read_tail(key, n)
+            if key == self.key and not overlapped:
+                overlapped.append(key)
+                other.ingest(self.make_feed('13:30:00', 'other'))
+            return tail
+
+        overlapped = []
+        sandbox.record_store.read_tail = read_tail_then_overlap
+        report = sandbox.ingest(self.make_feed('13:00:00', 'this', n=3))
+        sandbox.record_store.read_tail = read_tail
+        return sandbox, report
+
+    def test_conflicting_ingests_keep_both_statuses(self):
+        for layout in ['ndjson', 'segmented']:
+            self.client.objects.clear()
+            digest_index.clear_cache()
+            sandbox, report = self.ingest_overlapping(layout=layout, conditional_writes=True, use_digest_index=True,
+                state_bucket='state-bucket')
+            # wz0 is unchanged but for the feed update time, so its digest is a hit
+            self.assertEqual(report.outcomes, {'skipped': 1, 'overwrite': 0, 'new_status': 1, 'new_fp': 1})
+            recs = sandbox.read_recs(self.key)
+            self.assertEqual([rec['features'][0]['properties']['description'] for rec in recs],
+                             ['first', 'other', 'this'])
+            # digests of the files both ingests wrote are dropped, so their next status is compared with the file
+            index = digest_index.FeedDigestIndex(sandbox.s3helper, 'state-bucket', self.key[:self.key.rindex('/')+1]).load()
+            self.assertEqual(sorted(index.digests), [self.key.replace('wz1_', 'wz0_'), self.key.replace('wz1_', 'wz2_')])
+            sandbox.ingest(self.make_feed('13:00:00', 'this', n=3))
+            self.assertEqual(sandbox.read_recs(self.key), recs)
+
+    def test_unconditional_ingests_lose_a_status(self):
+        sandbox, report = self.ingest_overlapping()
+        recs = sandbox.read_recs(self.key)
+        self.assertEqual([rec['features'][0]['properties']['description'] for rec in recs], ['first', 'this'])
+
+    def test_conflicting_new_files(self):
+        sandbox = WorkZoneSandbox(bucket='test-bucket', feed=FEED, conditional_writes=True,
+            s3helper=S3Helper(client=self.client))
+        other = WorkZoneSandbox(bucket='test-bucket', feed=FEED, conditional_writes=True,
+            s3helper=S3Helper(client=self.client))
+        list_month = sandbox.list_month
+
+        def list_month_then_overlap(prefix):
+            # the other ingest creates the work zone files after this one listed the month
+            listing = list_month(prefix)
+            other.ingest(self.make_feed('12:00:00', 'other'))
+            return listing
+
+        sandbox.list_month = list_month_then_overlap
+        report = sandbox.ingest(self.make_feed('13:00:00', 'this'))
+        self.assertEqual(report.outcomes['new_status'], 2)
+        self.assertEqual([rec['features'][0]['properties']['description'] for rec in sandbox.read_recs(self.key)],
+                         ['other', 'this'])
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i+chunk_size]
+
+    def close(self):
+        pass
+
+
+class TestRawFeedIngest(unittest.TestCase):
+    def setUp(self):
+        self.client = LocalS3Client()
+        self.s3helper = S3Helper(client=self.client)
+        self.lambda_client = mock.Mock()
+        self.feeds = [
+            dict(FEED, feedname='feed{}'.format(i), pipedtosocrata=(i == 0)) for i in range(4)
+        ]
+        self.url_dict = {('TS', feed['feedname']): 'https://example.com/' + feed['feedname'] for feed in self.feeds}
+
+    def fake_get(self, url, headers=None, timeout=None, stream=False):
+        self.timeouts[url] = timeout
+        if url.endswith('feed2'):
+            return FakeResponse(503)
+        if url.endswith('feed3'):
+            raise IOError('connection reset')
+        return FakeResponse(200, b'{"features": []}')
+
+    def test_ingest_raw_feeds(self):
+        self.timeouts = {}
+        session = mock.Mock()
+        session.get.side_effect = self.fake_get
+        results = ingest_raw_feeds(self.feeds, 'raw-bucket', max_workers=4, session=session,
+            timeouts={'feed1': 5}, url_dict=self.url_dict, s3helper=self.s3helper,
+            lambda_client=self.lambda_client, lambda_to_trigger='lake', socrata_lambda_to_trigger='socrata')
+
+        self.assertEqual([result['feedname'] for result in results], ['feed0', 'feed1', 'feed2', 'feed3'])
+        self.assertTrue(results[0]['key'].startswith('state=TS/feedName=feed0/'))
+        self.assertIsNone(results[2]['key'])
+        self.assertIsNone(results[2]['error'])
+        self.assertIn('connection reset', results[3]['error'])
+        self.assertEqual(self.timeouts['https://example.com/feed1'], 5)
+        self.assertEqual(self.timeouts['https://example.com/feed0'], (10, 60))
+
+        keys = sorted(k for k in self.client.objects['raw-bucket'] if not k.endswith('_fetch_state.json'))
+        self.assertEqual(len(keys), 3)
+        self.assertTrue(keys[2].endswith('__FEED_NOT_RETRIEVED'))
+        # lake lambda for feed0 and feed1, socrata lambda for feed0 only
+        invoked = sorted(call[1]['FunctionName'] for call in self.lambda_client.invoke.call_args_list)
+        self.assertEqual(invoked, ['lake', 'lake', 'socrata'])
+
+    def test_unchanged_feed_is_not_copied(self):
+        responses = [
+            FakeResponse(200, b'{"features": [1]}', {'ETag': '"v1"'}),
+            FakeResponse(304),
+            # same bytes without validators
+            FakeResponse(200, b'{"features": [1]}'),
+            FakeResponse(200, b'{"features": [2]}', {'ETag': '"v2"'}),
+        ]
+        session = mock.Mock()
+        session.get.side_effect = responses
+        sandbox = WorkZoneRawSandbox('raw-bucket', feed=self.feeds[1], url_dict=self.url_dict,
+            lambda_client=self.lambda_client, lambda_to_trigger='lake', s3helper=self.s3helper,
+            conditional_fetch=True, state_bucket='state-bucket')
+        keys = [sandbox.ingest(session=session) for _ in responses]
+
+        self.assertEqual(session.get.call_args_list[0][1]['headers'], {})
+        self.assertEqual(session.get.call_args_list[1][1]['headers'], {'If-None-Match': '"v1"'})
+        self.assertFalse(keys[0].endswith('__UNCHANGED'))
+        self.assertTrue(keys[1].endswith('__UNCHANGED'))
+        self.assertTrue(keys[2].endswith('__UNCHANGED'))
+        self.assertFalse(keys[3].endswith('__UNCHANGED'))
+        marker = json.loads(self.client.objects['raw-bucket'][keys[1]]['Body'])
+        self.assertEqual(marker['key'], keys[0])
+        self.assertEqual(self.lambda_client.invoke.call_count, 2)
+        # the fetch state is kept out of the public raw bucket
+        self.assertFalse([k for k in self.client.objects['raw-bucket'] if k.endswith('_fetch_state.json')])
+        state = json.loads(self.client.objects['state-bucket']['state=TS/feedName=feed1/_fetch_state.json']['Body'])
+        self.assertEqual(state['etag'], '"v2"')
+        self.assertEqual(state['key'], keys[3])
+        with self.assertRaises(ValueError):
+            WorkZoneRawSandbox('raw-bucket', feed=self.feeds[1], url_dict=self.url_dict, conditional_fetch=True)
+
+    def test_fetch_errors_after_upload_are_not_retrieval_failures(self):
+        session = mock.Mock()
+        session.get.side_effect = [FakeResponse(304), FakeResponse(200, b'{"features": [1]}', {'ETag': '"v1"'})]
+        sandbox = WorkZoneRawSandbox('raw-bucket', feed=self.feeds[1], url_dict=self.url_dict,
+            lambda_client=self.lambda_client, lambda_to_trigger='lake', s3helper=self.s3helper, conditional_fetch=False,
+            state_bucket='state-bucket')
+        # a 304 the feed was not asked for (e.g. from a cache) is not a snapshot
+        self.assertEqual(sandbox.fetch(session=session), {'key': None, 'unchanged': False, 'content': None})
+
+        sandbox.conditional_fetch = True
+        with mock.patch('wzdx_sandbox.wzdx_sandbox.FeedFetchState.save', side_effect=IOError('S3 unavailable')):
+            with self.assertRaises(IOError):
+                sandbox.fetch(session=session)
+        keys = list(self.client.objects['raw-bucket'])
+        self.assertEqual(len(keys), 1)
+        self.assertFalse(keys[0].endswith('__FEED_NOT_RETRIEVED'))
+
@@ -0,0 +1,93 @@
+"""
+Module-level registry of boto3 sessions and clients. Creating a session or a
+client takes hundreds of milliseconds, so they are created once per process
+and reused by every sandbox and across warm lambda invocations.
+
+"""
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+DEFAULT_RETRY_MODE = 'adaptive'
+DEFAULT_MAX_ATTEMPTS = 5
+
+# keyed by process id, so that a forked process never uses its parent's connections
+_sessions = {}
+_clients = {}
+_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    global _lock
+    _lock = threading.Lock()
+    _sessions.clear()
+    _clients.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    # the lock may have been held by another thread of the parent at the time of the fork
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_session(aws_profile=None):
+    """
+    Returns the boto3 session of an AWS profile, creating it on first use.
+
+    Parameters:
+        aws_profile: Optional string name of your AWS profile. If not given,
+            the default credential chain is used.
+    Returns:
+        boto3.session.Session object.
+    """
+    key = (os.getpid(), aws_profile)
+    with _lock:
+        if key not in _sessions:
+            if aws_profile:
+                _sessions[key] = boto3.session.Session(profile_name=aws_profile)
+            else:
+                _sessions[key] = boto3.session.Session()
+        return _sessions[key]
+
+
+def get_client(service, aws_profile=None, max_pool_connections=None, retry_mode=DEFAULT_RETRY_MODE,
+               max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """
+    Returns a boto3 client, creating it on first use. Clients are thread-safe
+    and shared by all threads of a process.
+
+    Parameters:
+        service: Name of the AWS service (e.g. 's3', 'lambda').
+        aws_profile: Optional string name of your AWS profile.
+        max_pool_connections: Optional size of the client's connection pool.
+            Should be at least the number of threads using the client at the
+            same time, otherwise threads wait for a free connection.
+        retry_mode: Optional botocore retry mode. 'adaptive' (default) also
+            slows down requests when the service throttles.
+        max_attempts: Optional maximum number of attempts of each request.
+    Returns:
+        boto3 client object.
+    """
+    max_pool_connections = max(max_pool_connections or 0, DEFAULT_MAX_POOL_CONNECTIONS)
+    key = (os.getpid(), aws_profile, service, max_pool_connections, retry_mode, max_attempts)
+    session = get_session(aws_profile)
+    with _lock:
+        if key not in _clients:
+            config = Config(max_pool_connections=max_pool_connections,
+                            retries={'mode': retry_mode, 'max_attempts': max_attempts})
+            # client creation is not thread-safe on a shared session, so it is done under the lock
+            _clients[key] = session.client(service, config=config)
+        return _clients[key]
+
+
+def clear():
+    """
+    Drops all sessions and clients, e.g. after credentials were rotated.
+
+    """
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
@@ -0,0 +1,404 @@
+"""
+Backfill of the ITS Work Zone Sandbox from the raw snapshots of the ITS Work
+Zone Raw Sandbox, e.g. to rebuild the lake history after the parsing rules
+changed, without invoking the lake lambda once per raw snapshot.
+
+The raw snapshots of each feed are listed for a date range and replayed in the
+order they were retrieved, since whether a status overwrites the previous one
+depends on the history before it. Feeds are independent of each other, so
+they are spread over a pool of workers, one feed per worker at a time.
+
+Within a feed, work zone files are kept in memory (see
+wzdx_sandbox.record_store.BufferedRecordStore) and written once every
+flush_every snapshots instead of once per snapshot. Progress is checkpointed
+after each flush, so an interrupted run resumes from the last flush:
+
+    python -m wzdx_sandbox.backfill feeds.json my-raw-bucket my-rebuilt-lake-bucket \\
+        --start 2021-01-01 --end 2022-01-01 --checkpoints ./checkpoints
+
+Statuses are appended to the work zone files already in the lake bucket, so a
+rebuild should write to an empty bucket, or to one whose feed-months being
+rebuilt were removed first.
+
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import sys
+import time
+
+import dateutil.parser
+
+from wzdx_sandbox import codec
+from wzdx_sandbox.digest_index import FeedDigestIndex
+from wzdx_sandbox.executor import create_executor, run_tasks, TaskFailures, DEFAULT_MAX_WORKERS
+from wzdx_sandbox.ingest_report import IngestReport
+from wzdx_sandbox.record_store import BufferedRecordStore
+from wzdx_sandbox.s3_helper import S3Helper
+from wzdx_sandbox.spatial_index import FeedSpatialIndex, month_prefixes
+from wzdx_sandbox.wzdx_sandbox import WorkZoneSandbox
+
+
+DEFAULT_FLUSH_EVERY = 500
+# number of raw snapshots of a feed read ahead of the one being replayed
+DEFAULT_PREFETCH = 4
+# raw objects that are not snapshots: unchanged markers and failed fetches
+MARKER_SUFFIXES = ('__UNCHANGED', '__FEED_NOT_RETRIEVED')
+# the sandboxes log through this logger, so that their message for every snapshot is not printed
+logger = logging.getLogger(__name__)
+
+
+def parse_raw_key(feed, key):
+    """
+    Returns the retrieval time of a raw snapshot from its S3 key
+    ('<prefix><feedname>_<retrieval time>[<extension>]'), or None if the
+    object is not a snapshot of the feed.
+
+    """
+    name = key.rpartition('/')[2]
+    head = '{}_'.format(feed['feedname'])
+    if not name.startswith(head) or name.endswith(MARKER_SUFFIXES):
+        return None
+    retrieved = name[len(head):]
+    # extension of the compression, if any, e.g. '.gz'
+    if not retrieved[-1].isdigit():
+        retrieved = retrieved.rpartition('.')[0]
+    try:
+        return dateutil.parser.parse(retrieved)
+    except (ValueError, OverflowError):
+        return None
+
+
+def list_raw_snapshots(s3helper, raw_bucket, feed, start=None, end=None):
+    """
+    Lists the raw snapshots of a feed retrieved between start (inclusive) and
+    end (exclusive).
+
+    Parameters:
+        s3helper: S3Helper object.
+        raw_bucket: Name of the AWS S3 bucket that contains the ITS Work Zone Raw Sandbox.
+        feed: Feed dictionary object.
+        start: Optional earliest retrieval time, as a datetime or ISO 8601 string.
+        end: Optional retrieval time the snapshots were retrieved before.
+    Returns:
+        Array of (retrieval time, S3 key) tuples, oldest first.
+    """
+    start = dateutil.parser.parse(start) if isinstance(start, str) else start
+    end = dateutil.parser.parse(end) if isinstance(end, str) else end
+    if start is not None and end is not None:
+        prefix_template = 'state={state}/feedName={feedname}/year={year}/month={month}/'
+        prefixes = month_prefixes(prefix_template, feed, start, end)
+    else:
+        prefixes = ['state={state}/feedName={feedname}/'.format(**feed)]
+    snapshots = []
+    for prefix in prefixes:
+        for key in s3helper.list_prefix(raw_bucket, prefix):
+            retrieved = parse_raw_key(feed, key)
+            if retrieved is None:
+                continue
+            if (start is not None and retrieved < start.replace(tzinfo=None)) or \
+                    (end is not None and retrieved >= end.replace(tzinfo=None)):
+                continue
+            snapshots.append((retrieved, key))
+    return sorted(snapshots)
+
+
+class S3CheckpointStore(object):
+    """
+    Backfill checkpoints stored at '<prefix><feedname>.json'.
+
+    """
+    def __init__(self, s3helper, bucket, prefix='_backfill/'):
+        self.s3helper = s3helper
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get(self, name):
+        try:
+            return codec.loads(self.s3helper.get_data_stream(self.bucket, self.prefix + name + '.json').read())
+        except self.s3helper.client.exceptions.NoSuchKey:
+            return None
+
+    def put(self, name, checkpoint):
+        self.s3helper.write_bytes(codec.dumps(checkpoint, sort_keys=True), self.bucket, self.prefix + name + '.json')
+
+
+class LocalCheckpointStore(object):
+    """
+    Backfill checkpoints stored as '<feedname>.json' files in a local directory.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def get(self, name):
+        try:
+            with open(os.path.join(self.path, name + '.json'), 'rb') as in_f:
+                return codec.loads(in_f.read())
+        except FileNotFoundError:
+            return None
+
+    def put(self, name, checkpoint):
+        path = os.path.join(self.path, name + '.json')
+        # written to a temporary file first, so that an interrupted run never leaves a partial checkpoint
+        with open(path + '.tmp', 'wb') as out_f:
+            out_f.write(codec.dumps(checkpoint, sort_keys=True))
+        os.replace(path + '.tmp', path)
+
+
+def create_checkpoint_store(url, s3helper=None):
+    """
+    Creates a checkpoint store from its URL: 's3://<bucket>/<prefix>' for an
+    S3CheckpointStore, and 'file://<path>' or a path for a LocalCheckpointStore.
+
+    """
+    if url.startswith('s3://'):
+        bucket, _, prefix = url[len('s3://'):].partition('/')
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        return S3CheckpointStore(s3helper or S3Helper(), bucket, prefix or '_backfill/')
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    return LocalCheckpointStore(url)
+
+
+class BackfillSandbox(WorkZoneSandbox):
+    """
+    WorkZoneSandbox that replays raw snapshots into work zone files kept in
+    memory until flushed. The digest and spatial indexes of the feed-months
+    written are brought up to date when flushing, instead of after every
+    snapshot.
+
+    """
+    def __init__(self, bucket, feed=None, **kwargs):
+        self.keep_digest_index = kwargs.pop('use_digest_index', False)
+        self.keep_spatial_index = kwargs.pop('use_spatial_index', False)
+        # the buffered work zone files are shared between the workers, so they must be threads
+        kwargs['executor_type'] = 'thread'
+        super(BackfillSandbox, self).__init__(bucket, feed=feed, use_digest_index=False, **kwargs)
+        if self.keep_digest_index and self.state_bucket is None:
+            raise ValueError('state_bucket is required for the digest index')
+        self.record_store = BufferedRecordStore(self.record_store)
+        # each feed-month is listed once per run, files written since are known to the record store
+        self.listings = {}
+        self.digest_indexes = {}
+        self.spatial_indexes = {}
+        self.field_name_tuples = {}
+
+    def list_month(self, prefix):
+        if prefix not in self.listings:
+            self.listings[prefix] = super(BackfillSandbox, self).list_month(prefix)
+        return self.listings[prefix]
+
+    def process_statuses(self, statuses, prefix, field_name_tuple, report):
+        # kept to compute the digests of the statuses flushed
+        self.field_name_tuples[prefix] = field_name_tuple
+        return super(BackfillSandbox, self).process_statuses(statuses, prefix, field_name_tuple, report)
+
+    def flush(self):
+        """
+        Method to write the work zone files changed since the last flush, and
+        the digest and spatial indexes of their feed-months.
+
+        Returns:
+            Number of work zone files written.
+        """
+        flushed = self.record_store.flush()
+        by_prefix = {}
+        for key, recs in flushed.items():
+            by_prefix.setdefault(key.rpartition('/')[0] + '/', {})[key] = recs
+        for prefix, files in sorted(by_prefix.items()):
+            if self.keep_digest_index:
+                # indexes are read once per run and kept up to date in memory, as this run writes them
+                if prefix not in self.digest_indexes:
+                    self.digest_indexes[prefix] = FeedDigestIndex(self.s3helper, self.state_bucket, prefix).load()
+                digest_index = self.digest_indexes[prefix]
+                for key, recs in files.items():
+                    digest_index.update(key, self.status_digest(recs[-1], self.field_name_tuples[prefix]))
+                digest_index.save()
+            if self.keep_spatial_index:
+                if prefix not in self.spatial_indexes:
+                    self.spatial_indexes[prefix] = FeedSpatialIndex(self.s3helper, self.bucket, prefix).load()
+                spatial_index = self.spatial_indexes[prefix]
+                for key, recs in files.items():
+                    spatial_index.replace_file(key, [self.get_index_entry(rec) for rec in recs])
+                spatial_index.save()
+        return len(flushed)
+
+
+def _read_ahead(s3helper, bucket, keys, n):
+    # raw snapshots are downloaded while earlier ones are replayed, but handed out in order
+    with ThreadPoolExecutor(max_workers=n) as executor:
+        futures = []
+        for key in keys:
+            futures.append((key, executor.submit(lambda key: s3helper.get_data_stream(bucket, key).read(), key)))
+            if len(futures) > n:
+                yield futures[0][0], futures.pop(0)[1]
+        for key, future in futures:
+            yield key, future
+
+
+def backfill_feed(feed, raw_bucket, lake_bucket, start=None, end=None, checkpoints=None, s3helper=None,
+                  flush_every=DEFAULT_FLUSH_EVERY, prefetch=DEFAULT_PREFETCH, lake_args=None, print_func=print):
+    """
+    Replays the raw snapshots of one feed into the lake, in retrieval order,
+    resuming from the feed's checkpoint if there is one.
+
+    Parameters:
+        feed: Feed dictionary object.
+        raw_bucket: Name of the AWS S3 bucket that contains the ITS Work Zone Raw Sandbox.
+        lake_bucket: Name of the AWS S3 bucket the work zone files are written to.
+        start: Optional earliest retrieval time of the snapshots replayed.
+        end: Optional retrieval time the snapshots replayed were retrieved before.
+        checkpoints: Optional checkpoint store object, or its URL (see
+            create_checkpoint_store). If not given, progress is not kept.
+        s3helper: Optional S3Helper object.
+        flush_every: Optional number of snapshots replayed between flushes.
+        prefetch: Optional number of snapshots read ahead.
+        lake_args: Optional dictionary of other arguments of WorkZoneSandbox
+            (e.g. layout, compression, use_spatial_index, dedup_headers).
+        print_func: Optional function used to log progress.
+    Returns:
+        Dictionary object {'feedname', 'n_snapshots', 'n_files_written',
+        'outcomes', 'failures', 'wall_seconds'}. failures is an array of
+        [S3 key, error] pairs of the snapshots that could not be replayed.
+    """
+    begin = time.perf_counter()
+    s3helper = s3helper or S3Helper()
+    if isinstance(checkpoints, str):
+        checkpoints = create_checkpoint_store(checkpoints, s3helper)
+    feedname = feed['feedname']
+    lake_args = dict({'logger': logger}, **(lake_args or {}))
+    sandbox = BackfillSandbox(lake_bucket, feed=feed, s3helper=s3helper, **lake_args)
+    checkpoint = (checkpoints.get(feedname) if checkpoints is not None else None) or {}
+    done = checkpoint.get('last_key')
+    flushing = checkpoint.get('flushing_key')
+
+    snapshots = list_raw_snapshots(s3helper, raw_bucket, feed, start, end)
+    # raw keys of a feed sort by retrieval time, like the snapshots
+    keys = [key for _, key in snapshots if done is None or key > done]
+    if done is not None:
+        print_func('Resuming {} after {}, {} snapshot(s) left'.format(feedname, done, len(keys)))
+
+    report = IngestReport(feedname=feedname)
+    failures = []
+    n_files_written = 0
+    n_replayed = 0
+    n_since_flush = 0
+    last_key = done
+
+    def flush(last_key):
+        if checkpoints is not None:
+            # a run interrupted while flushing replays these snapshots with skip_replayed set
+            checkpoints.put(feedname, dict(checkpoint, flushing_key=last_key))
+        n_written = sandbox.flush()
+        if checkpoints is not None:
+            checkpoint.update({'last_key': last_key, 'flushing_key': None, 'updated_at': time.time()})
+            checkpoints.put(feedname, checkpoint)
+        return n_written
+
+    for key, content in _read_ahead(s3helper, raw_bucket, keys, prefetch):
+        # statuses no newer than the last one of their file were flushed before the run was interrupted
+        sandbox.skip_replayed = flushing is not None and key <= flushing
+        try:
+            report.merge(sandbox.ingest(content.result()))
+        except TaskFailures as e:
+            # statuses that were processed are kept, like in the lake lambda
+            failures.append([key, repr(e)])
+            for result in e.results or []:
+                if result is not None:
+                    report.merge(result)
+        except Exception as e:
+            failures.append([key, repr(e)])
+        last_key = key
+        n_replayed += 1
+        n_since_flush += 1
+        if n_since_flush >= flush_every:
+            n_files_written += flush(last_key)
+            n_since_flush = 0
+            print_func('{}: {}/{} snapshot(s) replayed, up to {}'.format(feedname, n_replayed, len(keys), key))
+    if n_since_flush:
+        n_files_written += flush(last_key)
+    return {
+        'feedname': feedname,
+        'n_snapshots': len(keys),
+        'n_files_written': n_files_written,
+        'outcomes': dict(report.outcomes),
+        'failures': failures,
+        'wall_seconds': round(time.perf_counter() - begin, 3),
+    }
+
+
+def run_backfill(feeds, raw_bucket, lake_bucket, start=None, end=None, checkpoints=None, max_workers=None,
+                 executor_type='thread', s3helper=None, flush_every=DEFAULT_FLUSH_EVERY, prefetch=DEFAULT_PREFETCH,
+                 lake_args=None, print_func=print):
+    """
+    Backfills several feeds at the same time, one feed per worker, each in
+    retrieval order (see backfill_feed).
+
+    Parameters:
+        feeds: Array of feed dictionary objects.
+        executor_type: Optional. 'thread' (default) or 'process'. With
+            processes, checkpoints must be a URL and s3helper is not shared.
+        max_workers: Optional maximum number of feeds backfilled at the same time.
+        Other parameters are as for backfill_feed.
+    Returns:
+        Array of the results of backfill_feed, in the order of feeds.
+    Raises:
+        TaskFailures if any feed could not be backfilled, after all others were.
+    """
+    max_workers = max_workers or DEFAULT_MAX_WORKERS
+    if executor_type == 'thread':
+        # one worker per feed, plus each feed's read ahead
+        s3helper = s3helper or S3Helper(max_pool_connections=max_workers * (prefetch + 1))
+    else:
+        s3helper = None
+        print_func = print
+    with create_executor(executor_type, max_workers) as executor:
+        tasks = [(feed, raw_bucket, lake_bucket, start, end, checkpoints, s3helper, flush_every, prefetch,
+                  lake_args, print_func) for feed in feeds]
+        return run_tasks(executor, backfill_feed, tasks, task_ids=[feed['feedname'] for feed in feeds])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Backfills the ITS Work Zone Sandbox from raw feed snapshots.')
+    parser.add_argument('feeds', help='JSON file of an array of feed registry records')
+    parser.add_argument('raw_bucket')
+    parser.add_argument('lake_bucket')
+    parser.add_argument('--feednames', nargs='+', default=None, help='feeds of the file to backfill. Defaults to all')
+    parser.add_argument('--start', default=None, help='earliest retrieval time, e.g. 2021-01-01')
+    parser.add_argument('--end', default=None, help='retrieval time the snapshots were retrieved before')
+    parser.add_argument('--checkpoints', default=None, help="checkpoint store, 's3://<bucket>/<prefix>' or a directory")
+    parser.add_argument('--max-workers', type=int, default=None, help='feeds backfilled at the same time')
+    parser.add_argument('--executor-type', default='thread', choices=['thread', 'process'])
+    parser.add_argument('--flush-every', type=int, default=DEFAULT_FLUSH_EVERY)
+    parser.add_argument('--layout', default='ndjson')
+    parser.add_argument('--compression', default=None)
+    parser.add_argument('--state-bucket', default=None, help='bucket to keep the digest index in, if any')
+    args = parser.parse_args(argv)
+
+    with open(args.feeds) as in_f:
+        feeds = json.load(in_f)
+    if args.feednames:
+        feeds = [feed for feed in feeds if feed['feedname'] in args.feednames]
+    lake_args = {'layout': args.layout, 'compression': args.compression}
+    if args.state_bucket:
+        lake_args.update({'use_digest_index': True, 'state_bucket': args.state_bucket})
+    try:
+        results = run_backfill(feeds, args.raw_bucket, args.lake_bucket, args.start, args.end, args.checkpoints,
+                               args.max_workers, args.executor_type, flush_every=args.flush_every,
+                               lake_args=lake_args)
+    except TaskFailures as e:
+        for feedname, err in e.failures:
+            print('{} failed: {!r}'.format(feedname, err))
+        results = [result for result in e.results if result is not None]
+    for result in results:
+        print(json.dumps(result))
+    return 1 if any(result['failures'] for result in results) or len(results) < len(feeds) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""
+JSON codec for the newline JSON read/write path. Uses orjson when it is
+installed and the standard library json module otherwise.
+
+Both backends produce the same bytes: compact separators, non-ASCII
+characters written as UTF-8, and floats formatted as Python's json module
+does. orjson formats very large and very small floats differently, so any
+output that may contain such a float (or that orjson cannot serialize, such
+as integers over 64 bits or strings with lone surrogates) is serialized with
+the json module instead. orjson also writes NaN and Infinity as null, so
+output with a null is checked for non-finite floats, which are written as
+the json module writes them (NaN, Infinity, -Infinity).
+
+The lines of the work zone files are not written with dumps but with
+dumps_record, which keeps the format they have always been written in, so
+that lines appended to an existing file match the lines already in it.
+
+"""
+import json
+import math
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+# numbers orjson and json may format differently, e.g. 1e16 vs 1e+16, 0.00001 vs 1e-05.
+# The pattern starts with a literal so that the search stays fast.
+_EXPONENT = re.compile(rb'e(?<=[0-9]e)[-0-9]')
+
+
+def _json_dumps(obj, sort_keys=False):
+    try:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), sort_keys=sort_keys).encode('utf-8')
+    except UnicodeEncodeError:
+        # lone surrogates cannot be encoded as UTF-8, they are escaped as \uXXXX instead
+        return json.dumps(obj, separators=(',', ':'), sort_keys=sort_keys).encode('utf-8')
+
+
+def _has_non_finite(obj):
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_non_finite(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite(value) for value in obj)
+    return False
+
+
+def dumps(obj, sort_keys=False):
+    """
+    Serializes obj to JSON.
+
+    Parameters:
+        obj: JSON serializable object.
+        sort_keys: Optional. If True, dictionary keys are sorted.
+    Returns:
+        UTF-8 encoded bytes.
+    """
+    if orjson is not None:
+        try:
+            out = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+        except TypeError:
+            return _json_dumps(obj, sort_keys)
+        if b'0.0000' not in out and _EXPONENT.search(out) is None and \
+                (b'null' not in out or not _has_non_finite(obj)):
+            return out
+    return _json_dumps(obj, sort_keys)
+
+
+def dumps_record(obj):
+    """
+    Serializes a work zone record as a line of a newline JSON work zone file:
+    the json module's default separators, with non-ASCII characters escaped.
+
+    Parameters:
+        obj: JSON serializable object.
+    Returns:
+        UTF-8 encoded bytes.
+    """
+    return json.dumps(obj).encode('utf-8')
+
+
+def loads(data):
+    """
+    Deserializes JSON from bytes or string. Input orjson rejects (e.g. the NaN
+    literal, which the json module accepts) is parsed with the json module.
+
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            pass
+    return json.loads(data)
@@ -0,0 +1,608 @@
+"""
+Monthly compaction of the ITS Work Zone Sandbox into Parquet.
+
+The lake keeps one small newline JSON object per work zone, direction and month
+under 'state=/feedName=/year=/month=/', so a scan of a state-month opens
+thousands of objects and parses JSON. Once a month is closed, compact_lake rolls
+all its work zone files into one Parquet file per feed-month at
+'<prefix>state=/feedName=/year=/month=/part-00000.parquet':
+
+- one row per work zone status, sorted by work zone ID and update time, so the
+  row group statistics of both columns prune row groups on read;
+- the nested header and activity fields flattened into typed columns named by
+  their dotted path (e.g. 'header.update_date', 'properties.vehicle_impact'),
+  lists kept as JSON strings;
+- the geometry kept as 2D WKB, with GeoParquet metadata.
+
+A manifest at '<prefix>_manifest.json' lists the Parquet file, row count and
+update time range of each feed-month. read_compacted prunes feed-months with
+the manifest, and pushes the work zone ID and update time predicates down to
+the Parquet row groups.
+
+The lake can be in S3 (S3LakeFiles) or in a local directory (LocalLakeFiles),
+e.g. a copy made with 'aws s3 sync':
+
+    python -m wzdx_sandbox.compaction ./lake --state TS
+
+Requires the pyarrow package (pip install pyarrow).
+
+"""
+import argparse
+import datetime
+import io
+import os
+import re
+import struct
+import time
+
+from wzdx_sandbox import codec
+from wzdx_sandbox.compression import compression_for_key
+from wzdx_sandbox.record_store import HeaderDedupRecordStore, SegmentedRecordStore
+from wzdx_sandbox.spec_registry import DEFAULT_FEED_TYPE, find_spec
+
+
+COMPACTED_PREFIX = 'compacted/'
+MANIFEST_NAME = '_manifest.json'
+PART_NAME = 'part-00000.parquet'
+DEFAULT_ROW_GROUP_SIZE = 10000
+PARTITION_FIELDS = ('state', 'feedName', 'year', 'month')
+
+_MONTH_PREFIX_RE = re.compile(r'^(state=([^/]+)/feedName=([^/]+)/year=(\d{4})/month=(\d{2})/)')
+_TIME_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d+))?)?)?\s*(Z|[+-]\d{2}:?\d{2})?$')
+_WKB_TYPES = {'Point': 1, 'LineString': 2, 'Polygon': 3, 'MultiPoint': 4, 'MultiLineString': 5,
+              'MultiPolygon': 6, 'GeometryCollection': 7}
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Parquet compaction requires the pyarrow package (pip install pyarrow)')
+    return pyarrow
+
+
+def parse_time(value):
+    """
+    Parses an ISO 8601 date or time (e.g. '2021-03-01T12:00:00Z') into a UTC
+    datetime. Times without a UTC offset are taken as UTC.
+
+    Returns:
+        datetime object, or None if value is empty or not an ISO 8601 time.
+    """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            return value.replace(tzinfo=datetime.timezone.utc)
+        return value.astimezone(datetime.timezone.utc)
+    match = _TIME_RE.match(value.strip()) if isinstance(value, str) else None
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    microsecond = int((fraction or '0')[:6].ljust(6, '0'))
+    tz = datetime.timezone.utc
+    if offset and offset != 'Z':
+        offset = offset.replace(':', '')
+        delta = datetime.timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5]))
+        tz = datetime.timezone(-delta if offset[0] == '-' else delta)
+    try:
+        parsed = datetime.datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0),
+                                   int(second or 0), microsecond, tzinfo=tz)
+    except ValueError:
+        return None
+    return parsed.astimezone(datetime.timezone.utc)
+
+
+def geojson_to_wkb(geometry):
+    """
+    Encodes a GeoJSON geometry as little endian WKB. Only the first two
+    dimensions of each position are kept.
+
+    Returns:
+        bytes, or None if geometry is empty.
+    """
+    if not geometry:
+        return None
+    out = bytearray()
+    _write_wkb(out, geometry)
+    return bytes(out)
+
+
+def _write_wkb(out, geometry):
+    kind = geometry['type']
+    out += struct.pack('<BI', 1, _WKB_TYPES[kind])
+    if kind == 'GeometryCollection':
+        out += struct.pack('<I', len(geometry['geometries']))
+        for member in geometry['geometries']:
+            _write_wkb(out, member)
+        return
+    coordinates = geometry['coordinates']
+    if kind == 'Point':
+        # an empty point is written with NaN coordinates
+        out += struct.pack('<2d', *(coordinates[:2] if coordinates else (float('nan'), float('nan'))))
+    elif kind == 'LineString':
+        _write_positions(out, coordinates)
+    elif kind == 'Polygon':
+        _write_rings(out, coordinates)
+    else:
+        member_kind = kind[len('Multi'):]
+        out += struct.pack('<I', len(coordinates))
+        for member in coordinates:
+            _write_wkb(out, {'type': member_kind, 'coordinates': member})
+
+
+def _write_positions(out, positions):
+    out += struct.pack('<I', len(positions))
+    for position in positions:
+        out += struct.pack('<2d', position[0], position[1])
+
+
+def _write_rings(out, rings):
+    out += struct.pack('<I', len(rings))
+    for ring in rings:
+        _write_positions(out, ring)
+
+
+def _flatten(obj, prefix, row):
+    for name, value in obj.items():
+        if isinstance(value, dict):
+            _flatten(value, prefix + name + '.', row)
+        else:
+            row[prefix + name] = value
+
+
+def flatten_record(rec, feed_version, status_index=None):
+    """
+    Flattens a work zone status, as stored in a work zone file, into a row.
+
+    Parameters:
+        rec: Dictionary object of the status (feed header and a single activity).
+        feed_version: Spec version of the feed, e.g. '3.0'.
+        status_index: Optional position of the status in its work zone file.
+    Returns:
+        Dictionary object of the row: the key columns (work_zone_id,
+        road_direction, feed_version, update_time, update_timestamp,
+        status_index, geometry_type and geometry as WKB), the header fields
+        under 'header.' and the other activity fields, by dotted path.
+    Raises:
+        ValueError if the feed version is not registered.
+    """
+    spec = find_spec(DEFAULT_FEED_TYPE, feed_version)
+    if spec is None:
+        raise ValueError('No spec registered for {} version {}'.format(DEFAULT_FEED_TYPE, feed_version))
+    header = rec[spec.get_header_field_name(rec)]
+    activity = dict(rec[spec.activity_list_field_name][0])
+    geometry = activity.pop('geometry', None)
+    update_time = header[spec.update_time_field_name]
+    try:
+        road_direction = spec.get_road_direction(activity)
+    except (KeyError, TypeError):
+        road_direction = None
+    identifier = spec.get_identifier(activity)
+    row = {
+        'work_zone_id': str(identifier) if identifier is not None else None,
+        'road_direction': road_direction,
+        'feed_version': str(feed_version),
+        'update_time': update_time,
+        'update_timestamp': parse_time(update_time),
+        'status_index': status_index,
+        'geometry_type': geometry.get('type') if geometry else None,
+        'geometry': geojson_to_wkb(geometry),
+    }
+    _flatten(header, 'header.', row)
+    _flatten(activity, '', row)
+    return row
+
+
+def _key_column_types(pa):
+    return [('work_zone_id', pa.string()), ('road_direction', pa.string()), ('feed_version', pa.string()),
+            ('update_time', pa.string()), ('update_timestamp', pa.timestamp('ms', tz='UTC')),
+            ('status_index', pa.int32()), ('geometry_type', pa.string()), ('geometry', pa.binary())]
+
+
+def _column(pa, values):
+    # the narrowest type that holds every value; anything else is kept as JSON text
+    kinds = {type(value) for value in values if value is not None}
+    if kinds == {bool}:
+        return pa.array(values, pa.bool_())
+    if kinds == {int} and all(value is None or -2**63 <= value < 2**63 for value in values):
+        return pa.array(values, pa.int64())
+    if kinds and kinds <= {int, float}:
+        return pa.array([float(value) if value is not None else None for value in values], pa.float64())
+    if kinds <= {str}:
+        return pa.array(values, pa.string())
+    return pa.array([value if value is None or isinstance(value, str) else codec.dumps(value).decode('utf-8')
+                     for value in values], pa.string())
+
+
+def build_table(rows):
+    """
+    Builds a pyarrow Table of flattened rows (see flatten_record), sorted by
+    work zone ID and update time.
+
+    """
+    pa = _pyarrow()
+    rows = sorted(rows, key=lambda row: (row['work_zone_id'] or '', row['update_timestamp'] or
+                                         datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)))
+    key_types = _key_column_types(pa)
+    key_names = {name for name, _ in key_types}
+    other_names = sorted({name for row in rows for name in row} - key_names)
+    arrays = [pa.array([row.get(name) for row in rows], column_type) for name, column_type in key_types]
+    arrays += [_column(pa, [row.get(name) for row in rows]) for name in other_names]
+    names = [name for name, _ in key_types] + other_names
+    geometry_types = sorted({row['geometry_type'] for row in rows if row['geometry_type']})
+    geo = {'version': '1.0.0', 'primary_column': 'geometry',
+           'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': geometry_types}}}
+    return pa.Table.from_arrays(arrays, names=names).replace_schema_metadata({'geo': codec.dumps(geo)})
+
+
+class LocalLakeFiles(object):
+    """
+    Lake files in a local directory, keyed by their path relative to it.
+
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def list(self, prefix=''):
+        """
+        Returns a dictionary of the files under prefix, keyed by key, with the
+        'Size' of each file.
+
+        """
+        listing = {}
+        top = self.path(prefix.rstrip('/')) if prefix.rstrip('/') else self.root
+        if not os.path.isdir(top):
+            return listing
+        for dirpath, _, filenames in os.walk(top):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                if key.startswith(prefix) and not filename.endswith('.tmp'):
+                    listing[key] = {'Size': os.path.getsize(path)}
+        return listing
+
+    def read(self, key):
+        """
+        Returns the content of a file, decompressed if its extension is that
+        of a compression (see wzdx_sandbox.compression).
+
+        """
+        try:
+            with open(self.path(key), 'rb') as in_f:
+                data = in_f.read()
+        except FileNotFoundError:
+            return None
+        compression = compression_for_key(key)
+        if compression is not None:
+            return compression.open(io.BytesIO(data)).read()
+        return data
+
+    def write(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written to a temporary file first, so that a reader never sees a partial file
+        with open(path + '.tmp', 'wb') as out_f:
+            out_f.write(data)
+        os.replace(path + '.tmp', path)
+
+    def parquet_source(self, key):
+        # read by path, so that only the footer and the row groups read are loaded
+        return self.path(key)
+
+
+class S3LakeFiles(object):
+    """
+    Lake files in an AWS S3 bucket, keyed by their key relative to root.
+
+    """
+    def __init__(self, s3helper, bucket, root=''):
+        """
+        Parameters:
+            s3helper: S3Helper object.
+            bucket: Name of the AWS S3 bucket.
+            root: Optional prefix of the lake in the bucket.
+        """
+        self.s3helper = s3helper
+        self.bucket = bucket
+        self.root = root
+
+    def list(self, prefix=''):
+        listing = self.s3helper.list_prefix(self.bucket, self.root + prefix)
+        return {key[len(self.root):]: obj for key, obj in listing.items()}
+
+    def read(self, key):
+        try:
+            return self.s3helper.get_data_stream(self.bucket, self.root + key).read()
+        except self.s3helper.client.exceptions.NoSuchKey:
+            return None
+
+    def write(self, key, data):
+        self.s3helper.write_bytes(data, self.bucket, self.root + key)
+
+    def parquet_source(self, key):
+        return io.BytesIO(self.read(key))
+
+
+def create_lake_files(url, s3helper=None):
+    """
+    Creates the lake files of a URL: 's3://<bucket>/<root>' for S3LakeFiles,
+    and 'file://<path>' or a path for LocalLakeFiles.
+
+    """
+    if url.startswith('s3://'):
+        bucket, _, root = url[len('s3://'):].partition('/')
+        if root and not root.endswith('/'):
+            root += '/'
+        if s3helper is None:
+            from wzdx_sandbox.s3_helper import S3Helper
+            s3helper = S3Helper()
+        return S3LakeFiles(s3helper, bucket, root)
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    return LocalLakeFiles(url)
+
+
+def list_month_partitions(files, state=None, feedname=None):
+    """
+    Lists the lake files of each feed-month.
+
+    Returns:
+        Dictionary of {key: {'Size'}} listings, keyed by feed-month prefix
+        (e.g. 'state=TS/feedName=feed/year=2021/month=03/').
+    """
+    prefix = ''
+    if state:
+        prefix = 'state={}/'.format(state)
+        if feedname:
+            prefix += 'feedName={}/'.format(feedname)
+    partitions = {}
+    for key, obj in files.list(prefix).items():
+        match = _MONTH_PREFIX_RE.match(key)
+        if match and (not feedname or match.group(3) == feedname):
+            partitions.setdefault(match.group(1), {})[key] = obj
+    return partitions
+
+
+def read_partition_recs(files, month_prefix, listing):
+    """
+    Reads the statuses of every work zone file of a feed-month, in either
+    storage layout (see wzdx_sandbox.record_store). Feed headers stored once
+    per feed-month (see HeaderDedupRecordStore) are put back in each status.
+
+    Parameters:
+        files: LocalLakeFiles or S3LakeFiles object.
+        month_prefix: Feed-month prefix.
+        listing: Dictionary of the files of the feed-month, keyed by key.
+    Returns:
+        Generator of (feed version, status index, record) tuples.
+    """
+    manifest_suffix = SegmentedRecordStore.manifest_suffix
+    ref_field_name = HeaderDedupRecordStore.ref_field_name
+    headers = {}
+
+    def rehydrate(rec):
+        for name, value in rec.items():
+            if isinstance(value, dict) and len(value) == 1 and ref_field_name in value:
+                header_hash = value[ref_field_name]
+                if header_hash not in headers:
+                    headers[header_hash] = codec.loads(files.read('{}{}{}.json'.format(
+                        month_prefix, HeaderDedupRecordStore.headers_folder, header_hash)))
+                rec[name] = headers[header_hash]
+        return rec
+
+    for key in sorted(listing):
+        name = key[len(month_prefix):]
+        # digest index, parts of segmented files, and anything in a sub folder
+        if '/' in name or name.startswith('_'):
+            continue
+        if name.endswith(manifest_suffix):
+            name = name[:-len(manifest_suffix)]
+            manifest = codec.loads(files.read(key))
+            parts_prefix = '{}_parts/{}/'.format(month_prefix, name)
+            # records of the manifest's tail are read from it, as they are authoritative over their parts
+            n_parts = manifest['n_recs'] - len(manifest['tail'])
+            part_keys = sorted(part_key for part_key in listing if part_key.startswith(parts_prefix))[:n_parts]
+            lines = [line for part_key in part_keys for line in files.read(part_key).split(b'\n')]
+            lines += [codec.dumps_record(rec) for rec in manifest['tail']]
+        else:
+            compression = compression_for_key(key)
+            if compression is not None:
+                name = name[:-len(compression.extension)]
+            lines = files.read(key).split(b'\n')
+        feed_version = name.rpartition('_v')[2]
+        recs = [rehydrate(codec.loads(line)) for line in lines if line.strip()]
+        for i, rec in enumerate(recs):
+            yield feed_version, i, rec
+
+
+def load_manifest(files, prefix=COMPACTED_PREFIX):
+    data = files.read(prefix + MANIFEST_NAME)
+    return codec.loads(data) if data is not None else {'partitions': {}}
+
+
+def _save_manifest(files, manifest, prefix):
+    files.write(prefix + MANIFEST_NAME, codec.dumps(manifest, sort_keys=True))
+
+
+def compact_partition(files, month_prefix, listing, out_files=None, prefix=COMPACTED_PREFIX,
+                      row_group_size=DEFAULT_ROW_GROUP_SIZE):
+    """
+    Compacts the work zone files of one feed-month into a Parquet file.
+
+    Returns:
+        Manifest entry of the feed-month, or None if it has no statuses.
+    """
+    pa = _pyarrow()
+    out_files = out_files or files
+    rows = [flatten_record(rec, feed_version, i) for feed_version, i, rec in read_partition_recs(files, month_prefix, listing)]
+    if not rows:
+        return None
+    table = build_table(rows)
+    sink = pa.BufferOutputStream()
+    pa.parquet.write_table(table, sink, row_group_size=row_group_size, compression='zstd')
+    key = prefix + month_prefix + PART_NAME
+    out_files.write(key, sink.getvalue().to_pybytes())
+    timestamps = [row['update_timestamp'] for row in rows if row['update_timestamp'] is not None]
+    state, feedname, year, month = _MONTH_PREFIX_RE.match(month_prefix).groups()[1:]
+    return {
+        'state': state, 'feedName': feedname, 'year': year, 'month': month,
+        'files': [key],
+        'n_rows': table.num_rows,
+        'n_work_zones': len({row['work_zone_id'] for row in rows}),
+        'min_update_time': min(timestamps).isoformat() if timestamps else None,
+        'max_update_time': max(timestamps).isoformat() if timestamps else None,
+        'source': _source_signature(listing),
+        'compacted_at': time.time(),
+    }
+
+
+def _source_signature(listing):
+    return {'n_objects': len(listing), 'n_bytes': sum(obj['Size'] for obj in listing.values())}
+
+
+def compact_lake(files, out_files=None, prefix=COMPACTED_PREFIX, state=None, feedname=None, include_open=False,
+                 force=False, row_group_size=DEFAULT_ROW_GROUP_SIZE, now=None, print_func=print):
+    """
+    Compacts every closed feed-month of the lake into Parquet, and records it
+    in the manifest. Feed-months whose files did not change since they were
+    compacted are skipped.
+
+    Parameters:
+        files: LocalLakeFiles or S3LakeFiles object of the lake.
+        out_files: Optional LocalLakeFiles or S3LakeFiles object the Parquet
+            files and manifest are written to. Defaults to files.
+        prefix: Optional prefix of the Parquet files and manifest.
+        state: Optional state to compact. Defaults to all states.
+        feedname: Optional feed to compact, with state. Defaults to all feeds.
+        include_open: Optional. If True, the current month is compacted too.
+        force: Optional. If True, unchanged feed-months are compacted again.
+        row_group_size: Optional number of rows of each Parquet row group.
+        now: Optional datetime deciding which months are closed. Defaults to now.
+        print_func: Optional function used to log progress.
+    Returns:
+        Dictionary of the outcome of each feed-month, keyed by feed-month
+        prefix: 'compacted', 'unchanged', 'open' or 'empty'.
+    """
+    out_files = out_files or files
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    current_month = now.strftime('%Y%m')
+    manifest = load_manifest(out_files, prefix)
+    outcomes = {}
+    for month_prefix, listing in sorted(list_month_partitions(files, state, feedname).items()):
+        year, month = _MONTH_PREFIX_RE.match(month_prefix).groups()[3:]
+        entry = manifest['partitions'].get(month_prefix)
+        if year + month >= current_month and not include_open:
+            outcomes[month_prefix] = 'open'
+        elif entry is not None and entry['source'] == _source_signature(listing) and not force:
+            outcomes[month_prefix] = 'unchanged'
+        else:
+            entry = compact_partition(files, month_prefix, listing, out_files, prefix, row_group_size)
+            if entry is None:
+                outcomes[month_prefix] = 'empty'
+                continue
+            manifest['partitions'][month_prefix] = entry
+            # saved after each feed-month, so an interrupted run keeps what it compacted
+            _save_manifest(out_files, manifest, prefix)
+            outcomes[month_prefix] = 'compacted'
+            print_func('Compacted {} statuses of {} to {}'.format(entry['n_rows'], month_prefix, entry['files'][0]))
+    return outcomes
+
+
+def _matches(entry, states, feednames, start, end):
+    if states is not None and entry['state'] not in states:
+        return False
+    if feednames is not None and entry['feedName'] not in feednames:
+        return False
+    if entry['min_update_time'] is None:
+        return start is None and end is None
+    if start is not None and parse_time(entry['max_update_time']) < start:
+        return False
+    if end is not None and parse_time(entry['min_update_time']) >= end:
+        return False
+    return True
+
+
+def read_compacted(files, states=None, feednames=None, start=None, end=None, work_zone_ids=None, columns=None,
+                   prefix=COMPACTED_PREFIX):
+    """
+    Reads work zone statuses from the compacted lake. Feed-months are pruned
+    with the manifest, and the update time and work zone ID predicates are
+    pushed down to the row groups of each Parquet file.
+
+    Parameters:
+        files: LocalLakeFiles or S3LakeFiles object the compacted lake is in.
+        states: Optional list of states.
+        feednames: Optional list of feed names.
+        start: Optional earliest update time, as a datetime or ISO 8601 string.
+        end: Optional update time (exclusive) statuses were updated before.
+        work_zone_ids: Optional list of work zone IDs.
+        columns: Optional list of columns to read. Defaults to all columns.
+    Returns:
+        pyarrow Table of the statuses, with the state, feedName, year and
+        month partition columns.
+    """
+    pa = _pyarrow()
+    start = parse_time(start) if start is not None else None
+    end = parse_time(end) if end is not None else None
+    states = set(states) if states is not None else None
+    feednames = set(feednames) if feednames is not None else None
+    filters = []
+    if work_zone_ids is not None:
+        filters.append(('work_zone_id', 'in', [str(identifier) for identifier in work_zone_ids]))
+    if start is not None:
+        filters.append(('update_timestamp', '>=', start))
+    if end is not None:
+        filters.append(('update_timestamp', '<', end))
+
+    tables = []
+    for _, entry in sorted(load_manifest(files, prefix)['partitions'].items()):
+        if not _matches(entry, states, feednames, start, end):
+            continue
+        for key in entry['files']:
+            table = pa.parquet.read_table(files.parquet_source(key), columns=columns, filters=filters or None)
+            for field in PARTITION_FIELDS:
+                table = table.append_column(field, pa.array([entry[field]] * table.num_rows, pa.string()))
+            tables.append(table)
+    return _concat_tables(pa, tables)
+
+
+def _concat_tables(pa, tables):
+    # feed-months may have different columns, missing ones are filled with nulls
+    if not tables:
+        return pa.table({})
+    schema = pa.unify_schemas([table.schema for table in tables])
+    aligned = []
+    for table in tables:
+        arrays = [table.column(field.name) if field.name in table.column_names
+                  else pa.nulls(table.num_rows, field.type) for field in schema]
+        aligned.append(pa.Table.from_arrays(arrays, schema=schema))
+    return pa.concat_tables(aligned)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compacts closed months of the ITS Work Zone Sandbox into Parquet.')
+    parser.add_argument('lake', help="lake URL, 's3://<bucket>/<root>' or a local directory")
+    parser.add_argument('--out', default=None, help='URL the Parquet files are written to. Defaults to the lake')
+    parser.add_argument('--prefix', default=COMPACTED_PREFIX)
+    parser.add_argument('--state', default=None)
+    parser.add_argument('--feedname', default=None)
+    parser.add_argument('--include-open-months', action='store_true')
+    parser.add_argument('--force', action='store_true', help='compact unchanged months again')
+    parser.add_argument('--row-group-size', type=int, default=DEFAULT_ROW_GROUP_SIZE)
+    args = parser.parse_args(argv)
+
+    files = create_lake_files(args.lake)
+    out_files = create_lake_files(args.out) if args.out else files
+    outcomes = compact_lake(files, out_files, args.prefix, args.state, args.feedname,
+                            include_open=args.include_open_months, force=args.force,
+                            row_group_size=args.row_group_size)
+    for month_prefix, outcome in sorted(outcomes.items()):
+        print('{} {}'.format(outcome, month_prefix))
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+Compression of sandbox objects. Compressed objects get the extension of their
+compression format (e.g. '.gz') and the matching Content-Encoding, and are decompressed
+as they are read.
+
+zstd needs the optional zstandard package.
+
+"""
+import gzip
+import io
+import zlib
+
+
+class Compression(object):
+    """
+    Compression format.
+
+    """
+    def __init__(self, name, extension, content_encoding, default_level):
+        self.name = name
+        self.extension = extension
+        self.content_encoding = content_encoding
+        self.default_level = default_level
+
+    def compress(self, data, level=None):
+        raise NotImplementedError
+
+    def compressobj(self, level=None):
+        """
+        Returns an incremental compressor, with compress(data) and flush() methods.
+
+        """
+        raise NotImplementedError
+
+    def open(self, fileobj):
+        """
+        Returns a readable binary file object of the decompressed content of fileobj.
+
+        """
+        raise NotImplementedError
+
+
+class GzipCompression(Compression):
+    def __init__(self):
+        super(GzipCompression, self).__init__('gzip', '.gz', 'gzip', 6)
+
+    def compress(self, data, level=None):
+        out = io.BytesIO()
+        # mtime=0 so that the same content always compresses to the same bytes
+        with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=self.default_level if level is None else level,
+                           mtime=0) as f:
+            f.write(data)
+        return out.getvalue()
+
+    def compressobj(self, level=None):
+        # wbits=31 writes a gzip header and trailer
+        return zlib.compressobj(self.default_level if level is None else level, zlib.DEFLATED, 31)
+
+    def open(self, fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+
+class ZstdCompression(Compression):
+    def __init__(self):
+        super(ZstdCompression, self).__init__('zstd', '.zst', 'zstd', 3)
+
+    def _zstandard(self):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstd compression requires the zstandard package (pip install zstandard)')
+        return zstandard
+
+    def compress(self, data, level=None):
+        zstandard = self._zstandard()
+        return zstandard.ZstdCompressor(level=self.default_level if level is None else level).compress(data)
+
+    def compressobj(self, level=None):
+        zstandard = self._zstandard()
+        return zstandard.ZstdCompressor(level=self.default_level if level is None else level).compressobj()
+
+    def open(self, fileobj):
+        zstandard = self._zstandard()
+        # buffered, for readline and line iteration
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True))
+
+
+COMPRESSIONS = {compression.name: compression for compression in [GzipCompression(), ZstdCompression()]}
+
+
+def get_compression(compression):
+    """
+    Returns the Compression object of a compression name ('gzip' or 'zstd'), or None
+    if compression is None or empty.
+
+    """
+    if not compression:
+        return None
+    if compression not in COMPRESSIONS:
+        raise ValueError('compression must be one of {}, got {}'.format(sorted(COMPRESSIONS), compression))
+    return COMPRESSIONS[compression]
+
+
+def compression_for_key(key, content_encoding=None):
+    """
+    Returns the Compression object of an S3 object from its Content-Encoding or, if
+    it has none, from the extension of its key. Returns None for uncompressed
+    objects.
+
+    """
+    for compression in COMPRESSIONS.values():
+        if content_encoding == compression.content_encoding:
+            return compression
+    for compression in COMPRESSIONS.values():
+        if key.endswith(compression.extension):
+            return compression
+    return None
+
+
+class DecompressedStream(object):
+    """
+    Readable binary stream of the decompressed body of an S3 object, with the
+    reading methods of botocore's StreamingBody.
+
+    """
+    def __init__(self, body, compression):
+        self._body = body
+        self._fileobj = compression.open(body)
+
+    def read(self, amt=None):
+        return self._fileobj.read(-1 if amt is None else amt)
+
+    def readline(self):
+        return self._fileobj.readline()
+
+    def __iter__(self):
+        return iter(self._fileobj)
+
+    def iter_lines(self, chunk_size=None, keepends=False):
+        for line in self._fileobj:
+            yield line if keepends else line.rstrip(b'\r\n')
+
+    def close(self):
+        self._fileobj.close()
+        self._body.close()
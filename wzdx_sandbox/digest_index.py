@@ -0,0 +1,150 @@
+"""
+Per feed-month index of the digest of the last status written to each work
+zone file, used to skip unchanged work zone statuses without any per-key S3
+I/O. The index is internal state, kept in a state bucket rather than next to
+the work zone files.
+
+"""
+from collections import OrderedDict
+import threading
+
+from wzdx_sandbox import codec
+from wzdx_sandbox.s3_helper import retry_on_conflict
+
+
+CACHE_SIZE = 64
+
+# index contents of recently used feed-months, kept across warm lambda invocations
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _cache_get(cache_key, etag):
+    with _cache_lock:
+        entry = _cache.get(cache_key)
+        if entry is None or entry[0] != etag:
+            return None
+        _cache.move_to_end(cache_key)
+        return dict(entry[1])
+
+
+def _cache_put(cache_key, etag, digests):
+    with _cache_lock:
+        _cache[cache_key] = (etag, dict(digests))
+        _cache.move_to_end(cache_key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+
+class FeedDigestIndex(object):
+    """
+    Index of status digests (see WorkZoneSandbox.status_digest) for all work
+    zone files under one feed-month prefix, stored as a single JSON object at
+    '<prefix>_digests.json' in the state bucket.
+
+    """
+    index_name = '_digests.json'
+
+    def __init__(self, s3helper, bucket, prefix, conditional=False):
+        """
+        Initialization function of the FeedDigestIndex class.
+
+        Parameters:
+            s3helper: S3Helper object.
+            bucket: Name of the AWS S3 bucket the index is kept in, which
+                should not be the public bucket of the work zone files.
+            prefix: Feed-month prefix of the work zone files
+                (state={state}/feedName={feedname}/year={year}/month={month}/).
+            conditional: Optional. If True, the index is saved with a
+                conditional write, and merged with the index saved by another
+                ingest if it changed since it was loaded.
+        """
+        self.s3helper = s3helper
+        self.bucket = bucket
+        self.key = prefix + self.index_name
+        self.conditional = conditional
+        self.digests = {}
+        # digests of the index as loaded, and the ones updated since, to merge on a conflict
+        self.etag = None
+        self.loaded = {}
+        self.updated = {}
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Loads the index. The in-memory copy is used if its ETag still matches
+        the one in S3, so a warm container only makes a HEAD request.
+
+        Returns:
+            The FeedDigestIndex object.
+        """
+        cache_key = (self.bucket, self.key)
+        self.digests, self.etag = {}, None
+        etag = self.s3helper.get_etag(self.bucket, self.key)
+        if etag is not None:
+            digests = _cache_get(cache_key, etag)
+            if digests is not None:
+                self.digests, self.etag = digests, etag
+            else:
+                data, self.etag = self.s3helper.get_bytes(self.bucket, self.key)
+                self.digests = codec.loads(data)
+                _cache_put(cache_key, self.etag, self.digests)
+        self.loaded = dict(self.digests)
+        return self
+
+    def matches(self, key, digest):
+        return self.digests.get(key) == digest
+
+    def update(self, key, digest):
+        with self._lock:
+            if self.digests.get(key) != digest:
+                self.digests[key] = digest
+                self.updated[key] = digest
+                self.dirty = True
+
+    def save(self):
+        """
+        Writes the index back to S3 if it changed since it was loaded.
+
+        """
+        if not self.dirty:
+            return
+        if self.conditional:
+            response = retry_on_conflict(self._save_conditionally)
+        else:
+            response = self.s3helper.write_bytes(codec.dumps(self.digests, sort_keys=True), self.bucket, self.key)
+        etag = (response or {}).get('ETag')
+        if etag:
+            _cache_put((self.bucket, self.key), etag, self.digests)
+            self.etag = etag
+        self.loaded, self.updated = dict(self.digests), {}
+        self.dirty = False
+
+    def _save_conditionally(self, attempt):
+        if attempt:
+            self._merge_saved()
+        return self.s3helper.write_bytes(codec.dumps(self.digests, sort_keys=True), self.bucket, self.key,
+            if_match=self.etag, if_none_match=self.etag is None)
+
+    def _merge_saved(self):
+        # another ingest saved the index since it was loaded: keep its digests, and this one's for the files
+        # only this one wrote. Files both wrote are dropped from the index, as which one wrote last is not
+        # known, so their next status is compared with the file itself.
+        if self.s3helper.path_exists(self.bucket, self.key):
+            data, etag = self.s3helper.get_bytes(self.bucket, self.key)
+            saved = codec.loads(data)
+        else:
+            saved, etag = {}, None
+        digests = dict(saved)
+        for key, digest in self.updated.items():
+            if saved.get(key) == self.loaded.get(key):
+                digests[key] = digest
+            else:
+                digests.pop(key, None)
+        self.digests, self.etag = digests, etag
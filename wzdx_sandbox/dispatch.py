@@ -0,0 +1,292 @@
+"""
+Queue-based dispatch of raw feed snapshots to the downstream lake and Socrata
+lambdas. Snapshots are coalesced into batch messages, so that one downstream
+invocation processes many snapshots, and each feed registry record is sent
+once per batch instead of once per snapshot.
+
+Queues are pluggable: MemoryQueue and SQLiteQueue for local runs and tests,
+SQSQueue for deployment. create_queue picks one from a URL.
+
+"""
+import sqlite3
+import threading
+import time
+
+from wzdx_sandbox import codec
+from wzdx_sandbox.aws_clients import get_client
+from wzdx_sandbox.executor import TaskFailures
+
+
+MAX_BATCH_SIZE = 50
+# SQS limit of messages per send_message_batch, receive_message and delete_message_batch call
+SQS_MAX_MESSAGES = 10
+
+
+def make_batch(items):
+    """
+    Builds a batch message.
+
+    Parameters:
+        items: Array of (feed, bucket, key) tuples, where feed is the feed
+            registry record of the snapshot at key.
+    Returns:
+        Dictionary object {'feeds': {feedname: feed}, 'items': [{'feedname',
+        'bucket', 'key'}]}.
+    """
+    feeds = {}
+    out_items = []
+    for feed, bucket, key in items:
+        feeds[feed['feedname']] = feed
+        out_items.append({'feedname': feed['feedname'], 'bucket': bucket, 'key': key})
+    return {'feeds': feeds, 'items': out_items}
+
+
+def iter_work_items(event, with_message_ids=False):
+    """
+    Reads the snapshots to process from a downstream lambda event: a single
+    snapshot event ({'feed', 'bucket', 'key'}), a batch message (see
+    make_batch), or an SQS event whose records are batch messages.
+
+    Parameters:
+        event: Event the downstream lambda was invoked with.
+        with_message_ids: Optional. If True, the id of the SQS message each
+            snapshot came in is yielded first, or None if the event is not
+            from SQS (see batch_response).
+    Returns:
+        Iterable of (feed, bucket, key) tuples, or of (message id, feed,
+        bucket, key) tuples if with_message_ids is True.
+    """
+    if 'Records' in event:
+        for record in event['Records']:
+            for item in iter_work_items(codec.loads(record['body'])):
+                yield ((record['messageId'],) + item) if with_message_ids else item
+    elif 'items' in event:
+        for item in event['items']:
+            item = event['feeds'][item['feedname']], item['bucket'], item['key']
+            yield ((None,) + item) if with_message_ids else item
+    else:
+        item = event['feed'], event['bucket'], event['key']
+        yield ((None,) + item) if with_message_ids else item
+
+
+def batch_response(event, failures):
+    """
+    Returns the response of a downstream lambda to an event, given the
+    snapshots that failed. For an SQS event, only the messages holding a
+    failed snapshot are reported as failed (partial batch response, which
+    needs ReportBatchItemFailures turned on for the SQS trigger), so that
+    SQS delivers those again and deletes the others. Any other event is
+    failed as a whole.
+
+    Parameters:
+        event: Event the downstream lambda was invoked with.
+        failures: Array of (message id, key, exception) tuples of the failed
+            snapshots, with message ids as yielded by iter_work_items.
+    Returns:
+        Dictionary object {'batchItemFailures': [{'itemIdentifier'}]} for an
+        SQS event, otherwise None.
+    Raises:
+        TaskFailures if a snapshot of an event that is not from SQS failed.
+    """
+    if 'Records' in event:
+        message_ids = []
+        for message_id, _, _ in failures:
+            if message_id not in message_ids:
+                message_ids.append(message_id)
+        return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in message_ids]}
+    if failures:
+        raise TaskFailures([(key, e) for _, key, e in failures])
+    return None
+
+
+class MemoryQueue(object):
+    """
+    In-process queue.
+
+    """
+    def __init__(self):
+        self.messages = []
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def send_batch(self, messages):
+        with self._lock:
+            for message in messages:
+                self.messages.append((str(self._next_id), codec.dumps(message)))
+                self._next_id += 1
+
+    def receive(self, max_messages=SQS_MAX_MESSAGES):
+        """
+        Returns up to max_messages (handle, message) tuples, oldest first.
+        Messages stay in the queue until they are deleted.
+
+        """
+        with self._lock:
+            return [(handle, codec.loads(body)) for handle, body in self.messages[:max_messages]]
+
+    def delete(self, handles):
+        handles = set(handles)
+        with self._lock:
+            self.messages = [(handle, body) for handle, body in self.messages if handle not in handles]
+
+
+class SQLiteQueue(object):
+    """
+    Queue kept in a SQLite database, so that it survives the process. Received
+    messages are hidden for visibility_timeout seconds, and become visible
+    again if they are not deleted by then, as with SQS.
+
+    """
+    def __init__(self, path=':memory:', visibility_timeout=300):
+        """
+        Parameters:
+            path: Optional path of the SQLite database file.
+            visibility_timeout: Optional number of seconds a received message
+                is hidden from other receivers.
+        """
+        self.visibility_timeout = visibility_timeout
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS messages '
+                               '(id INTEGER PRIMARY KEY AUTOINCREMENT, body BLOB, visible_at REAL)')
+
+    def send_batch(self, messages):
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT INTO messages (body, visible_at) VALUES (?, 0)',
+                                   [(codec.dumps(message),) for message in messages])
+
+    def receive(self, max_messages=SQS_MAX_MESSAGES):
+        now = time.time()
+        with self._lock, self._conn:
+            rows = self._conn.execute('SELECT id, body FROM messages WHERE visible_at <= ? ORDER BY id LIMIT ?',
+                                      (now, max_messages)).fetchall()
+            self._conn.executemany('UPDATE messages SET visible_at = ? WHERE id = ?',
+                                   [(now + self.visibility_timeout, row[0]) for row in rows])
+        return [(str(row[0]), codec.loads(row[1])) for row in rows]
+
+    def delete(self, handles):
+        with self._lock, self._conn:
+            self._conn.executemany('DELETE FROM messages WHERE id = ?', [(int(handle),) for handle in handles])
+
+
+class SQSQueue(object):
+    """
+    Amazon SQS queue. The downstream lambdas can be triggered by the queue
+    directly, with an SQS event source mapping.
+
+    """
+    def __init__(self, queue_url, client=None, aws_profile=None):
+        """
+        Parameters:
+            queue_url: URL of the SQS queue.
+            client: Optional boto3 SQS client to use instead of the shared one.
+            aws_profile: Optional string name of your AWS profile.
+        """
+        self.queue_url = queue_url
+        self.client = client or get_client('sqs', aws_profile)
+
+    def send_batch(self, messages):
+        for i in range(0, len(messages), SQS_MAX_MESSAGES):
+            entries = [{'Id': str(j), 'MessageBody': codec.dumps(message).decode('utf-8')}
+                       for j, message in enumerate(messages[i:i+SQS_MAX_MESSAGES])]
+            response = self.client.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            if response.get('Failed'):
+                raise RuntimeError('Failed to send {} messages to {}: {}'.format(
+                    len(response['Failed']), self.queue_url, response['Failed']))
+
+    def receive(self, max_messages=SQS_MAX_MESSAGES):
+        response = self.client.receive_message(QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_messages, SQS_MAX_MESSAGES), WaitTimeSeconds=0)
+        return [(message['ReceiptHandle'], codec.loads(message['Body'])) for message in response.get('Messages', [])]
+
+    def delete(self, handles):
+        handles = list(handles)
+        for i in range(0, len(handles), SQS_MAX_MESSAGES):
+            entries = [{'Id': str(j), 'ReceiptHandle': handle}
+                       for j, handle in enumerate(handles[i:i+SQS_MAX_MESSAGES])]
+            self.client.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+
+
+def create_queue(url, aws_profile=None):
+    """
+    Creates a queue from its URL: 'memory://' for a MemoryQueue,
+    'sqlite:///<path>' for a SQLiteQueue, and an SQS queue URL for an SQSQueue.
+
+    """
+    if url.startswith('memory://'):
+        return MemoryQueue()
+    if url.startswith('sqlite://'):
+        return SQLiteQueue(url[len('sqlite:///'):] or ':memory:')
+    if url.startswith('https://sqs.') or url.startswith('https://queue.amazonaws.com'):
+        return SQSQueue(url, aws_profile=aws_profile)
+    raise ValueError('Unsupported queue URL: {}'.format(url))
+
+
+class Dispatcher(object):
+    """
+    Collects snapshots for the downstream targets (e.g. 'lake' and 'socrata')
+    and sends them to each target's queue as batch messages.
+
+    """
+    def __init__(self, queues, batch_size=MAX_BATCH_SIZE):
+        """
+        Parameters:
+            queues: Dictionary of queue objects keyed by target name.
+            batch_size: Optional maximum number of snapshots per batch message.
+        """
+        self.queues = queues
+        self.batch_size = batch_size
+        self.pending = {target: [] for target in queues}
+        self._lock = threading.Lock()
+
+    def has_target(self, target):
+        return target in self.queues
+
+    def add(self, target, feed, bucket, key):
+        """
+        Adds a snapshot for a target. It is sent on the next flush.
+
+        """
+        with self._lock:
+            self.pending[target].append((feed, bucket, key))
+
+    def flush(self):
+        """
+        Sends all pending snapshots.
+
+        Returns:
+            Dictionary of the number of messages sent, keyed by target name.
+        """
+        with self._lock:
+            pending, self.pending = self.pending, {target: [] for target in self.queues}
+        n_messages = {}
+        for target, items in pending.items():
+            messages = [make_batch(items[i:i+self.batch_size]) for i in range(0, len(items), self.batch_size)]
+            if messages:
+                self.queues[target].send_batch(messages)
+            n_messages[target] = len(messages)
+        return n_messages
+
+
+def drain(queue, handler, max_messages=SQS_MAX_MESSAGES):
+    """
+    Processes messages until the queue is empty, e.g. to run the downstream
+    handlers locally. A message is deleted once the handler returns.
+
+    Parameters:
+        queue: Queue object.
+        handler: Function called with each message.
+        max_messages: Optional number of messages received at a time.
+    Returns:
+        Number of messages processed.
+    """
+    n_messages = 0
+    while True:
+        messages = queue.receive(max_messages)
+        if not messages:
+            return n_messages
+        for handle, message in messages:
+            handler(message)
+            queue.delete([handle])
+            n_messages += 1
@@ -0,0 +1,140 @@
+"""
+Executors for running per-work-zone tasks concurrently.
+
+"""
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+EXECUTOR_TYPES = ('thread', 'process')
+DEFAULT_MAX_WORKERS = 10  # matches botocore's default max_pool_connections
+
+
+class TaskFailures(Exception):
+    """
+    Raised after all tasks of a batch have completed if any of them failed.
+    Failures are kept in the order the tasks were submitted.
+
+    """
+    def __init__(self, failures, results=None):
+        """
+        Parameters:
+            failures: List of (task identifier, exception) tuples, in submission
+                order.
+            results: Optional list of results of all tasks, in submission order,
+                with None for the tasks that failed.
+        """
+        self.failures = failures
+        self.results = results
+        msg = '{} task(s) failed: {}'.format(
+            len(failures),
+            ', '.join('{} ({!r})'.format(task_id, e) for task_id, e in failures))
+        super(TaskFailures, self).__init__(msg)
+
+
+def create_executor(executor_type='thread', max_workers=None):
+    """
+    Creates a bounded executor.
+
+    Parameters:
+        executor_type: 'thread' (default) or 'process'. Threads are recommended
+            since work zone processing is I/O bound against S3. Note that
+            process pools rely on /dev/shm, which is not available on AWS Lambda.
+        max_workers: Optional maximum number of concurrent workers. Defaults to
+            DEFAULT_MAX_WORKERS.
+    Returns:
+        concurrent.futures.Executor object.
+    """
+    max_workers = max_workers or DEFAULT_MAX_WORKERS
+    if executor_type == 'thread':
+        return ThreadPoolExecutor(max_workers=max_workers)
+    elif executor_type == 'process':
+        return ProcessPoolExecutor(max_workers=max_workers)
+    raise ValueError('executor_type must be one of {}, got {}'.format(EXECUTOR_TYPES, executor_type))
+
+
+class TaskQueue(object):
+    """
+    Submits tasks to an executor as they arrive (e.g. while a feed is still
+    being downloaded), keeping every worker slot busy, and collects their
+    results in submission order.
+
+    """
+    def __init__(self, executor, max_pending=None):
+        """
+        Parameters:
+            executor: concurrent.futures.Executor object.
+            max_pending: Optional maximum number of unfinished tasks. If reached,
+                submit blocks until a task finishes, which bounds the memory held
+                by queued task arguments.
+        """
+        self.executor = executor
+        self.max_pending = max_pending
+        self.task_ids = []
+        self.futures = []
+        self._pending = set()
+        self._last_future = {}
+
+    def submit(self, task_id, func, *args):
+        if self.max_pending:
+            self._pending = {f for f in self._pending if not f.done()}
+            if len(self._pending) >= self.max_pending:
+                self._pending = wait(self._pending, return_when=FIRST_COMPLETED).not_done
+        future = self.executor.submit(func, *args)
+        self.task_ids.append(task_id)
+        self.futures.append(future)
+        self._pending.add(future)
+        self._last_future[task_id] = future
+        return future
+
+    def wait_for(self, task_id):
+        """
+        Waits for the last task submitted with the identifier to finish, e.g.
+        so that tasks on the same S3 key run one after the other.
+
+        """
+        if task_id in self._last_future:
+            wait([self._last_future[task_id]])
+
+    def results(self):
+        """
+        Returns:
+            List of results, in submission order.
+        Raises:
+            TaskFailures if any task raised an exception.
+        """
+        results = []
+        failures = []
+        for task_id, future in zip(self.task_ids, self.futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(None)
+                failures.append((task_id, e))
+        if failures:
+            raise TaskFailures(failures, results) from failures[0][1]
+        return results
+
+
+def run_tasks(executor, func, tasks, task_ids=None):
+    """
+    Submits all tasks to the executor so that every worker slot stays busy,
+    then collects results in submission order. A failed task does not stop
+    the remaining tasks; all failures are raised together at the end.
+
+    Parameters:
+        executor: concurrent.futures.Executor object.
+        func: Callable to run for each task. Must be picklable for process pools.
+        tasks: List of argument tuples, one per task.
+        task_ids: Optional list of identifiers (e.g. S3 keys) used when reporting
+            failures. Defaults to the task's position.
+    Returns:
+        List of results, in the same order as tasks.
+    Raises:
+        TaskFailures if any task raised an exception.
+    """
+    if task_ids is None:
+        task_ids = list(range(len(tasks)))
+    queue = TaskQueue(executor)
+    for task_id, args in zip(task_ids, tasks):
+        queue.submit(task_id, func, *args)
+    return queue.results()
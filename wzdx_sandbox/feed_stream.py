@@ -0,0 +1,222 @@
+"""
+Streaming parsers for WZDx feed snapshots. They yield the feed header and then
+one work zone activity at a time, so that memory use does not grow with the
+size of the feed.
+
+"""
+import codecs
+import json
+from xml.parsers import expat
+
+
+CHUNK_SIZE = 65536
+
+_json_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r\ufeff'
+
+
+class _JsonStreamReader(object):
+    """
+    Buffered reader that decodes one JSON value at a time from a stream.
+
+    """
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def read_more(self):
+        if self.eof:
+            return False
+        # read at least as much as is buffered, so that large values need few retries
+        chunk = self.stream.read(max(self.chunk_size, len(self.buf) - self.pos))
+        if not chunk:
+            self.eof = True
+            chunk = self.decoder.decode(b'', final=True)
+        elif type(chunk) == bytes:
+            chunk = self.decoder.decode(chunk)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return not self.eof
+
+    def peek(self):
+        """
+        Returns the next non-whitespace character without consuming it, or ''
+        at the end of the stream.
+
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.read_more() and self.pos >= len(self.buf):
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Expected one of {!r} at position {}, got {!r}'.format(chars, self.pos, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = _json_decoder.raw_decode(self.buf, self.pos)
+                # a value ending with the buffer may be a truncated number
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return obj
+            except ValueError:
+                if self.eof:
+                    raise
+            self.read_more()
+
+
+def iter_json_feed(stream, activity_list_field_name='features', chunk_size=CHUNK_SIZE):
+    """
+    Incrementally parses a JSON feed whose activities are in a top-level list.
+
+    Parameters:
+        stream: "Readable" file datastream object, in bytes or text.
+        activity_list_field_name: Name of the top-level field with the activity list.
+        chunk_size: Number of bytes read from the stream at a time.
+    Returns:
+        Iterable of (event, value) tuples. The first event is ('header', doc),
+        where doc is the feed with an empty activity list and the top-level
+        fields read so far. It is followed by one ('activity', activity) per
+        activity, and a final ('end', doc), once any top-level fields that come
+        after the activity list have been added to doc.
+    """
+    reader = _JsonStreamReader(stream, chunk_size)
+    reader.expect('{')
+    doc = {}
+    header_sent = False
+    if reader.peek() == '}':
+        reader.pos += 1
+    else:
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            if key == activity_list_field_name and reader.peek() == '[':
+                reader.pos += 1
+                doc[key] = []
+                header_sent = True
+                yield 'header', doc
+                if reader.peek() == ']':
+                    reader.pos += 1
+                else:
+                    while True:
+                        yield 'activity', reader.value()
+                        if reader.expect(',]') == ']':
+                            break
+            else:
+                doc[key] = reader.value()
+            if reader.expect(',}') == '}':
+                break
+    if not header_sent:
+        yield 'header', doc
+    yield 'end', doc
+
+
+def _add_child(parent, name, value):
+    if name in parent:
+        if type(parent[name]) != list:
+            parent[name] = [parent[name]]
+        parent[name].append(value)
+    else:
+        parent[name] = value
+
+
+class _XmlFeedBuilder(object):
+    """
+    expat handlers that build the elements below the root with the structure
+    xmltodict.parse returns for them: names as written in the source (with
+    their namespace prefix, if any), attributes as '@name', repeated children
+    as lists, text as '#text' if the element also has attributes or children,
+    and None for empty elements.
+
+    """
+    def __init__(self, activity_list_field_name):
+        self.activity_list_field_name = activity_list_field_name
+        self.doc = {}
+        self.content = None
+        self.stack = []
+        self.header_sent = False
+        self.events = []
+
+    def start(self, name, attrs):
+        attrs = {'@' + k: v for k, v in attrs.items()}
+        if self.content is None:
+            self.content = attrs
+            self.doc[name] = self.content
+            self.stack.append(None)
+        else:
+            self.stack.append((name, attrs, []))
+
+    def data(self, text):
+        if self.stack[-1] is not None:
+            self.stack[-1][2].append(text)
+
+    def end(self, name):
+        frame = self.stack.pop()
+        if frame is None:
+            return
+        _, out, text = frame
+        text = ''.join(text).strip()
+        if not out:
+            value = text or None
+        else:
+            value = out
+            if text:
+                out['#text'] = text
+        if len(self.stack) > 1:
+            _add_child(self.stack[-1][1], name, value)
+        elif name == self.activity_list_field_name:
+            if not self.header_sent:
+                self.content[name] = []
+                self.header_sent = True
+                self.events.append(('header', self.doc))
+            self.events.append(('activity', value))
+        else:
+            _add_child(self.content, name, value)
+
+
+def iter_xml_feed(stream, activity_list_field_name='WorkZoneActivity', chunk_size=CHUNK_SIZE):
+    """
+    Incrementally parses a WZDx v1 XML feed, in which the activities are
+    children of the root element.
+
+    Parameters:
+        stream: "Readable" file datastream object.
+        activity_list_field_name: Name of the activity elements, with their
+            namespace prefix if the feed uses one.
+        chunk_size: Number of bytes read from the stream at a time.
+    Returns:
+        Iterable of (event, value) tuples, as for iter_json_feed. doc has the
+        structure xmltodict.parse would return, e.g.
+        {'WZDx': {'Header': {...}, 'WorkZoneActivity': []}}.
+    """
+    builder = _XmlFeedBuilder(activity_list_field_name)
+    # like xmltodict, without namespace processing, so that names keep their prefixes
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = builder.start
+    parser.EndElementHandler = builder.end
+    parser.CharacterDataHandler = builder.data
+    while True:
+        chunk = stream.read(chunk_size)
+        parser.Parse(chunk, not chunk)
+        # only the activities parsed from this chunk are held in memory
+        for event in builder.events:
+            yield event
+        builder.events = []
+        if not chunk:
+            break
+    if not builder.header_sent:
+        yield 'header', builder.doc
+    yield 'end', builder.doc
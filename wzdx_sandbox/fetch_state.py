@@ -0,0 +1,79 @@
+"""
+Per feed state of the last raw feed fetch, used to make conditional requests
+and to recognize feed snapshots that did not change since the last poll.
+
+"""
+from wzdx_sandbox import codec
+
+
+class FeedFetchState(object):
+    """
+    HTTP validators (ETag, Last-Modified) and content hash of the last snapshot
+    fetched from a feed, stored as a single JSON object at
+    '<prefix>_fetch_state.json' in the state bucket.
+
+    """
+    state_name = '_fetch_state.json'
+
+    def __init__(self, s3helper, bucket, prefix):
+        """
+        Initialization function of the FeedFetchState class.
+
+        Parameters:
+            s3helper: S3Helper object.
+            bucket: Name of the AWS S3 bucket the state is kept in, which should
+                not be the public bucket of the raw feeds.
+            prefix: Feed prefix (state={state}/feedName={feedname}/).
+        """
+        self.s3helper = s3helper
+        self.bucket = bucket
+        self.key = prefix + self.state_name
+        self.state = {}
+
+    def load(self):
+        """
+        Loads the state. A feed that was never fetched has an empty state.
+
+        Returns:
+            The FeedFetchState object.
+        """
+        try:
+            datastream = self.s3helper.get_data_stream(self.bucket, self.key)
+        except self.s3helper.client.exceptions.NoSuchKey:
+            self.state = {}
+            return self
+        self.state = codec.loads(datastream.read())
+        return self
+
+    def request_headers(self):
+        """
+        Returns the headers of a conditional request for the feed.
+
+        """
+        headers = {}
+        if self.state.get('etag'):
+            headers['If-None-Match'] = self.state['etag']
+        if self.state.get('last_modified'):
+            headers['If-Modified-Since'] = self.state['last_modified']
+        return headers
+
+    def matches(self, digest):
+        return self.state.get('sha256') == digest
+
+    def save(self, response, digest, key):
+        """
+        Records the validators of a response and the hash and S3 key of the
+        snapshot it returned.
+
+        Parameters:
+            response: requests.Response object of the feed request.
+            digest: SHA-256 hex digest of the snapshot.
+            key: S3 key of the raw feed object.
+        """
+        self.state = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'sha256': digest,
+            'key': key
+        }
+        self.s3helper.write_bytes(codec.dumps(self.state, sort_keys=True), self.bucket, self.key)
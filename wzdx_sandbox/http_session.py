@@ -0,0 +1,30 @@
+"""
+Shared HTTP session for polling WZDx feeds.
+
+"""
+import requests
+from requests.adapters import HTTPAdapter
+
+
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 4
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (10, 60)
+
+
+def create_http_session(max_connections_per_host=DEFAULT_MAX_CONNECTIONS_PER_HOST, max_hosts=100):
+    """
+    Creates a requests session that keeps connections alive across requests.
+
+    Parameters:
+        max_connections_per_host: Optional maximum number of open connections
+            to any one host. Requests beyond this wait for a free connection
+            instead of opening a new one.
+        max_hosts: Optional number of hosts whose connection pools are kept.
+    Returns:
+        requests.Session object.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_hosts, pool_maxsize=max_connections_per_host, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -0,0 +1,124 @@
+"""
+Structured report of what an ingest run did.
+
+"""
+from contextlib import contextmanager
+import threading
+import time
+
+
+class IngestReport(object):
+    """
+    Counters for one ingest run, or for a single work zone status processed by
+    a worker. Worker reports are merged into the report of the run.
+
+    phase_cpu_seconds holds the time spent in each phase summed over all
+    threads and worker processes, so with concurrent workers the diff and
+    write phases can add up to more than the run took. wall_seconds is the
+    wall-clock time of the whole run.
+
+    """
+    OUTCOMES = ('skipped', 'overwrite', 'new_status', 'new_fp')
+    PHASES = ('parse', 'fingerprint', 'diff', 'write')
+
+    def __init__(self, feedname=None):
+        """
+        Initialization function of the IngestReport class.
+
+        Parameters:
+            feedname: Optional name of the feed being ingested.
+        """
+        self.feedname = feedname
+        self.n_statuses = 0
+        self.outcomes = {outcome: 0 for outcome in self.OUTCOMES}
+        self.s3_calls = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.phase_cpu_seconds = {phase: 0.0 for phase in self.PHASES}
+        self.changed_fields = {}
+        self.wall_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # reports are returned from process pool workers; locks cannot be pickled
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add_outcome(self, outcome):
+        with self._lock:
+            self.outcomes[outcome] += 1
+
+    def add_s3_call(self, operation, bytes_read=0, bytes_written=0):
+        with self._lock:
+            self.s3_calls[operation] = self.s3_calls.get(operation, 0) + 1
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+
+    def add_changed_fields(self, diffs):
+        """
+        Counts the changed fields of a new work zone status, from the output of
+        wzdx_sandbox.record_diff.diff_records.
+
+        """
+        with self._lock:
+            for diff in diffs:
+                self.changed_fields[diff['path']] = self.changed_fields.get(diff['path'], 0) + 1
+
+    def add_phase_time(self, phase, seconds):
+        with self._lock:
+            self.phase_cpu_seconds[phase] = self.phase_cpu_seconds.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, phase):
+        """
+        Context manager that adds the time spent in the block to the phase.
+
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase_time(phase, time.perf_counter() - start)
+
+    def merge(self, other):
+        """
+        Adds the counters of another report (e.g. a worker's report) to this one.
+
+        """
+        with self._lock:
+            self.n_statuses += other.n_statuses
+            for outcome, n in other.outcomes.items():
+                self.outcomes[outcome] = self.outcomes.get(outcome, 0) + n
+            for operation, n in other.s3_calls.items():
+                self.s3_calls[operation] = self.s3_calls.get(operation, 0) + n
+            self.bytes_read += other.bytes_read
+            self.bytes_written += other.bytes_written
+            for phase, seconds in other.phase_cpu_seconds.items():
+                self.phase_cpu_seconds[phase] = self.phase_cpu_seconds.get(phase, 0.0) + seconds
+            for path, n in other.changed_fields.items():
+                self.changed_fields[path] = self.changed_fields.get(path, 0) + n
+
+    def to_dict(self):
+        """
+        Returns the report as a JSON serializable dictionary. Phase times are
+        summed across workers (phase_cpu_seconds), wall_seconds is the
+        wall-clock time of the run.
+
+        """
+        return {
+            'feedname': self.feedname,
+            'n_statuses': self.n_statuses,
+            'outcomes': dict(self.outcomes),
+            's3_calls': dict(self.s3_calls),
+            'n_s3_calls': sum(self.s3_calls.values()),
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'phase_cpu_seconds': {k: round(v, 6) for k, v in self.phase_cpu_seconds.items()},
+            'changed_fields': dict(self.changed_fields),
+            'wall_seconds': round(self.wall_seconds, 6)
+        }
@@ -0,0 +1,284 @@
+"""
+In-process pipeline for self-hosted deployments. Each raw feed snapshot is
+fetched and written to the raw sandbox, parsed once, and the parsed feed is fed
+to both the lake (work zone fingerprint and diff) and the Socrata stage, instead
+of each downstream lambda reading the snapshot back from S3 and parsing it again.
+
+Stages run in their own worker threads and are connected by bounded queues, so
+a slow stage holds back the stages before it instead of letting snapshots pile
+up in memory.
+
+"""
+from copy import deepcopy
+import queue
+import threading
+
+from wzdx_sandbox.executor import TaskFailures, DEFAULT_MAX_WORKERS
+from wzdx_sandbox.http_session import create_http_session, DEFAULT_MAX_CONNECTIONS_PER_HOST, DEFAULT_TIMEOUT
+from wzdx_sandbox.s3_helper import S3Helper
+from wzdx_sandbox.socrata_sync import sync_feed
+from wzdx_sandbox.socrata_watermark import S3WatermarkStore
+from wzdx_sandbox.wzdx_sandbox import WorkZoneRawSandbox, WorkZoneSandbox, read_url_dict
+
+
+DEFAULT_MAX_QUEUE = 4
+
+# queue tokens: an upstream stage (or the source) has no more items, and a worker should exit
+_DONE = object()
+_STOP = object()
+
+
+class Stage(object):
+    """
+    A stage of a StageGraph. Each item is passed to func, and its result to
+    every downstream stage. A stage with no downstream stage keeps its results.
+
+    """
+    def __init__(self, name, func, workers=1, max_queue=DEFAULT_MAX_QUEUE):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = queue.Queue(max_queue)
+        self.upstream = []
+        self.downstream = []
+        self._lock = threading.Lock()
+        self._n_open = 0
+        self._n_running = 0
+
+
+class StageGraph(object):
+    """
+    Directed acyclic graph of stages connected by bounded queues.
+
+    """
+    def __init__(self, max_queue=DEFAULT_MAX_QUEUE):
+        """
+        Parameters:
+            max_queue: Optional default number of items waiting in front of a
+                stage. An upstream stage blocks while the queue is full.
+        """
+        self.max_queue = max_queue
+        self.stages = {}
+        self.results = {}
+        self.failures = []
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, func, upstream=None, workers=1, max_queue=None):
+        """
+        Adds a stage.
+
+        Parameters:
+            name: Unique name of the stage.
+            func: Function called with each item. If it returns None, the item
+                is not passed downstream (e.g. a feed that did not change).
+            upstream: Optional list of names of stages, already added, whose
+                results are the items of this stage. Stages without upstream
+                stages are given the items passed to run.
+            workers: Optional number of threads running the stage.
+            max_queue: Optional number of items waiting in front of the stage.
+        Returns:
+            Stage object.
+        """
+        if name in self.stages:
+            raise ValueError('Stage {} already exists'.format(name))
+        stage = Stage(name, func, workers, max_queue or self.max_queue)
+        for upstream_name in upstream or []:
+            if upstream_name not in self.stages:
+                raise ValueError('Upstream stage {} of {} does not exist'.format(upstream_name, name))
+            stage.upstream.append(self.stages[upstream_name])
+            self.stages[upstream_name].downstream.append(stage)
+        self.stages[name] = stage
+        return stage
+
+    def run(self, items):
+        """
+        Runs every item through the graph and waits for all stages to finish.
+        An item that fails in a stage is not passed downstream, and does not
+        stop the other items.
+
+        Parameters:
+            items: Iterable of items for the stages without upstream stages.
+        Returns:
+            Dictionary of the results of each stage without downstream stages,
+            keyed by stage name, as lists of (item index, result) tuples sorted
+            by the index of the item in items.
+        Raises:
+            TaskFailures if any item failed in any stage, with ((stage name, item
+            index), exception) failures and the results as described above.
+        """
+        self.results = {name: [] for name, stage in self.stages.items() if not stage.downstream}
+        self.failures = []
+        sources = [stage for stage in self.stages.values() if not stage.upstream]
+        threads = []
+        for stage in self.stages.values():
+            stage._n_open = len(stage.upstream) or 1
+            stage._n_running = stage.workers
+            for _ in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(stage,), name='{}-worker'.format(stage.name))
+                thread.start()
+                threads.append(thread)
+        try:
+            for i, item in enumerate(items):
+                for stage in sources:
+                    stage.queue.put((i, item))
+        finally:
+            for stage in sources:
+                stage.queue.put(_DONE)
+            for thread in threads:
+                thread.join()
+        results = {name: sorted(stage_results, key=lambda result: result[0])
+                   for name, stage_results in self.results.items()}
+        if self.failures:
+            failures = sorted(self.failures, key=lambda failure: failure[0][1])
+            raise TaskFailures(failures, results) from failures[0][1]
+        return results
+
+    def _work(self, stage):
+        while True:
+            token = stage.queue.get()
+            if token is _STOP:
+                break
+            if token is _DONE:
+                with stage._lock:
+                    stage._n_open -= 1
+                    closed = stage._n_open == 0
+                if closed:
+                    # items still queued are in front of the stop tokens
+                    for _ in range(stage.workers):
+                        stage.queue.put(_STOP)
+                continue
+            i, item = token
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                with self._lock:
+                    self.failures.append(((stage.name, i), e))
+                continue
+            if result is None:
+                continue
+            if not stage.downstream:
+                with self._lock:
+                    self.results[stage.name].append((i, result))
+            for downstream in stage.downstream:
+                downstream.queue.put((i, result))
+        with stage._lock:
+            stage._n_running -= 1
+            last = stage._n_running == 0
+        if last:
+            for downstream in stage.downstream:
+                downstream.queue.put(_DONE)
+
+
+def run_single_pass(feeds, raw_bucket, lake_bucket, socrata_params=None, max_fetch_workers=None,
+                    max_connections_per_host=DEFAULT_MAX_CONNECTIONS_PER_HOST, timeout=DEFAULT_TIMEOUT,
+                    session=None, s3helper=None, url_dict=None, compression=None, compression_level=None,
+                    lake_args=None, socrata_args=None, max_queue=DEFAULT_MAX_QUEUE, sync=sync_feed, state_bucket=None,
+                    logger=None):
+    """
+    Fetches feeds to the ITS Work Zone Raw Sandbox and ingests each new snapshot
+    to the ITS Work Zone Sandbox and, for feeds piped to Socrata, to Socrata,
+    parsing each snapshot once and never reading it back from S3. The downstream
+    lambdas are not triggered.
+
+    Stages: 'fetch' (max_fetch_workers threads) -> 'parse' -> 'lake' and 'socrata'.
+
+    Parameters:
+        feeds: Array of feed dictionary objects, as for WorkZoneRawSandbox.
+        raw_bucket: Name of the AWS S3 bucket that contains the ITS Work Zone Raw Sandbox.
+        lake_bucket: Name of the AWS S3 bucket that contains the ITS Work Zone Sandbox.
+        socrata_params: Optional dictionary object of the Socrata credentials.
+            If not given, the Socrata stage is skipped.
+        max_fetch_workers: Optional maximum number of feeds fetched at the same time.
+        max_connections_per_host: Optional maximum number of concurrent
+            connections to any one host.
+        timeout: Optional timeout of each feed request in seconds, or a
+            (connect, read) tuple.
+        session: Optional requests session to use instead of creating one.
+        s3helper: Optional S3Helper object shared by all stages.
+        url_dict: Optional dictionary of feed URLs keyed by (state, feedname).
+            If not given, URLs are read from WZDx_URLs.csv.
+        compression: Optional compression of the raw feed objects.
+        compression_level: Optional compression level of the raw feed objects.
+        lake_args: Optional dictionary of other arguments of WorkZoneSandbox
+            (e.g. layout, max_workers, compression).
+        socrata_args: Optional dictionary of other arguments of sync (e.g.
+            mode='incremental'). The digest index of incremental syncs and the
+            dataset watermarks are kept in the state_bucket. No watermarks are
+            kept if neither state_bucket nor watermarks is given.
+        max_queue: Optional number of snapshots waiting in front of each stage.
+        sync: Optional function called with (feed, data, socrata_params,
+            print_func=print_func, **socrata_args) to sync a parsed feed to
+            Socrata. Defaults to socrata_sync.sync_feed.
+        state_bucket: Optional name of the AWS S3 bucket internal state is kept
+            in. If given, feeds are fetched conditionally (see
+            WorkZoneRawSandbox), with their fetch state kept in this bucket,
+            and it is the default state_bucket of the Socrata syncs.
+        logger: Optional logger object. If not given, information is printed.
+    Returns:
+        Array of {'feedname', 'key', 'lake', 'socrata', 'error'} dictionary
+        objects, one per feed, in the order of feeds. key is the S3 key of the
+        raw snapshot, or None if nothing was ingested; lake is the IngestReport
+        of a new snapshot; socrata is the outcome of the Socrata sync; and error
+        is the repr of the first exception raised for the feed, if any.
+    """
+    lake_args = lake_args or {}
+    socrata_args = dict(socrata_args or {})
+    max_fetch_workers = max_fetch_workers or DEFAULT_MAX_WORKERS
+    session = session or create_http_session(max_connections_per_host)
+    if url_dict is None:
+        url_dict = read_url_dict()
+    if s3helper is None:
+        s3helper = S3Helper(max_pool_connections=max_fetch_workers + (lake_args.get('max_workers') or DEFAULT_MAX_WORKERS))
+    print_func = logger.info if logger else print
+    socrata_args.setdefault('s3helper', s3helper)
+    if state_bucket is not None:
+        socrata_args.setdefault('state_bucket', state_bucket)
+    if socrata_args.get('state_bucket') is not None:
+        socrata_args.setdefault('watermarks', S3WatermarkStore(s3helper, socrata_args['state_bucket']))
+    keys = {}
+
+    def fetch(feed):
+        sandbox = WorkZoneRawSandbox(raw_bucket, feed=feed, url_dict=url_dict, s3helper=s3helper,
+            compression=feed.get('compression') or compression, compression_level=compression_level,
+            conditional_fetch=state_bucket is not None, state_bucket=state_bucket, logger=logger)
+        snapshot = sandbox.fetch(session=session, timeout=timeout, keep_content=True)
+        keys[feed['feedname']] = snapshot['key']
+        if snapshot['key'] is None or snapshot['unchanged']:
+            return None
+        return {'feed': feed, 'key': snapshot['key'], 'content': snapshot['content']}
+
+    def parse(snapshot):
+        sandbox = WorkZoneSandbox(lake_bucket, feed=snapshot['feed'], s3helper=s3helper, logger=logger, **lake_args)
+        return {'feed': snapshot['feed'], 'key': snapshot['key'], 'sandbox': sandbox,
+                'data': sandbox.parse_to_json(snapshot['content'])}
+
+    def ingest_to_lake(snapshot):
+        return snapshot['sandbox'].ingest(snapshot['data'])
+
+    def sync_to_socrata(snapshot):
+        if snapshot['feed']['pipedtosocrata'] != True:
+            return None
+        # the lake stage reads the same parsed feed at the same time
+        return sync(snapshot['feed'], deepcopy(snapshot['data']), socrata_params,
+            print_func=print_func, **socrata_args)
+
+    graph = StageGraph(max_queue)
+    graph.add_stage('fetch', fetch, workers=max_fetch_workers)
+    graph.add_stage('parse', parse, upstream=['fetch'])
+    graph.add_stage('lake', ingest_to_lake, upstream=['parse'])
+    if socrata_params is not None:
+        graph.add_stage('socrata', sync_to_socrata, upstream=['parse'])
+    try:
+        results = graph.run(feeds)
+        errors = {}
+    except TaskFailures as e:
+        results = e.results
+        errors = {}
+        for (stage_name, i), err in e.failures:
+            print_func('{} stage failed for {}: {!r}'.format(stage_name, feeds[i]['feedname'], err))
+            errors.setdefault(i, err)
+    lake_reports = dict(results['lake'])
+    socrata_outcomes = dict(results.get('socrata', []))
+    return [{'feedname': feed['feedname'], 'key': keys.get(feed['feedname']), 'lake': lake_reports.get(i),
+             'socrata': socrata_outcomes.get(i), 'error': repr(errors[i]) if i in errors else None}
+            for i, feed in enumerate(feeds)]
@@ -0,0 +1,110 @@
+"""
+Canonical hashing and field-level diffing of work zone records.
+
+"""
+import hashlib
+
+from wzdx_sandbox import codec
+
+
+# fields ignored when deciding whether a work zone status changed
+DEFAULT_IGNORE_PATHS = ('update_date',)
+# update date fields of the GeoJSON spec versions, for callers that also want to ignore them
+GEOJSON_UPDATE_DATE_PATHS = ('properties.update_date', 'properties.core_details.update_date')
+
+
+def compile_paths(paths):
+    """
+    Compiles dotted paths (e.g. 'properties.update_date') into a nested
+    dictionary, with True marking the fields to drop.
+
+    """
+    if isinstance(paths, dict) or paths is None:
+        return paths or {}
+    tree = {}
+    for path in paths:
+        node = tree
+        parts = path.split('.')
+        for part in parts[:-1]:
+            child = node.setdefault(part, {})
+            if child is True:
+                break
+            node = child
+        else:
+            node[parts[-1]] = True
+    return tree
+
+
+def prune(obj, ignore_tree):
+    """
+    Returns a copy of obj without the fields in ignore_tree (see compile_paths).
+    Lists are transparent, so paths apply to each of their elements.
+
+    """
+    if not ignore_tree:
+        return obj
+    if isinstance(obj, list):
+        return [prune(item, ignore_tree) for item in obj]
+    if not isinstance(obj, dict):
+        return obj
+    out = {}
+    for k, v in obj.items():
+        sub_tree = ignore_tree.get(k)
+        if sub_tree is True:
+            continue
+        out[k] = prune(v, sub_tree) if sub_tree else v
+    return out
+
+
+def canonical_hash(obj, ignore_paths=None):
+    """
+    Returns a hash of obj that does not depend on key order, optionally
+    ignoring some fields.
+
+    Parameters:
+        obj: JSON serializable object.
+        ignore_paths: Optional list of dotted paths (or compiled paths, see
+            compile_paths) of fields to ignore.
+    Returns:
+        Hex string of the SHA-256 of the canonical JSON serialization of obj.
+    """
+    obj = prune(obj, compile_paths(ignore_paths))
+    return hashlib.sha256(codec.dumps(obj, sort_keys=True)).hexdigest()
+
+
+def _compact(value):
+    if isinstance(value, (dict, list)):
+        return {'hash': canonical_hash(value)}
+    return value
+
+
+def diff_records(old, new, ignore_paths=None, path=''):
+    """
+    Compares two records field by field.
+
+    Parameters:
+        old: Dictionary object of the previous record.
+        new: Dictionary object of the current record.
+        ignore_paths: Optional list of dotted paths of fields to ignore.
+    Returns:
+        Array of {'path', 'old', 'new'} dictionary objects, one per changed field.
+        Dictionaries are compared key by key; other values, including lists
+        such as geometry coordinates, are compared as a whole. Changed
+        dictionary and list values are replaced by their hash to keep the
+        diff compact. Missing fields are reported as None.
+    """
+    ignore_tree = compile_paths(ignore_paths)
+    diffs = []
+    if isinstance(old, dict) and isinstance(new, dict):
+        for k in list(old) + [k for k in new if k not in old]:
+            sub_tree = ignore_tree.get(k)
+            if sub_tree is True:
+                continue
+            sub_path = path + '.' + k if path else k
+            if k not in old or k not in new:
+                diffs.append({'path': sub_path, 'old': _compact(old.get(k)), 'new': _compact(new.get(k))})
+            elif old[k] != new[k]:
+                diffs += diff_records(old[k], new[k], sub_tree, sub_path)
+    elif prune(old, ignore_tree) != prune(new, ignore_tree):
+        diffs.append({'path': path, 'old': _compact(old), 'new': _compact(new)})
+    return diffs
@@ -0,0 +1,457 @@
+"""
+Storage layouts for the monthly work zone files of the ITS Work Zone Sandbox.
+
+"""
+from collections import OrderedDict
+import threading
+
+from wzdx_sandbox import codec
+from wzdx_sandbox.compression import get_compression
+from wzdx_sandbox.record_diff import canonical_hash
+
+
+HEADER_CACHE_SIZE = 1024
+
+# feed headers by (bucket, header key); header objects never change once written
+_header_cache = OrderedDict()
+_header_cache_lock = threading.Lock()
+
+
+class WorkZoneFileTail(object):
+    """
+    Last records of a monthly work zone file, along with what the record store
+    needs to append to or replace the last record of that file.
+
+    """
+    def __init__(self, recs, n_recs, context=None):
+        """
+        Parameters:
+            recs: Array of the last records of the file, oldest first.
+            n_recs: Total number of records in the file, or None if unknown.
+            context: Optional store specific state (e.g. the manifest of the file).
+        """
+        self.recs = recs
+        self.n_recs = n_recs
+        self.context = context
+
+
+class NdjsonRecordStore(object):
+    """
+    Original layout: all statuses of a work zone for the month are kept in one
+    newline JSON object at the work zone key (plus the extension of the
+    compression, if any). Every append or overwrite rewrites the whole object.
+
+    """
+    layout = 'ndjson'
+
+    def __init__(self, s3helper, bucket, compression=None, level=None, conditional=False):
+        """
+        Parameters:
+            s3helper: S3Helper object.
+            bucket: Name of the AWS S3 bucket that contains the ITS Work Zone Sandbox.
+            compression: Optional compression of the newline JSON objects,
+                'gzip' or 'zstd' (see wzdx_sandbox.compression).
+            level: Optional compression level.
+            conditional: Optional. If True, a work zone file is only written if
+                it did not change since its tail was read, and only created if
+                it does not exist yet. Otherwise a WriteConflict is raised (see
+                S3Helper.write_bytes), and the caller reads the tail again.
+        """
+        self.s3helper = s3helper
+        self.bucket = bucket
+        self.compression = compression
+        self.level = level
+        self.conditional = conditional
+        self.extension = get_compression(compression).extension if compression else ''
+
+    def object_key(self, key):
+        """
+        Returns the S3 key whose presence shows that the work zone file exists.
+
+        """
+        return key + self.extension
+
+    def _read_lines(self, object_key):
+        datastream = self.s3helper.get_data_stream(self.bucket, object_key)
+        return [codec.loads(rec) for rec in datastream.iter_lines() if rec]
+
+    def _write_recs(self, recs, object_key, **conditions):
+        return self.s3helper.write_recs(recs, self.bucket, object_key,
+            compression=self.compression, level=self.level, **conditions)
+
+    def _conditions(self, tail):
+        # the file is replaced only if it is still the one the tail was read from
+        if not self.conditional:
+            return {}
+        if tail is None:
+            return {'if_none_match': True}
+        return {'if_match': tail.context['etag']}
+
+    def exists(self, key, listing=None):
+        """
+        Check if the work zone file exists, either in the listing (see
+        S3Helper.list_prefix) or with a HEAD request if no listing is given.
+
+        """
+        if listing is not None:
+            return self.object_key(key) in listing
+        return self.s3helper.path_exists(self.bucket, self.object_key(key))
+
+    def read_recs(self, key):
+        """
+        Returns all records of the work zone file, oldest first.
+
+        """
+        return self._read_lines(self.object_key(key))
+
+    def read_tail(self, key, n=2):
+        """
+        Returns a WorkZoneFileTail with the last n records of the work zone file.
+        Only the end of the object is read (see S3Helper.get_tail_recs).
+
+        """
+        recs, offsets, body, etag = self.s3helper.get_tail_recs(self.bucket, self.object_key(key), n=n, with_etag=True)
+        n_recs = len([line for line in body.split(b'\n') if line.strip()]) if body is not None else None
+        return WorkZoneFileTail(recs, n_recs, context={'body': body, 'last_offset': offsets[-1], 'etag': etag})
+
+    def _read_body(self, key, tail):
+        # the history before the last record is spliced as bytes and never parsed
+        if tail.context['body'] is None:
+            tail.context['body'] = self.s3helper.get_data_stream(self.bucket, self.object_key(key)).read()
+        return tail.context['body']
+
+    def write_recs(self, key, recs):
+        """
+        Writes the whole history of the work zone file, replacing the file.
+
+        """
+        self._write_recs(recs, self.object_key(key))
+
+    def append(self, key, rec, tail=None):
+        """
+        Appends the record to the work zone file, creating the file if tail is None.
+
+        """
+        if tail is None:
+            self._write_recs([rec], self.object_key(key), **self._conditions(tail))
+            return
+        body = self._read_body(key, tail).rstrip(b'\n')
+        self.s3helper.write_bytes(body + b'\n' + codec.dumps_record(rec), self.bucket, self.object_key(key),
+            compression=self.compression, level=self.level, **self._conditions(tail))
+
+    def replace_last(self, key, rec, tail):
+        """
+        Replaces the last record of the work zone file with the record.
+
+        """
+        body = self._read_body(key, tail)[:tail.context['last_offset']]
+        self.s3helper.write_bytes(body + codec.dumps_record(rec), self.bucket, self.object_key(key),
+            compression=self.compression, level=self.level, **self._conditions(tail))
+
+
+class SegmentedRecordStore(NdjsonRecordStore):
+    """
+    Append-friendly layout: each status is kept in its own part object, and a
+    small manifest at '<key>.manifest.json' holds the number of records and a
+    copy of the last two records. Appending writes one part and the manifest,
+    and replacing the last record rewrites only the last part and the manifest,
+    regardless of how long the monthly history is.
+
+    Parts are kept at '<prefix>_parts/<work zone file name>/<index>.ndjson' so
+    that a delimited listing of the month prefix stays one entry per work zone.
+    Only parts are compressed; manifests are always plain JSON.
+
+    The records in the manifest's tail are authoritative over their parts.
+    With conditional writes, the manifest is the only object written
+    conditionally, so a writer that lost a conflict may have overwritten the
+    part of a record still in the tail. Each append then also rewrites the
+    part of the record leaving the tail, from the tail.
+
+    """
+    layout = 'segmented'
+    manifest_suffix = '.manifest.json'
+    n_tail = 2
+
+    def object_key(self, key):
+        return key + self.manifest_suffix
+
+    def part_key(self, key, index):
+        prefix, _, name = key.rpartition('/')
+        if prefix:
+            prefix += '/'
+        return '{}_parts/{}/{:06d}.ndjson{}'.format(prefix, name, index, self.extension)
+
+    def read_manifest(self, key):
+        datastream = self.s3helper.get_data_stream(self.bucket, self.object_key(key))
+        return codec.loads(datastream.read())
+
+    def read_recs(self, key):
+        manifest = self.read_manifest(key)
+        recs = []
+        for index in range(manifest['n_recs'] - len(manifest['tail'])):
+            recs += self._read_lines(self.part_key(key, index))
+        return recs + manifest['tail']
+
+    def read_tail(self, key, n=2):
+        data, etag = self.s3helper.get_bytes(self.bucket, self.object_key(key))
+        manifest = codec.loads(data)
+        context = dict(manifest, etag=etag)
+        if n <= len(manifest['tail']) or len(manifest['tail']) == manifest['n_recs']:
+            return WorkZoneFileTail(manifest['tail'][-n:], manifest['n_recs'], context=context)
+        recs = []
+        for index in range(max(manifest['n_recs'] - n, 0), manifest['n_recs'] - len(manifest['tail'])):
+            recs += self._read_lines(self.part_key(key, index))
+        return WorkZoneFileTail(recs + manifest['tail'], manifest['n_recs'], context=context)
+
+    def _write(self, key, index, rec, manifest, tail=None):
+        # part is written before the manifest, so the manifest never refers to a missing part
+        self._write_recs([rec], self.part_key(key, index))
+        self.s3helper.write_bytes(codec.dumps(manifest), self.bucket, self.object_key(key),
+            **self._conditions(tail))
+
+    def write_recs(self, key, recs):
+        for index, rec in enumerate(recs):
+            self._write_recs([rec], self.part_key(key, index))
+        manifest = {'n_recs': len(recs), 'tail': recs[-self.n_tail:]}
+        self.s3helper.write_bytes(codec.dumps(manifest), self.bucket, self.object_key(key))
+
+    def append(self, key, rec, tail=None):
+        if tail is None:
+            n_recs, prev_tail = 0, []
+        else:
+            n_recs, prev_tail = tail.context['n_recs'], tail.context['tail']
+        manifest = {'n_recs': n_recs + 1, 'tail': (prev_tail + [rec])[-self.n_tail:]}
+        if self.conditional and len(prev_tail) == self.n_tail:
+            # the record leaving the tail can no longer change, and its part may be a conflicting writer's
+            self._write_recs(prev_tail[:1], self.part_key(key, n_recs - self.n_tail))
+        self._write(key, n_recs, rec, manifest, tail)
+
+    def replace_last(self, key, rec, tail):
+        n_recs, prev_tail = tail.context['n_recs'], tail.context['tail']
+        manifest = {'n_recs': n_recs, 'tail': prev_tail[:-1] + [rec]}
+        self._write(key, n_recs - 1, rec, manifest, tail)
+
+
+def _header_cache_get(cache_key):
+    with _header_cache_lock:
+        header = _header_cache.get(cache_key)
+        if header is not None:
+            _header_cache.move_to_end(cache_key)
+        return header
+
+
+def _header_cache_put(cache_key, header):
+    with _header_cache_lock:
+        _header_cache[cache_key] = header
+        _header_cache.move_to_end(cache_key)
+        while len(_header_cache) > HEADER_CACHE_SIZE:
+            _header_cache.popitem(last=False)
+
+
+def clear_header_cache():
+    with _header_cache_lock:
+        _header_cache.clear()
+
+
+class HeaderDedupRecordStore(object):
+    """
+    Wrapper of a record store that keeps each distinct feed header once per
+    feed-month, at '<prefix>_headers/<hash>.json', and stores only a
+    {'$ref': <hash>} reference to it in each record. The feed header is often
+    larger than the activity, and is the same for every activity of a feed.
+
+    Records are rehydrated to their original shape when read, so records
+    written before the wrapper was used, which still hold their header, are
+    read as they are.
+
+    """
+    headers_folder = '_headers/'
+    ref_field_name = '$ref'
+
+    def __init__(self, store, header_field_names):
+        """
+        Parameters:
+            store: Record store the records are written to (e.g. NdjsonRecordStore).
+            header_field_names: Iterable of the field names of feed headers
+                (see wzdx_sandbox.spec_registry.header_field_names).
+        """
+        self.store = store
+        self.s3helper = store.s3helper
+        self.bucket = store.bucket
+        self.layout = store.layout
+        self.header_field_names = tuple(header_field_names)
+
+    def header_key(self, key, header_hash):
+        prefix, slash, _ = key.rpartition('/')
+        return '{}{}{}{}.json'.format(prefix, slash, self.headers_folder, header_hash)
+
+    def object_key(self, key):
+        return self.store.object_key(key)
+
+    def exists(self, key, listing=None):
+        return self.store.exists(key, listing)
+
+    def _write_header(self, key, header):
+        header_hash = canonical_hash(header)
+        header_key = self.header_key(key, header_hash)
+        cache_key = (self.bucket, header_key)
+        # content addressed, so concurrent writers of the same header write the same object
+        if _header_cache_get(cache_key) is None:
+            if not self.s3helper.path_exists(self.bucket, header_key):
+                self.s3helper.write_bytes(codec.dumps(header, sort_keys=True), self.bucket, header_key)
+            _header_cache_put(cache_key, header)
+        return header_hash
+
+    def read_header(self, key, header_hash):
+        """
+        Returns the feed header of a reference, read once per process.
+
+        """
+        header_key = self.header_key(key, header_hash)
+        cache_key = (self.bucket, header_key)
+        header = _header_cache_get(cache_key)
+        if header is None:
+            header = codec.loads(self.s3helper.get_data_stream(self.bucket, header_key).read())
+            _header_cache_put(cache_key, header)
+        return header
+
+    def dehydrate(self, key, rec):
+        """
+        Returns a copy of the record with its feed header replaced by a reference.
+
+        """
+        rec = dict(rec)
+        for name in self.header_field_names:
+            if isinstance(rec.get(name), dict) and self.ref_field_name not in rec[name]:
+                rec[name] = {self.ref_field_name: self._write_header(key, rec[name])}
+        return rec
+
+    def rehydrate(self, key, rec):
+        """
+        Returns the record in its original shape, with the feed header in
+        place of its reference.
+
+        """
+        for name in self.header_field_names:
+            value = rec.get(name)
+            if isinstance(value, dict) and len(value) == 1 and self.ref_field_name in value:
+                rec = dict(rec)
+                rec[name] = self.read_header(key, value[self.ref_field_name])
+        return rec
+
+    def read_recs(self, key):
+        return [self.rehydrate(key, rec) for rec in self.store.read_recs(key)]
+
+    def write_recs(self, key, recs):
+        self.store.write_recs(key, [self.dehydrate(key, rec) for rec in recs])
+
+    def read_tail(self, key, n=2):
+        tail = self.store.read_tail(key, n)
+        # the wrapped store's own tail is kept for its appends and replacements
+        return WorkZoneFileTail([self.rehydrate(key, rec) for rec in tail.recs], tail.n_recs, context=tail)
+
+    def append(self, key, rec, tail=None):
+        self.store.append(key, self.dehydrate(key, rec), tail.context if tail is not None else None)
+
+    def replace_last(self, key, rec, tail):
+        self.store.replace_last(key, self.dehydrate(key, rec), tail.context)
+
+
+class BufferedRecordStore(object):
+    """
+    Wrapper of a record store that keeps the work zone files it reads or
+    writes in memory, and writes each changed file once when flushed, instead
+    of once per status. Used to replay many feed snapshots in a row (see
+    wzdx_sandbox.backfill).
+
+    """
+    def __init__(self, store):
+        """
+        Parameters:
+            store: Record store the work zone files are read from and flushed to.
+        """
+        self.store = store
+        self.s3helper = store.s3helper
+        self.bucket = store.bucket
+        self.layout = store.layout
+        self.files = {}
+        self.dirty = set()
+        # files flushed by this object, which a listing taken before may not show
+        self.written = set()
+
+    def object_key(self, key):
+        return self.store.object_key(key)
+
+    def exists(self, key, listing=None):
+        return key in self.files or key in self.written or self.store.exists(key, listing)
+
+    def _load(self, key):
+        if key not in self.files:
+            self.files[key] = self.store.read_recs(key)
+        return self.files[key]
+
+    def read_recs(self, key):
+        if key in self.files:
+            return list(self.files[key])
+        return self.store.read_recs(key)
+
+    def read_tail(self, key, n=2):
+        recs = self._load(key)
+        return WorkZoneFileTail(recs[-n:], len(recs))
+
+    def append(self, key, rec, tail=None):
+        if tail is None:
+            self.files[key] = [rec]
+        else:
+            self._load(key).append(rec)
+        self.dirty.add(key)
+
+    def replace_last(self, key, rec, tail):
+        self._load(key)[-1] = rec
+        self.dirty.add(key)
+
+    def flush(self):
+        """
+        Writes every work zone file changed since the last flush, and drops all
+        work zone files from memory.
+
+        Returns:
+            Dictionary of the records of the files written, keyed by key.
+        """
+        flushed = {key: self.files[key] for key in sorted(self.dirty)}
+        for key, recs in flushed.items():
+            self.store.write_recs(key, recs)
+        self.written.update(flushed)
+        self.dirty = set()
+        self.files = {}
+        return flushed
+
+
+RECORD_STORES = {store.layout: store for store in [NdjsonRecordStore, SegmentedRecordStore]}
+
+
+def create_record_store(layout, s3helper, bucket, compression=None, level=None, dedup_headers=False,
+                        header_field_names=(), conditional=False):
+    """
+    Creates the record store for a storage layout.
+
+    Parameters:
+        layout: 'ndjson' or 'segmented'.
+        s3helper: S3Helper object.
+        bucket: Name of the AWS S3 bucket that contains the ITS Work Zone Sandbox.
+        compression: Optional compression of the work zone files, 'gzip' or 'zstd'.
+        level: Optional compression level.
+        dedup_headers: Optional. If True, the store is wrapped in a
+            HeaderDedupRecordStore.
+        header_field_names: Optional field names of feed headers, for dedup_headers.
+        conditional: Optional. If True, work zone files are written with
+            conditional writes (see NdjsonRecordStore).
+    Returns:
+        Record store object.
+    """
+    if layout not in RECORD_STORES:
+        raise ValueError('layout must be one of {}, got {}'.format(sorted(RECORD_STORES), layout))
+    store = RECORD_STORES[layout](s3helper, bucket, compression, level, conditional)
+    if dedup_headers:
+        return HeaderDedupRecordStore(store, header_field_names)
+    return store
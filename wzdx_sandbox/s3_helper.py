@@ -2,13 +2,66 @@
 AWS and AWS S3 Helper functions.
 
 """
-import boto3
 import botocore.exceptions
-import json
+from contextlib import contextmanager
+import hashlib
 import logging
+import random
+import threading
+import time
 import traceback
 import inspect
 
+from wzdx_sandbox import aws_clients, codec
+from wzdx_sandbox.compression import DecompressedStream, compression_for_key, get_compression
+
+
+# S3 requires every part of a multipart upload but the last to be at least 5 MiB
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+# attempts of a conditional read-modify-write before a WriteConflict is raised (see retry_on_conflict)
+DEFAULT_WRITE_ATTEMPTS = 5
+DEFAULT_CONFLICT_DELAY = 0.05
+# error codes of a conditional write whose precondition did not hold, or that raced another conditional write
+CONFLICT_ERROR_CODES = ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409')
+
+
+class WriteConflict(Exception):
+    """
+    Raised by a conditional write (see S3Helper.write_bytes) when the object
+    changed since it was read, or was created by someone else.
+
+    """
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+        super(WriteConflict, self).__init__('s3://{}/{} changed since it was read'.format(bucket, key))
+
+
+def retry_on_conflict(func, max_attempts=DEFAULT_WRITE_ATTEMPTS, delay=DEFAULT_CONFLICT_DELAY):
+    """
+    Runs a read-modify-write until it does not conflict with another writer.
+
+    Parameters:
+        func: Callable taking the attempt number (0 for the first attempt). It
+            should read the objects it writes again on every attempt, and merge
+            its changes with what it read.
+        max_attempts: Optional maximum number of attempts.
+        delay: Optional base delay in seconds before the second attempt. It
+            doubles on every attempt, with jitter, so that writers that
+            conflicted do not retry in lockstep.
+    Returns:
+        Return value of func.
+    Raises:
+        WriteConflict if the last attempt still conflicted.
+    """
+    for attempt in range(max_attempts):
+        try:
+            return func(attempt)
+        except WriteConflict:
+            if attempt == max_attempts - 1:
+                raise
+            time.sleep(delay * (2 ** attempt) * random.uniform(0.5, 1.5))
+
 
 class aws_helper(object):
     """
@@ -37,17 +90,15 @@ class aws_helper(object):
 
     def _create_aws_session(self):
         """
-        Creates AWS session using aws profile name passed in or using aws
-        credentials in environment variables.
+        Gets the AWS session of the aws profile name passed in or of the aws
+        credentials in environment variables. The session is created once per
+        process (see wzdx_sandbox.aws_clients).
 
         Returns:
             AWS session object.
         """
         try:
-            if self.aws_profile:
-                session = boto3.session.Session(profile_name=self.aws_profile)
-            else:
-                session = boto3.session.Session()
+            session = aws_clients.get_session(self.aws_profile)
         except botocore.exceptions.ProfileNotFound:
             self.print_func('Please supply a valid AWS profile name.')
             exit()
@@ -63,22 +114,60 @@ class S3Helper(aws_helper):
     Helper class for connecting to and working with AWS S3.
 
     """
-    def __init__(self, **kwargs):
+    def __init__(self, client=None, max_pool_connections=None, **kwargs):
         """
         Initialization function of the S3Helper class.
 
+        Parameters:
+            client: Optional S3 client to use instead of the shared one (e.g.
+                benchmarks.local_s3.LocalS3Client).
+            max_pool_connections: Optional number of concurrent connections of
+                the S3 client, e.g. the number of worker threads using it.
         """
         super(S3Helper, self).__init__(**kwargs)
-        self.client = self._get_client()
+        self.max_pool_connections = max_pool_connections
+        self.client = client or self._get_client()
+        self._local = threading.local()
 
     def _get_client(self):
         """
-        Creates S3 client.
+        Gets the shared S3 client of the aws profile (see wzdx_sandbox.aws_clients).
 
         Returns:
             AWS S3 client.
         """
-        return self.session.client('s3')
+        return aws_clients.get_client('s3', self.aws_profile, max_pool_connections=self.max_pool_connections)
+
+    def get_client(self, service):
+        """
+        Gets the shared client of another AWS service (e.g. 'lambda') for the
+        aws profile.
+
+        Returns:
+            AWS client.
+        """
+        return aws_clients.get_client(service, self.aws_profile)
+
+    @contextmanager
+    def collect(self, report):
+        """
+        Context manager that records every S3 call made by the current thread
+        within the block to the report (see wzdx_sandbox.ingest_report).
+
+        Parameters:
+            report: Object with an add_s3_call(operation, bytes_read, bytes_written) method.
+        """
+        previous = getattr(self._local, 'report', None)
+        self._local.report = report
+        try:
+            yield report
+        finally:
+            self._local.report = previous
+
+    def _record_call(self, operation, bytes_read=0, bytes_written=0):
+        report = getattr(self._local, 'report', None)
+        if report is not None:
+            report.add_s3_call(operation, bytes_read=bytes_read, bytes_written=bytes_written)
 
     def path_exists(self, bucket, path):
         """
@@ -92,6 +181,7 @@ class S3Helper(aws_helper):
             Boolean (True/False)
         """
         try:
+            self._record_call('head_object')
             self.client.head_object(Bucket=bucket, Key=path)
             return True
         except self.client.exceptions.NoSuchKey:
@@ -101,24 +191,144 @@ class S3Helper(aws_helper):
             self.print_func("ClientError caught, assuming path does not exist.")
             return False
 
+    def get_etag(self, bucket, key):
+        """
+        Returns the ETag of an object, or None if it does not exist.
+
+        """
+        try:
+            self._record_call('head_object')
+            return self.client.head_object(Bucket=bucket, Key=key)['ETag']
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def list_prefix(self, bucket, prefix, delimiter=None):
+        """
+        List all objects under an S3 prefix with paginated list_objects_v2 calls.
+        One listing answers existence for every key under the prefix, instead
+        of a HEAD request per key.
+
+        Parameters:
+            bucket: name of S3 bucket
+            prefix: S3 key prefix
+            delimiter: Optional delimiter (e.g. '/'). If given, objects nested
+                deeper than the prefix are not listed.
+
+        Returns:
+            Dictionary keyed by S3 key, with the 'ETag', 'Size' and 'LastModified'
+            of each object.
+        """
+        listing = {}
+        kwargs = {'Bucket': bucket, 'Prefix': prefix}
+        if delimiter:
+            kwargs['Delimiter'] = delimiter
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**kwargs):
+            self._record_call('list_objects_v2')
+            for obj in page.get('Contents', []):
+                listing[obj['Key']] = {
+                    'ETag': obj['ETag'],
+                    'Size': obj['Size'],
+                    'LastModified': obj['LastModified']
+                }
+        return listing
+
     def get_data_stream(self, bucket, key):
         """
-        Get data stream.
+        Get data stream. Compressed objects (see wzdx_sandbox.compression),
+        recognized by their Content-Encoding or key extension, are decompressed
+        as the stream is read.
 
         Parameters:
             bucket: name of S3 bucket
             path: key of S3 path
 
         Returns:
-            "Readable" file datastream objects
+            "Readable" file datastream objects, in bytes
+        """
+        obj = self.client.get_object(Bucket=bucket, Key=key)
+        self._record_call('get_object', bytes_read=obj.get('ContentLength', 0))
+        compression = compression_for_key(key, obj.get('ContentEncoding'))
+        if compression is not None:
+            return DecompressedStream(obj['Body'], compression)
+        return obj['Body']
+
+    def get_bytes(self, bucket, key):
+        """
+        Reads a whole object, decompressed, along with its ETag, e.g. to write
+        it back with a conditional write.
+
+        Returns:
+            Tuple of (bytes, ETag).
         """
         obj = self.client.get_object(Bucket=bucket, Key=key)
-        if key[-3:] == '.gz':
-            gzipped = GzipFile(None, 'rb', fileobj=obj['Body'])
-            data = TextIOWrapper(gzipped)
-        else:
-            data = obj['Body']
-        return data
+        self._record_call('get_object', bytes_read=obj.get('ContentLength', 0))
+        compression = compression_for_key(key, obj.get('ContentEncoding'))
+        body = DecompressedStream(obj['Body'], compression) if compression is not None else obj['Body']
+        return body.read(), obj['ETag']
+
+    def get_tail_recs(self, bucket, key, n=2, window=65536, with_etag=False):
+        """
+        Reads the last n records of a newline JSON object with a ranged GET of
+        the final bytes of the object, instead of downloading and parsing the
+        whole object. The range is doubled until it holds n complete records or
+        the whole object. Compressed objects cannot be read by range, so they
+        are read and decompressed whole.
+
+        Parameters:
+            bucket: name of S3 bucket
+            key: key of S3 path
+            n: number of records to read from the end of the object
+            window: initial number of bytes to read from the end of the object
+            with_etag: Optional. If True, the ETag of the object read is
+                returned too.
+
+        Returns:
+            Tuple of (array of the last n dictionary objects, oldest first; byte
+            offset of the start of each of these records in the object; the
+            bytes of the whole object if they were all read, otherwise None),
+            and the ETag if with_etag is True. Offsets and bytes are those of
+            the decompressed content.
+        """
+        compressed = compression_for_key(key) is not None
+        etag = None
+        while True:
+            if compressed:
+                chunk, etag = self.get_bytes(bucket, key)
+                start = 0
+            else:
+                obj = self.client.get_object(Bucket=bucket, Key=key, Range='bytes=-{}'.format(window))
+                self._record_call('get_object', bytes_read=obj.get('ContentLength', 0))
+                if etag is not None and obj['ETag'] != etag:
+                    # the object was replaced between two reads: start over from the new one
+                    etag = None
+                    continue
+                etag = obj['ETag']
+                chunk = obj['Body'].read()
+                start = 0
+                content_range = obj.get('ContentRange')
+                if content_range:
+                    # e.g. 'bytes 100-199/200'
+                    start = int(content_range.split(' ')[1].split('-')[0])
+            lines = []
+            offset = start
+            for line in chunk.split(b'\n'):
+                lines.append((offset, line))
+                offset += len(line) + 1
+            if start > 0:
+                # the first line may have been cut off by the range
+                lines = lines[1:]
+            lines = [(offset, line) for offset, line in lines if line.strip()]
+            if len(lines) >= n or start == 0:
+                lines = lines[-n:]
+                recs = [codec.loads(line) for _, line in lines]
+                offsets = [offset for offset, _ in lines]
+                if with_etag:
+                    return recs, offsets, chunk if start == 0 else None, etag
+                return recs, offsets, chunk if start == 0 else None
+            window *= 2
 
     def newline_json_rec_generator(self, data_stream):
         """
@@ -141,7 +351,7 @@ class S3Helper(aws_helper):
 
             try:
                 if line_stripped:
-                    yield json.loads(line_stripped)
+                    yield codec.loads(line_stripped)
             except:
                 self.print_func(traceback.format_exc())
                 self.print_func('Invalid json line. Skipping: {}'.format(line))
@@ -149,7 +359,7 @@ class S3Helper(aws_helper):
                 raise
             line = data_stream.readline()
 
-    def write_recs(self, recs, bucket, key):
+    def write_recs(self, recs, bucket, key, compression=None, level=None, if_match=None, if_none_match=False):
         """
         Writes the array of dictionary objects as newline json text file to the
         specified S3 key in the specified S3 bucket
@@ -158,18 +368,23 @@ class S3Helper(aws_helper):
             recs: array of dictionary objects
             bucket: name of S3 bucket
             path: key of S3 path
+            compression: Optional compression of the object, 'gzip' or 'zstd'
+                (see wzdx_sandbox.compression).
+            level: Optional compression level.
+            if_match, if_none_match: Optional conditions of the write, see write_bytes.
 
         Returns:
-            None
+            Response of the put_object call.
         """
         json_list = []
         for i in recs:
             if i is not None and not inspect.isfunction(i):
-                json_list.append(json.dumps(i))
-        outbytes = "\n".join(json_list).encode('utf-8')
-        self.client.put_object(Bucket=bucket, Key=key, Body=outbytes)
+                json_list.append(codec.dumps_record(i))
+        outbytes = b'\n'.join(json_list)
+        return self.write_bytes(outbytes, bucket, key, compression=compression, level=level,
+            if_match=if_match, if_none_match=if_none_match)
 
-    def write_bytes(self, outbytes, bucket, key):
+    def write_bytes(self, outbytes, bucket, key, compression=None, level=None, if_match=None, if_none_match=False):
         """
         Writes the bytes to the specified S3 key in the specified S3 bucket
 
@@ -177,10 +392,116 @@ class S3Helper(aws_helper):
             outbytes: bytes
             bucket: name of S3 bucket
             path: key of S3 path
+            compression: Optional compression of the object, 'gzip' or 'zstd'
+                (see wzdx_sandbox.compression). The object's Content-Encoding is
+                set accordingly. The key is used as is, so it should already
+                have the extension of the compression.
+            level: Optional compression level.
+            if_match: Optional ETag. If given, the object is only written if
+                its current ETag is still this one.
+            if_none_match: Optional. If True, the object is only written if it
+                does not exist yet.
 
         Returns:
-            None
+            Response of the put_object call.
+        Raises:
+            WriteConflict if a condition did not hold.
         """
         if type(outbytes) != bytes:
             outbytes = outbytes.encode('utf-8')
-        self.client.put_object(Bucket=bucket, Key=key, Body=outbytes)
+        kwargs = {}
+        compression = get_compression(compression)
+        if compression is not None:
+            outbytes = compression.compress(outbytes, level)
+            kwargs['ContentEncoding'] = compression.content_encoding
+        if if_match:
+            kwargs['IfMatch'] = if_match
+        if if_none_match:
+            kwargs['IfNoneMatch'] = '*'
+        self._record_call('put_object', bytes_written=len(outbytes))
+        try:
+            return self.client.put_object(Bucket=bucket, Key=key, Body=outbytes, **kwargs)
+        except botocore.exceptions.ClientError as e:
+            if kwargs.keys() & {'IfMatch', 'IfNoneMatch'} and e.response.get('Error', {}).get('Code') in CONFLICT_ERROR_CODES:
+                raise WriteConflict(bucket, key) from e
+            raise
+
+    def write_stream(self, chunks, bucket, key, compression=None, level=None, part_size=DEFAULT_PART_SIZE,
+                     commit=None):
+        """
+        Writes a stream of bytes to the specified S3 key in the specified S3
+        bucket with a multipart upload, so that memory use is bounded by the
+        part size rather than the size of the content. Content that fits in one
+        part is written with a single put_object call.
+
+        Parameters:
+            chunks: Iterable of bytes (e.g. requests.Response.iter_content()).
+            bucket: name of S3 bucket
+            key: key of S3 path
+            compression: Optional compression of the object, 'gzip' or 'zstd'
+                (see wzdx_sandbox.compression), applied as the content streams.
+            level: Optional compression level.
+            part_size: Optional size in bytes of each uploaded part, at least 5 MiB.
+            commit: Optional function called with the SHA-256 hex digest of the
+                content once all of it has been read. If it returns False, the
+                upload is abandoned and nothing is written.
+
+        Returns:
+            Dictionary object with the 'sha256' and number of bytes ('n_bytes')
+            of the content, the number of bytes of the object ('n_bytes_written'),
+            whether the object was written ('committed'), and its 'ETag'.
+        """
+        compression = get_compression(compression)
+        compressor = compression.compressobj(level) if compression is not None else None
+        kwargs = {'ContentEncoding': compression.content_encoding} if compression is not None else {}
+        hasher = hashlib.sha256()
+        n_bytes = 0
+        n_bytes_written = 0
+        buf = bytearray()
+        parts = []
+        upload_id = None
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                hasher.update(chunk)
+                n_bytes += len(chunk)
+                buf += compressor.compress(chunk) if compressor is not None else chunk
+                if len(buf) >= part_size:
+                    if upload_id is None:
+                        self._record_call('create_multipart_upload')
+                        upload_id = self.client.create_multipart_upload(Bucket=bucket, Key=key, **kwargs)['UploadId']
+                    parts.append(self._upload_part(bucket, key, upload_id, len(parts) + 1, bytes(buf)))
+                    n_bytes_written += len(buf)
+                    buf = bytearray()
+            if compressor is not None:
+                buf += compressor.flush()
+            n_bytes_written += len(buf)
+            result = {'sha256': hasher.hexdigest(), 'n_bytes': n_bytes, 'n_bytes_written': n_bytes_written,
+                      'committed': True, 'ETag': None}
+            if commit is not None and not commit(result['sha256']):
+                result['committed'] = False
+                return result
+            if upload_id is None:
+                self._record_call('put_object', bytes_written=len(buf))
+                response = self.client.put_object(Bucket=bucket, Key=key, Body=bytes(buf), **kwargs)
+            else:
+                if buf:
+                    parts.append(self._upload_part(bucket, key, upload_id, len(parts) + 1, bytes(buf)))
+                self._record_call('complete_multipart_upload')
+                response = self.client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                    MultipartUpload={'Parts': parts})
+                upload_id = None
+            result['ETag'] = response.get('ETag')
+            return result
+        finally:
+            if upload_id is not None:
+                # failed or abandoned uploads would otherwise keep their parts, and be billed for them
+                self._record_call('abort_multipart_upload')
+                self.client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+
+    def _upload_part(self, bucket, key, upload_id, part_number, body):
+        self._record_call('upload_part', bytes_written=len(body))
+        response = self.client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+            PartNumber=part_number, Body=body)
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
@@ -0,0 +1,334 @@
+"""
+Sync of parsed WZDx feeds to their Socrata datasets. Socrata datasets only hold
+the current feed, so a dataset is updated with the flattened feed whenever the
+feed is newer than the dataset, either by replacing it through a new draft
+('full' mode) or by upserting only the rows that changed since the last sync
+('incremental' mode).
+
+sandbox_exporter is imported on first use, so that this module can be imported
+where sandbox_exporter is not installed (e.g. by the lake lambda).
+
+"""
+from wzdx_sandbox import codec
+from wzdx_sandbox.executor import create_executor, run_tasks
+from wzdx_sandbox.record_diff import canonical_hash
+from wzdx_sandbox.spec_registry import get_spec, resolve_feed
+from wzdx_sandbox.socrata_watermark import DEFAULT_WATERMARK_TTL, is_expired, make_watermark
+
+
+SYNC_MODES = ('full', 'incremental')
+DEFAULT_ROW_ID_FIELD = 'road_event_id'
+DEFAULT_UPSERT_BATCH_SIZE = 1000
+DEFAULT_MAX_UPSERT_WORKERS = 4
+
+
+def get_flattener_class(feed):
+    """
+    Returns the sandbox_exporter flattener class of a feed's spec version.
+
+    """
+    spec = get_spec(feed)
+    if spec.socrata_flattener_name is None:
+        raise ValueError('Feeds of spec version {} cannot be flattened for Socrata'.format(feed['version']))
+    from sandbox_exporter import flattener_wzdx
+    return getattr(flattener_wzdx, spec.socrata_flattener_name)
+
+
+def get_feed_update_time(feed, data):
+    """
+    Returns the update time of a parsed feed, to the second.
+
+    """
+    return resolve_feed(feed, data).update_time[:19]
+
+
+def get_record_update_field(feed):
+    """
+    Returns the column of the feed update time in the Socrata dataset of a feed.
+
+    """
+    return get_spec(feed).socrata_update_field
+
+
+def get_dataset(feed, socrata_params):
+    from sandbox_exporter.socrata_util import SocrataDataset
+    return SocrataDataset(dataset_id=feed['socratadatasetid'], socrata_params=socrata_params)
+
+
+def refresh_watermark(feed, watermarks=None, socrata_params=None, dataset=None, watermark=None):
+    """
+    Reads the watermark of a feed's dataset from Socrata, from its most recent
+    row, and stores it.
+
+    Parameters:
+        feed: Dictionary object of the feed registry record.
+        watermarks: Optional watermark store (see wzdx_sandbox.socrata_watermark).
+        socrata_params: Dictionary object of the Socrata credentials. Not needed
+            if dataset is given.
+        dataset: Optional sandbox_exporter SocrataDataset object of the feed's dataset.
+        watermark: Optional previous watermark of the dataset, whose content
+            hash is kept if the dataset still holds the same feed.
+    Returns:
+        Watermark dictionary object, or None if the dataset is empty.
+    """
+    dataset_id = feed['socratadatasetid']
+    if dataset is None:
+        dataset = get_dataset(feed, socrata_params)
+    update_field = get_record_update_field(feed)
+    recs = dataset.client.get(dataset_id, limit=1, order='{} DESC'.format(update_field))
+    if not recs:
+        return None
+    update_time = recs[0][update_field][:19]
+    sha256 = watermark['sha256'] if watermark and watermark['update_time'] == update_time else None
+    watermark = make_watermark(update_time, sha256)
+    if watermarks is not None:
+        watermarks.put(dataset_id, watermark)
+    return watermark
+
+
+class SocrataDigestIndex(object):
+    """
+    Index of the hash of every row last synced to a Socrata dataset, keyed by
+    row identifier, stored as a single JSON object at
+    '<prefix>datasetId=<dataset_id>/_row_digests.json'.
+
+    """
+    index_name = '_row_digests.json'
+
+    def __init__(self, s3helper, bucket, dataset_id, prefix='socrata/'):
+        """
+        Initialization function of the SocrataDigestIndex class.
+
+        Parameters:
+            s3helper: S3Helper object.
+            bucket: Name of the AWS S3 bucket the index is kept in, which should
+                not be a public bucket.
+            dataset_id: Socrata dataset id.
+            prefix: Optional prefix of the index key.
+        """
+        self.s3helper = s3helper
+        self.bucket = bucket
+        self.key = '{}datasetId={}/{}'.format(prefix, dataset_id, self.index_name)
+        self.digests = None
+
+    def load(self):
+        """
+        Loads the index. digests is None if the dataset was never synced
+        with an index.
+
+        Returns:
+            The SocrataDigestIndex object.
+        """
+        try:
+            datastream = self.s3helper.get_data_stream(self.bucket, self.key)
+        except self.s3helper.client.exceptions.NoSuchKey:
+            self.digests = None
+            return self
+        self.digests = codec.loads(datastream.read())
+        return self
+
+    def save(self, digests):
+        """
+        Writes the hash of every row synced. None marks the dataset as
+        needing a full replace on its next sync.
+
+        """
+        self.digests = digests
+        self.s3helper.write_bytes(codec.dumps(digests, sort_keys=True), self.bucket, self.key)
+
+
+def get_row_digests(recs, row_id_field=DEFAULT_ROW_ID_FIELD):
+    """
+    Returns the hash of each flattened record, keyed by row identifier.
+
+    Raises:
+        ValueError if a record has no row identifier, or if two records have
+        the same one.
+    """
+    digests = {}
+    for rec in recs:
+        row_id = rec.get(row_id_field)
+        if row_id is None:
+            raise ValueError('Record without {}'.format(row_id_field))
+        if row_id in digests:
+            raise ValueError('More than one record with {} {}'.format(row_id_field, row_id))
+        digests[row_id] = canonical_hash(rec)
+    return digests
+
+
+def compute_delta(recs, digests, previous_digests, row_id_field=DEFAULT_ROW_ID_FIELD):
+    """
+    Compares flattened records with the rows last synced.
+
+    Parameters:
+        recs: Array of flattened records.
+        digests: Dictionary of the hash of each record, as returned by get_row_digests.
+        previous_digests: Dictionary of the hash of each row last synced.
+        row_id_field: Optional name of the row identifier column.
+    Returns:
+        Tuple of the array of added or updated records, and the sorted array of
+        identifiers of deleted rows.
+    """
+    upserts = [rec for rec in recs if previous_digests.get(rec[row_id_field]) != digests[rec[row_id_field]]]
+    deleted_ids = sorted(row_id for row_id in previous_digests if row_id not in digests)
+    return upserts, deleted_ids
+
+
+def apply_delta(dataset, dataset_id, upserts, deleted_ids, row_id_field=DEFAULT_ROW_ID_FIELD,
+                batch_size=DEFAULT_UPSERT_BATCH_SIZE, max_workers=DEFAULT_MAX_UPSERT_WORKERS):
+    """
+    Upserts added and updated records, and deletes removed rows, in batches
+    sent concurrently to the published dataset.
+
+    Parameters:
+        dataset: sandbox_exporter SocrataDataset object.
+        dataset_id: Socrata dataset id.
+        upserts: Array of added or updated flattened records.
+        deleted_ids: Array of row identifiers of deleted rows.
+        row_id_field: Optional name of the row identifier column.
+        batch_size: Optional number of rows per upsert request.
+        max_workers: Optional maximum number of upsert requests sent at the same time.
+    Returns:
+        Array of the responses of each batch.
+    Raises:
+        TaskFailures if any batch failed, after all others were sent.
+    """
+    def upsert(batch):
+        return dataset.clean_and_upsert(batch, dataset_id)
+
+    def delete(batch):
+        return dataset.client.upsert(dataset_id, [{row_id_field: row_id, ':deleted': True} for row_id in batch])
+
+    tasks = []
+    task_ids = []
+    for func, rows, name in [(upsert, upserts, 'upsert'), (delete, deleted_ids, 'delete')]:
+        for i in range(0, len(rows), batch_size):
+            tasks.append((func, rows[i:i+batch_size]))
+            task_ids.append('{} rows {}-{}'.format(name, i, min(i+batch_size, len(rows))-1))
+    if not tasks:
+        return []
+    with create_executor('thread', max_workers) as executor:
+        return run_tasks(executor, _call, tasks, task_ids)
+
+
+def _call(func, *args):
+    return func(*args)
+
+
+def sync_feed(feed, data, socrata_params, dataset=None, flattener=None, print_func=print, mode='full',
+              s3helper=None, state_bucket=None, row_id_field=DEFAULT_ROW_ID_FIELD,
+              batch_size=DEFAULT_UPSERT_BATCH_SIZE, max_workers=DEFAULT_MAX_UPSERT_WORKERS,
+              watermarks=None, watermark_ttl=DEFAULT_WATERMARK_TTL, refresh=False):
+    """
+    Updates the Socrata dataset of a feed with the flattened feed, unless the
+    dataset is at least as recent as the feed.
+
+    Parameters:
+        feed: Dictionary object of the feed registry record, with
+            'socratadatasetid' and 'version'.
+        data: Dictionary object of the parsed feed, as returned by
+            WorkZoneSandbox.parse_to_json.
+        socrata_params: Dictionary object of the Socrata credentials.
+        dataset: Optional sandbox_exporter SocrataDataset object of the feed's dataset.
+        flattener: Optional sandbox_exporter flattener object. Defaults to the
+            flattener of the feed's spec version.
+        print_func: Optional function used to log.
+        mode: Optional. 'full' (default) replaces the dataset through a new
+            draft. 'incremental' upserts the added and updated rows and deletes
+            the removed ones on the published dataset, based on the digest
+            index of the rows last synced (see SocrataDigestIndex). It requires
+            the dataset's row identifier to be set to row_id_field, and falls
+            back to 'full' if the dataset has no index yet, or if the feed's
+            rows cannot be identified.
+        s3helper: S3Helper object. Required if mode is 'incremental'.
+        state_bucket: Name of the AWS S3 bucket the digest index is kept in,
+            which should not be a public bucket. Required if mode is 'incremental'.
+        row_id_field: Optional name of the row identifier column.
+        batch_size: Optional number of rows per upsert request.
+        max_workers: Optional maximum number of upsert requests sent at the same time.
+        watermarks: Optional watermark store (see wzdx_sandbox.socrata_watermark).
+            If given, the dataset is considered up to date, without querying
+            Socrata, if its watermark is at least as recent as the feed or has
+            the same content hash. If not given, Socrata is queried every time.
+        watermark_ttl: Optional number of seconds after which a watermark is
+            read from Socrata again, in case the dataset was changed by another
+            process.
+        refresh: Optional. If True, the watermark is read from Socrata first.
+    Returns:
+        String outcome: 'stale' if the dataset is already up to date, 'empty'
+        if the feed has no records, 'published' if the dataset was replaced,
+        'unchanged' if no row changed since the last incremental sync, or
+        'updated' if only the changed rows were sent.
+    """
+    if mode not in SYNC_MODES:
+        raise ValueError('mode must be one of {}, got {}'.format(SYNC_MODES, mode))
+    if flattener is None:
+        flattener = get_flattener_class(feed)()
+    current_updated_time = get_feed_update_time(feed, data)
+
+    # check if socrata data is stale
+    # section does not work for wzdx v1 feeds
+    dataset_id = feed['socratadatasetid']
+    digest = None
+    watermark = None
+    if watermarks is not None:
+        digest = canonical_hash(data)
+        watermark = watermarks.get(dataset_id)
+    if watermark is None or refresh or is_expired(watermark, watermark_ttl):
+        if dataset is None:
+            dataset = get_dataset(feed, socrata_params)
+        watermark = refresh_watermark(feed, watermarks, dataset=dataset, watermark=watermark)
+    if watermark is not None:
+        if not current_updated_time > watermark['update_time'] or (digest is not None and digest == watermark['sha256']):
+            print_func('No update needed - feed has not been updated since {}'.format(watermark['update_time']))
+            return 'stale'
+
+    # feed content is newer than what is in Socrata
+    flattened_recs = flattener.process_and_split(data)
+    if not flattened_recs:
+        print_func('No records in feed - will not update Socrata dataset')
+        return 'empty'
+
+    if dataset is None:
+        dataset = get_dataset(feed, socrata_params)
+    index = None
+    digests = None
+    if mode == 'incremental':
+        if s3helper is None or state_bucket is None:
+            raise ValueError('s3helper and state_bucket are required for incremental sync')
+        index = SocrataDigestIndex(s3helper, state_bucket, dataset_id).load()
+        try:
+            digests = get_row_digests(flattened_recs, row_id_field)
+        except ValueError as e:
+            print_func('Cannot sync {} incrementally ({}) - will replace the dataset'.format(dataset_id, e))
+
+    if index is not None and index.digests is not None and digests is not None:
+        upserts, deleted_ids = compute_delta(flattened_recs, digests, index.digests, row_id_field)
+        if not upserts and not deleted_ids:
+            print_func('No rows changed since the last sync of dataset {}'.format(dataset_id))
+            outcome = 'unchanged'
+        else:
+            apply_delta(dataset, dataset_id, upserts, deleted_ids, row_id_field, batch_size, max_workers)
+            index.save(digests)
+            print_func('{} rows upserted and {} rows deleted in dataset {}.'.format(
+                len(upserts), len(deleted_ids), dataset_id))
+            outcome = 'updated'
+        _save_watermark(watermarks, dataset_id, current_updated_time, digest)
+        return outcome
+
+    working_id = dataset.create_new_draft()
+    response = dataset.clean_and_upsert(flattened_recs, working_id)
+    print_func(response)
+    dataset.publish_draft(working_id)
+    print_func('New draft for dataset {} published.'.format(working_id))
+    if index is not None:
+        # later syncs send only the rows that changed since this one, or replace
+        # the dataset again if its rows could not be identified (digests is None)
+        index.save(digests)
+    _save_watermark(watermarks, dataset_id, current_updated_time, digest)
+    return 'published'
+
+
+def _save_watermark(watermarks, dataset_id, update_time, digest):
+    if watermarks is not None:
+        watermarks.put(dataset_id, make_watermark(update_time, digest))
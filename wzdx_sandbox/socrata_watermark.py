@@ -0,0 +1,126 @@
+"""
+Per dataset watermarks of the last feed published to Socrata: its update time
+and content hash, and when the watermark was last checked against the dataset.
+Deciding whether a dataset is stale then takes one small read instead of a
+Socrata query.
+
+Watermarks are kept in S3 (S3WatermarkStore) or in a local directory
+(LocalWatermarkStore), one small JSON object per dataset.
+
+"""
+import os
+import time
+
+from wzdx_sandbox import codec
+
+
+# seconds after which a watermark is checked against the dataset again
+DEFAULT_WATERMARK_TTL = 3600
+
+
+def make_watermark(update_time, sha256=None, checked_at=None):
+    """
+    Builds a watermark.
+
+    Parameters:
+        update_time: Update time of the feed in the dataset, to the second.
+        sha256: Optional canonical hash of the parsed feed (see
+            wzdx_sandbox.record_diff.canonical_hash), if known.
+        checked_at: Optional epoch time the watermark was known to match the
+            dataset. Defaults to now.
+    Returns:
+        Dictionary object {'update_time', 'sha256', 'checked_at'}.
+    """
+    return {'update_time': update_time, 'sha256': sha256,
+            'checked_at': time.time() if checked_at is None else checked_at}
+
+
+def is_expired(watermark, ttl=DEFAULT_WATERMARK_TTL):
+    return time.time() - watermark['checked_at'] >= ttl
+
+
+class S3WatermarkStore(object):
+    """
+    Watermarks stored at '<prefix>datasetId=<dataset_id>/_watermark.json'.
+
+    """
+    watermark_name = '_watermark.json'
+
+    def __init__(self, s3helper, bucket, prefix='socrata/'):
+        """
+        Initialization function of the S3WatermarkStore class.
+
+        Parameters:
+            s3helper: S3Helper object.
+            bucket: Name of the AWS S3 bucket the watermarks are kept in, which
+                should not be a public bucket.
+            prefix: Optional prefix of the watermark keys in the bucket.
+        """
+        self.s3helper = s3helper
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def key(self, dataset_id):
+        return '{}datasetId={}/{}'.format(self.prefix, dataset_id, self.watermark_name)
+
+    def get(self, dataset_id):
+        """
+        Returns the watermark of a dataset, or None if it has none.
+
+        """
+        try:
+            datastream = self.s3helper.get_data_stream(self.bucket, self.key(dataset_id))
+        except self.s3helper.client.exceptions.NoSuchKey:
+            return None
+        return codec.loads(datastream.read())
+
+    def put(self, dataset_id, watermark):
+        self.s3helper.write_bytes(codec.dumps(watermark, sort_keys=True), self.bucket, self.key(dataset_id))
+
+
+class LocalWatermarkStore(object):
+    """
+    Watermarks stored as '<dataset_id>.json' files in a local directory, e.g.
+    for self-hosted deployments.
+
+    """
+    def __init__(self, path):
+        """
+        Parameters:
+            path: Path of the directory the watermarks are kept in. It is
+                created if it does not exist.
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def get(self, dataset_id):
+        try:
+            with open(os.path.join(self.path, dataset_id + '.json'), 'rb') as in_f:
+                return codec.loads(in_f.read())
+        except FileNotFoundError:
+            return None
+
+    def put(self, dataset_id, watermark):
+        path = os.path.join(self.path, dataset_id + '.json')
+        # written to a temporary file first, so that a reader never sees a partial watermark
+        with open(path + '.tmp', 'wb') as out_f:
+            out_f.write(codec.dumps(watermark, sort_keys=True))
+        os.replace(path + '.tmp', path)
+
+
+def create_watermark_store(url, s3helper=None):
+    """
+    Creates a watermark store from its URL: 's3://<bucket>/<prefix>' for an
+    S3WatermarkStore, and 'file://<path>' or a path for a LocalWatermarkStore.
+
+    """
+    if url.startswith('s3://'):
+        bucket, _, prefix = url[len('s3://'):].partition('/')
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        if s3helper is None:
+            raise ValueError('An S3Helper is required for watermarks in S3')
+        return S3WatermarkStore(s3helper, bucket, prefix or 'socrata/')
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    return LocalWatermarkStore(url)
@@ -0,0 +1,347 @@
+"""
+Per feed-month spatio-temporal index of the work zone statuses in the ITS Work
+Zone Sandbox, so that "which work zones were active in this bounding box
+between these times" reads a few small index objects and only the work zone
+files that match, instead of every work zone file of the feed.
+
+The index of a feed-month is kept in one JSON object per day of the month, at
+'<prefix>_spatial_index/<day>.json', holding, for each work zone file, one
+entry per status updated that day (UTC):
+
+    [record offset, min x, min y, max x, max y, start time, end time, update time]
+
+with times in seconds since the epoch. An ingest reads and rewrites only the
+shards of the days of its statuses, usually one, so its cost does not grow
+over the month. The bounding box comes from the GeoJSON
+geometry, or from the begin and end locations of v1 feeds (see
+SpecVersion.get_bbox). It is kept up to date as a side effect of
+WorkZoneSandbox.ingest when the sandbox is created with use_spatial_index=True.
+
+"""
+import calendar
+from datetime import datetime, timedelta
+import threading
+
+import dateutil.parser
+import dateutil.tz
+
+from wzdx_sandbox import codec
+from wzdx_sandbox.s3_helper import retry_on_conflict
+
+
+def to_epoch(value):
+    """
+    Returns the seconds since the epoch of a datetime or ISO 8601 time string.
+    Times without a UTC offset are taken as UTC. Returns None for times that
+    cannot be parsed.
+
+    """
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        try:
+            value = dateutil.parser.parse(value)
+        except (ValueError, TypeError, OverflowError):
+            return None
+    if value.tzinfo is not None:
+        value = value.astimezone(dateutil.tz.tzutc())
+    return calendar.timegm(value.timetuple())
+
+
+def make_entry(spec, activity, update_time):
+    """
+    Builds the index entry of an activity, without its record offset.
+
+    Parameters:
+        spec: SpecVersion object of the feed version of the activity.
+        activity: Dictionary object of the work zone activity.
+        update_time: Update time of the feed the activity was read from.
+    Returns:
+        Array of [min x, min y, max x, max y, start time, end time, update time].
+    """
+    bbox = spec.get_bbox(activity) or (None, None, None, None)
+    return list(bbox) + [to_epoch(_get(spec.get_start_time, activity)), to_epoch(_get(spec.get_end_time, activity)),
+                         to_epoch(update_time)]
+
+
+def _get(getter, activity):
+    try:
+        return getter(activity)
+    except (KeyError, TypeError, IndexError):
+        return None
+
+
+def _matches(entry, bbox, start, end):
+    _, min_x, min_y, max_x, max_y, entry_start, entry_end, _ = entry
+    if bbox is not None:
+        if min_x is None or min_x > bbox[2] or max_x < bbox[0] or min_y > bbox[3] or max_y < bbox[1]:
+            return False
+    # statuses without a start or end time are taken as open ended
+    if end is not None and entry_start is not None and entry_start > end:
+        return False
+    if start is not None and entry_end is not None and entry_end < start:
+        return False
+    return True
+
+
+def month_prefixes(prefix_template, feed, start, end):
+    """
+    Returns the feed-month prefixes of a feed, from the month of start to the
+    month of end.
+
+    """
+    start = datetime.utcfromtimestamp(to_epoch(start)).date().replace(day=1)
+    end = datetime.utcfromtimestamp(to_epoch(end)).date()
+    prefixes = []
+    month = start
+    while month <= end:
+        prefixes.append(prefix_template.format(**feed, year=month.strftime('%Y'), month=month.strftime('%m')))
+        month = (month + timedelta(days=32)).replace(day=1)
+    return prefixes
+
+
+class _IndexShard(object):
+    """
+    One day of a feed-month index: a single JSON object holding the entries of
+    the statuses of that day, keyed by work zone file name.
+
+    """
+    def __init__(self, s3helper, bucket, key, conditional=False):
+        self.s3helper = s3helper
+        self.bucket = bucket
+        self.key = key
+        self.conditional = conditional
+        self.entries = {}
+        # ETag and entries of the shard as loaded, and the files updated since, to merge on a conflict
+        self.etag = None
+        self.loaded = {}
+        self.updated = set()
+        self.dirty = False
+
+    def load(self):
+        self.entries, self.etag, self.loaded = {}, None, {}
+        try:
+            data, self.etag = self.s3helper.get_bytes(self.bucket, self.key)
+        except self.s3helper.client.exceptions.NoSuchKey:
+            return self
+        self.entries = codec.loads(data)
+        self.loaded = codec.loads(data)
+        return self
+
+    def save(self):
+        if not self.dirty:
+            return
+        if self.conditional:
+            response = retry_on_conflict(self._save_conditionally)
+            self.etag = response.get('ETag')
+        else:
+            self.s3helper.write_bytes(codec.dumps(self.entries, sort_keys=True), self.bucket, self.key)
+        self.loaded, self.updated = codec.loads(codec.dumps(self.entries)), set()
+        self.dirty = False
+
+    def _save_conditionally(self, attempt):
+        if attempt:
+            self._merge_saved()
+        return self.s3helper.write_bytes(codec.dumps(self.entries, sort_keys=True), self.bucket, self.key,
+            if_match=self.etag, if_none_match=self.etag is None)
+
+    def _merge_saved(self):
+        # another ingest saved the shard since it was loaded: keep its entries, and this one's for the files
+        # only this one wrote. The entries of files both wrote are combined with unknown offsets, so that
+        # query_index checks every record of these files.
+        try:
+            data, etag = self.s3helper.get_bytes(self.bucket, self.key)
+            saved = codec.loads(data)
+        except self.s3helper.client.exceptions.NoSuchKey:
+            saved, etag = {}, None
+        entries = dict(saved)
+        for name in self.updated:
+            ours = self.entries.get(name, [])
+            if saved.get(name) == self.loaded.get(name):
+                entries[name] = ours
+            else:
+                theirs = saved.get(name, [])
+                entries[name] = [[None] + entry[1:] for entry in theirs + [e for e in ours if e not in theirs]]
+        self.entries, self.etag = entries, etag
+
+
+class FeedSpatialIndex(object):
+    """
+    Spatio-temporal index of all work zone files under one feed-month prefix,
+    kept in one shard per day (see _shard_name).
+
+    """
+    index_name = '_spatial_index/'
+
+    def __init__(self, s3helper, bucket, prefix, conditional=False):
+        """
+        Initialization function of the FeedSpatialIndex class.
+
+        Parameters:
+            s3helper: S3Helper object.
+            bucket: Name of the AWS S3 bucket that contains the ITS Work Zone Sandbox.
+            prefix: Feed-month prefix of the work zone files
+                (state={state}/feedName={feedname}/year={year}/month={month}/).
+            conditional: Optional. If True, shards are saved with a conditional
+                write, and merged with the shard saved by another ingest if it
+                changed since it was loaded.
+        """
+        self.s3helper = s3helper
+        self.bucket = bucket
+        self.prefix = prefix
+        self.conditional = conditional
+        self.shards = {}
+        self._lock = threading.Lock()
+
+    def _shard(self, name):
+        # shards are read the first time they are needed
+        if name not in self.shards:
+            self.shards[name] = _IndexShard(self.s3helper, self.bucket,
+                self.prefix + self.index_name + name + '.json', self.conditional).load()
+        return self.shards[name]
+
+    @property
+    def entries(self):
+        """
+        Entries of the loaded shards, keyed by work zone file name, oldest day first.
+
+        """
+        entries = {}
+        for name in sorted(self.shards):
+            for file_name, file_entries in self.shards[name].entries.items():
+                entries.setdefault(file_name, []).extend(file_entries)
+        return entries
+
+    def load(self):
+        """
+        Loads every shard of the index, e.g. to search it.
+
+        Returns:
+            The FeedSpatialIndex object.
+        """
+        self.shards = {}
+        for key in sorted(self.s3helper.list_prefix(self.bucket, self.prefix + self.index_name)):
+            self._shard(key[len(self.prefix + self.index_name):-len('.json')])
+        return self
+
+    def update(self, key, outcome, entry, offset=None):
+        """
+        Records the status just written to a work zone file, in the shard of
+        the day of its update time. Only that shard is read and written.
+
+        Parameters:
+            key: S3 key of the work zone file.
+            outcome: Outcome of the status, 'overwrite', 'new_status' or 'new_fp'.
+            entry: Index entry of the status, as returned by make_entry.
+            offset: Optional record offset of the status in the work zone file.
+                If not given, it follows from the file's entries in the same
+                shard, or is left unknown.
+        """
+        name = key[len(self.prefix):]
+        with self._lock:
+            shard = self._shard(_shard_name(entry[6]))
+            entries = shard.entries.setdefault(name, [])
+            if offset is None:
+                if outcome == 'new_fp':
+                    offset = 0
+                elif entries and entries[-1][0] is not None:
+                    offset = entries[-1][0] + (outcome == 'new_status')
+            if outcome == 'overwrite' and entries and entries[-1][0] == offset:
+                entries[-1] = [offset] + entry
+            else:
+                # an overwritten status indexed in an earlier shard is left there; query_index checks the record
+                entries.append([offset] + entry)
+            shard.updated.add(name)
+            shard.dirty = True
+
+    def replace_file(self, key, recs_entries):
+        """
+        Replaces the entries of a whole work zone file, e.g. after a backfill
+        wrote it. The index should be loaded.
+
+        Parameters:
+            key: S3 key of the work zone file.
+            recs_entries: Array of the index entries of the file's records, oldest first.
+        """
+        name = key[len(self.prefix):]
+        with self._lock:
+            for shard in self.shards.values():
+                if shard.entries.pop(name, None) is not None:
+                    shard.updated.add(name)
+                    shard.dirty = True
+            for offset, entry in enumerate(recs_entries):
+                shard = self._shard(_shard_name(entry[6]))
+                shard.entries.setdefault(name, []).append([offset] + entry)
+                shard.updated.add(name)
+                shard.dirty = True
+
+    def save(self):
+        """
+        Writes the shards changed since they were loaded back to S3.
+
+        """
+        for name in sorted(self.shards):
+            self.shards[name].save()
+
+    def search(self, bbox=None, start=None, end=None):
+        """
+        Finds the statuses active in a bounding box during a time range, in the
+        loaded shards.
+
+        Parameters:
+            bbox: Optional (min x, min y, max x, max y) bounding box. Statuses
+                whose bounding box intersects it match.
+            start: Optional time, as a datetime or ISO 8601 string. Statuses
+                that ended before it do not match.
+            end: Optional time. Statuses that started after it do not match.
+        Returns:
+            Dictionary of the matching record offsets, keyed by the S3 key of
+            their work zone file. An offset is None if it is not known.
+        """
+        start, end = to_epoch(start), to_epoch(end)
+        matches = {}
+        for name, entries in self.entries.items():
+            offsets = [entry[0] for entry in entries if _matches(entry, bbox, start, end)]
+            if offsets:
+                matches[self.prefix + name] = offsets
+        return matches
+
+
+def _shard_name(update_time):
+    # the day of the month of the status' update time, '00' if it is not known
+    if update_time is None:
+        return '00'
+    return datetime.utcfromtimestamp(update_time).strftime('%d')
+
+
+def query_index(record_store, s3helper, bucket, prefixes, bbox=None, start=None, end=None, get_entry=None):
+    """
+    Reads the work zone statuses active in a bounding box during a time range
+    from the feed-months of prefixes. Only the index shards of each feed-month
+    and the work zone files with a matching status are read.
+
+    Parameters:
+        record_store: Record store of the work zone files (see wzdx_sandbox.record_store).
+        s3helper: S3Helper object.
+        bucket: Name of the AWS S3 bucket that contains the ITS Work Zone Sandbox.
+        prefixes: Iterable of feed-month prefixes. Feed-months without an index are skipped.
+        bbox, start, end: Optional query, see FeedSpatialIndex.search.
+        get_entry: Optional function returning the index entry of a record
+            (see make_entry), used to check the matching records against the
+            query. If not given, all records of a work zone file whose offsets
+            are not known are returned.
+    Returns:
+        Generator of (S3 key, record offset, record) tuples.
+    """
+    for prefix in prefixes:
+        matches = FeedSpatialIndex(s3helper, bucket, prefix).load().search(bbox, start, end)
+        for key in sorted(matches):
+            recs = record_store.read_recs(key)
+            offsets = matches[key]
+            query = (bbox, to_epoch(start), to_epoch(end))
+            if None in offsets:
+                offsets = range(len(recs))
+            for offset in sorted(set(offsets)):
+                # the entry of an overwritten status may still be in the shard of an earlier day
+                if offset < len(recs) and (get_entry is None or _matches([offset] + get_entry(recs[offset]), *query)):
+                    yield key, offset, recs[offset]
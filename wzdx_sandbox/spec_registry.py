@@ -0,0 +1,312 @@
+"""
+Registry of the feed spec versions the sandboxes can ingest. A spec version
+describes where a feed keeps its header, update time and activity list, and
+how the key fields (identifier and road direction) of an activity are read.
+
+Spec versions are resolved once per feed (see resolve_feed), which returns a
+FeedLayout whose accessors are used for every activity of the feed. New spec
+versions, and other feed types such as WZDx device feeds, are added with
+register_spec, without changes to the sandbox classes:
+
+    class WzdxDeviceSpec(SpecVersion):
+        feed_type = 'wzdx_device'
+        ...
+
+    register_spec(WzdxDeviceSpec(), '4')
+
+"""
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FEED_TYPE = 'wzdx'
+
+# spec versions keyed by (feed type, version), e.g. ('wzdx', '4')
+_specs = {}
+_lock = threading.Lock()
+# (feed type, version) pairs already warned about by get_spec
+_fallbacks_warned = set()
+
+
+def compile_getter(path):
+    """
+    Returns a function reading a nested field, e.g. ('properties', 'direction').
+    Paths of up to three fields are read without a loop.
+
+    """
+    path = tuple(path)
+    if len(path) == 1:
+        a, = path
+        return lambda obj: obj[a]
+    if len(path) == 2:
+        a, b = path
+        return lambda obj: obj[a][b]
+    if len(path) == 3:
+        a, b, c = path
+        return lambda obj: obj[a][b][c]
+
+    def getter(obj):
+        for field in path:
+            obj = obj[field]
+        return obj
+    return getter
+
+
+def _iter_positions(coordinates):
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        yield coordinates
+        return
+    for member in coordinates or []:
+        for position in _iter_positions(member):
+            yield position
+
+
+def _points_bbox(points):
+    points = list(points)
+    if not points:
+        return None
+    xs = [point[0] for point in points]
+    ys = [point[1] for point in points]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def geometry_bbox(geometry):
+    """
+    Returns the (min x, min y, max x, max y) bounding box of a GeoJSON
+    geometry, or None if it is empty.
+
+    """
+    if not geometry:
+        return None
+    if geometry.get('type') == 'GeometryCollection':
+        bboxes = [bbox for bbox in map(geometry_bbox, geometry.get('geometries', [])) if bbox]
+        return _points_bbox([point for bbox in bboxes for point in (bbox[:2], bbox[2:])])
+    return _points_bbox(_iter_positions(geometry.get('coordinates')))
+
+
+class SpecVersion(object):
+    """
+    Base class of spec versions. Subclasses set the field names and key field
+    paths of their version, and may override the methods for fields that
+    cannot be read with a fixed path.
+
+    """
+    feed_type = DEFAULT_FEED_TYPE
+    # field the whole feed is nested in, if any (e.g. 'WZDx')
+    root_field_name = None
+    # candidate header field names, the first one present in the feed is used
+    header_field_names = ()
+    update_time_field_name = None
+    activity_list_field_name = 'features'
+    version_field_name = 'version'
+    # top level fields copied into every record stored
+    copied_field_names = ('type',)
+    identifier_path = ('id',)
+    road_direction_path = ()
+    # start and end times of an activity, kept in the spatio-temporal index
+    start_time_path = ('properties', 'start_date')
+    end_time_path = ('properties', 'end_date')
+    # Socrata: name of the sandbox_exporter.flattener_wzdx class and column of the feed update time
+    socrata_flattener_name = None
+    socrata_update_field = 'update_date'
+
+    def __init__(self):
+        self.get_identifier = compile_getter(self.identifier_path)
+        self.get_road_direction = compile_getter(self.road_direction_path)
+        self.get_start_time = compile_getter(self.start_time_path)
+        self.get_end_time = compile_getter(self.end_time_path)
+
+    def get_bbox(self, activity):
+        """
+        Returns the (min x, min y, max x, max y) bounding box of an activity's
+        GeoJSON geometry, or None if it has none.
+
+        """
+        return geometry_bbox(activity.get('geometry'))
+
+    def get_root(self, data):
+        return data[self.root_field_name] if self.root_field_name else data
+
+    def get_header_field_name(self, root):
+        for name in self.header_field_names:
+            if name in root:
+                return name
+        return self.header_field_names[-1]
+
+    def resolve(self, data):
+        """
+        Returns the FeedLayout of a parsed feed. Only the feed header is
+        needed, the activity list may be missing.
+
+        """
+        return FeedLayout(self, data)
+
+
+class FeedLayout(object):
+    """
+    Fields of one parsed feed, resolved once from its spec version.
+
+    """
+    def __init__(self, spec, data):
+        self.spec = spec
+        self.root = spec.get_root(data)
+        self.header_field_name = spec.get_header_field_name(self.root)
+        self.update_time_field_name = spec.update_time_field_name
+        self.activity_list_field_name = spec.activity_list_field_name
+        self.field_name_tuple = (self.header_field_name, self.update_time_field_name, self.activity_list_field_name)
+        self.header = self.root[self.header_field_name]
+        self.update_time = self.header[self.update_time_field_name]
+        self.feed_version = self.header[spec.version_field_name]
+        # the key fields of activities follow the version the feed declares, if it is registered
+        key_spec = find_spec(spec.feed_type, self.feed_version) or spec
+        self.get_identifier = key_spec.get_identifier
+        self.get_road_direction = key_spec.get_road_direction
+        self.copied_fields = {name: self.root[name] for name in spec.copied_field_names if name in self.root}
+
+    def activities(self):
+        return self.root[self.activity_list_field_name]
+
+    def generate_out_rec(self, activity):
+        """
+        Wraps an activity into the record stored for it: the feed header, a
+        single activity list and the copied top level fields.
+
+        """
+        rec = {self.header_field_name: self.header, self.activity_list_field_name: [activity]}
+        rec.update(self.copied_fields)
+        return rec
+
+
+class WzdxV1Spec(SpecVersion):
+    root_field_name = 'WZDx'
+    header_field_names = ('Header',)
+    update_time_field_name = 'timeStampUpdate'
+    activity_list_field_name = 'WorkZoneActivity'
+    version_field_name = 'versionNo'
+    copied_field_names = ()
+    identifier_path = ('identifier',)
+    road_direction_path = ('beginLocation', 'roadDirection')
+    start_time_path = ('startDateTime',)
+    end_time_path = ('endDateTime',)
+
+    def get_bbox(self, activity):
+        # v1 has no geometry, only the latitude and longitude of the begin and end locations
+        points = []
+        for location_name in ['beginLocation', 'endLocation']:
+            location = activity.get(location_name) or {}
+            try:
+                points.append((float(location['longitude']), float(location['latitude'])))
+            except (KeyError, TypeError, ValueError):
+                continue
+        return _points_bbox(points)
+
+
+class WzdxV2Spec(SpecVersion):
+    header_field_names = ('road_event_feed_info',)
+    update_time_field_name = 'feed_update_date'
+    road_direction_path = ('properties', 'direction')
+    socrata_flattener_name = 'WzdxV2Flattener'
+    socrata_update_field = 'feed_update_date'
+
+    def __init__(self):
+        super(WzdxV2Spec, self).__init__()
+        self.get_identifier = lambda activity: activity['properties'].get('road_event_id') or activity.get('id')
+
+
+class WzdxV3Spec(WzdxV2Spec):
+    update_time_field_name = 'update_date'
+    socrata_flattener_name = 'WzdxV3Flattener'
+    socrata_update_field = 'update_date'
+
+
+class WzdxV4Spec(WzdxV3Spec):
+    # 4.0 kept the v3 header name, 4.1 renamed it
+    header_field_names = ('road_event_feed_info', 'feed_info')
+    road_direction_path = ('properties', 'core_details', 'direction')
+    socrata_flattener_name = 'WzdxV4Flattener'
+
+
+def register_spec(spec, version, feed_type=None):
+    """
+    Registers a spec version.
+
+    Parameters:
+        spec: SpecVersion object.
+        version: Version string, e.g. '4' for all 4.x versions or '4.2' for a
+            single minor version.
+        feed_type: Optional feed type. Defaults to the spec's feed_type.
+    """
+    with _lock:
+        _specs[(feed_type or spec.feed_type, version)] = spec
+
+
+def find_spec(feed_type, version):
+    """
+    Returns the spec registered for the most specific part of version (e.g.
+    '4.2' resolves to '4.2', then '4'), or None.
+
+    """
+    parts = str(version).split('.')
+    for end in range(len(parts), 0, -1):
+        spec = _specs.get((feed_type, '.'.join(parts[:end])))
+        if spec is not None:
+            return spec
+    return None
+
+
+def _version_key(version):
+    return tuple(int(part) if part.isdigit() else -1 for part in version.split('.'))
+
+
+def get_spec(feed):
+    """
+    Returns the spec version of a feed registry record. A version that is not
+    registered resolves to the highest version registered for the feed type,
+    as newer feeds were always read as the latest known version, and a warning
+    is logged once per version.
+
+    Raises:
+        ValueError if no spec version is registered for the feed type.
+    """
+    feed_type = feed.get('feedtype') or DEFAULT_FEED_TYPE
+    spec = find_spec(feed_type, feed['version'])
+    if spec is not None:
+        return spec
+    with _lock:
+        versions = [version for spec_feed_type, version in _specs if spec_feed_type == feed_type]
+        if not versions:
+            raise ValueError('No spec registered for feed type {}'.format(feed_type))
+        version = max(versions, key=_version_key)
+        warn = (feed_type, str(feed['version'])) not in _fallbacks_warned
+        _fallbacks_warned.add((feed_type, str(feed['version'])))
+        spec = _specs[(feed_type, version)]
+    if warn:
+        logger.warning('No spec registered for {} version {}, reading it as version {}'.format(
+            feed_type, feed['version'], version))
+    return spec
+
+
+def all_header_field_names():
+    """
+    Returns the header field names of every registered spec version.
+
+    """
+    with _lock:
+        specs = list(_specs.values())
+    return sorted({name for spec in specs for name in spec.header_field_names})
+
+
+def resolve_feed(feed, data):
+    """
+    Returns the FeedLayout of a parsed feed from the feed's registry record.
+
+    """
+    return get_spec(feed).resolve(data)
+
+
+register_spec(WzdxV1Spec(), '1')
+register_spec(WzdxV2Spec(), '2')
+register_spec(WzdxV3Spec(), '3')
+register_spec(WzdxV4Spec(), '4')
@@ -3,7 +3,7 @@ Class for working with ITS Work Zone Sandboxes.
 
 """
 from copy import deepcopy
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import dateutil.parser
 import json
 import logging
@@ -11,20 +11,36 @@ import requests
 import xmltodict
 import traceback
 import csv
-import multiprocessing
-
-from wzdx_sandbox.s3_helper import S3Helper
+import itertools
+import time
+
+from wzdx_sandbox import codec
+from wzdx_sandbox.compression import get_compression
+from wzdx_sandbox.digest_index import FeedDigestIndex
+from wzdx_sandbox.executor import create_executor, TaskQueue, TaskFailures, DEFAULT_MAX_WORKERS
+from wzdx_sandbox.fetch_state import FeedFetchState
+from wzdx_sandbox.feed_stream import iter_json_feed, iter_xml_feed, CHUNK_SIZE
+from wzdx_sandbox.http_session import create_http_session, DEFAULT_MAX_CONNECTIONS_PER_HOST, DEFAULT_TIMEOUT
+from wzdx_sandbox.ingest_report import IngestReport
+from wzdx_sandbox.record_diff import DEFAULT_IGNORE_PATHS, canonical_hash, compile_paths, diff_records
+from wzdx_sandbox.record_store import create_record_store
+from wzdx_sandbox.s3_helper import S3Helper, retry_on_conflict
+from wzdx_sandbox.spatial_index import FeedSpatialIndex, make_entry, month_prefixes, query_index
+from wzdx_sandbox.spec_registry import all_header_field_names, find_spec, get_spec, resolve_feed
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)  # necessary to make sure aws is logging
 
+# feed URLs by (state, feedname), per URL file, read once per container
+_url_dicts = {}
+
 
 class ITSSandbox(object):
     """ 
     Base class for working with ITS Sandbox.
 
     """
-    def __init__(self, bucket, aws_profile=None, logger=None):
+    def __init__(self, bucket, aws_profile=None, logger=None, s3helper=None, max_pool_connections=None):
         """
         Initialization function of the ITSSandbox class.
 
@@ -38,9 +54,12 @@ class ITSSandbox(object):
             logger: Optional parameter. Could pass in a logger object or not pass
                 in anything. If a logger object is passed in, information will be
                 logged instead of printed. If not, information will be printed.
+            s3helper: Optional S3Helper object to use instead of creating one.
+            max_pool_connections: Optional number of concurrent S3 connections,
+                if the S3Helper is created here.
         """
         self.bucket = bucket
-        self.s3helper = S3Helper(aws_profile=aws_profile)
+        self.s3helper = s3helper or S3Helper(aws_profile=aws_profile, max_pool_connections=max_pool_connections)
         self.print_func = print
         if logger:
             self.print_func = logger.info
@@ -55,8 +74,9 @@ class WorkZoneRawSandbox(ITSSandbox):
 
     """
     def __init__(self, bucket, feed=None, lambda_to_trigger=None,
-                socrata_lambda_to_trigger=None,
-                **kwargs):
+                socrata_lambda_to_trigger=None, compression=None, compression_level=None,
+                url_dict=None, lambda_client=None, conditional_fetch=False, chunk_size=CHUNK_SIZE,
+                dispatcher=None, state_bucket=None, **kwargs):
         """
         Initialization function of the WorkZoneRawSandbox class.
 
@@ -67,6 +87,28 @@ class WorkZoneRawSandbox(ITSSandbox):
                 fields (e.g. ':id').
             lambda_to_trigger: Name of the feed ingestion-parsing lambda function you'd like
                 to invoke.
+            compression: Optional compression of the raw feed objects, 'gzip' or
+                'zstd' (see wzdx_sandbox.compression). Compressed objects get the
+                extension of the compression (e.g. '.gz').
+            compression_level: Optional compression level.
+            url_dict: Optional dictionary of feed URLs keyed by (state, feedname).
+                If not given, URLs are read from WZDx_URLs.csv.
+            lambda_client: Optional boto3 lambda client used to trigger the
+                downstream lambdas. If not given, the shared client of the AWS profile is used.
+            conditional_fetch: Optional. If True, the validators and content hash
+                of the feed's last snapshot are kept in the state_bucket (see
+                wzdx_sandbox.fetch_state), the feed is requested conditionally,
+                and a snapshot that did not change is recorded with a small
+                '__UNCHANGED' marker object instead of a full copy, without
+                triggering the downstream lambdas.
+            chunk_size: Optional number of bytes read from the feed response at a
+                time while it is streamed to S3.
+            dispatcher: Optional wzdx_sandbox.dispatch.Dispatcher object with a
+                'lake' and/or a 'socrata' queue. Snapshots are added to the queues
+                it has instead of invoking the matching downstream lambdas, and are
+                sent when the dispatcher is flushed.
+            state_bucket: Optional name of the AWS S3 bucket internal state is
+                kept in (the fetch state). Required if conditional_fetch is True.
             aws_profile: Optional string name of your AWS profile, as set up in
                 the credential file at ~/.aws/credentials. No need to pass in
                 this parameter if you will be using your default profile. For
@@ -76,33 +118,70 @@ class WorkZoneRawSandbox(ITSSandbox):
                 in anything. If a logger object is passed in, information will be
                 logged instead of printed. If not, information will be printed.
         """
+        if conditional_fetch and state_bucket is None:
+            raise ValueError('state_bucket is required for conditional fetches')
         super(WorkZoneRawSandbox, self).__init__(bucket, **kwargs)
         self.prefix_template = 'state={state}/feedName={feedname}/year={year}/month={month}/'
         self.feed = feed
         self.lambda_to_trigger = lambda_to_trigger
         self.socrata_lambda_to_trigger = socrata_lambda_to_trigger
-        self.url_dict = {}
-        self.read_urls()
+        self.compression = compression
+        self.compression_level = compression_level
+        self.extension = get_compression(compression).extension if compression else ''
+        self.url_dict = url_dict
+        self.lambda_client = lambda_client
+        self.conditional_fetch = conditional_fetch
+        self.state_bucket = state_bucket
+        self.chunk_size = chunk_size
+        self.dispatcher = dispatcher
+        if url_dict is None:
+            self.read_urls()
         # variables necessary to update last ingest time to Socrata WZDx feed registry
         # this is currently done in the previous lambda function "wzdx_trigger_ingest".
         # leaving the block below in case we move the step to this function
 
-    def read_urls(self):
-        header = True
-        with open('WZDx_URLs.csv') as in_f:
-            for line in in_f:
-                if header:
-                    header = False
-                    continue
-                row = line.strip('\n').split(',')
-                self.url_dict[(row[0],row[1])] = row[2]
+    def read_urls(self, path='WZDx_URLs.csv'):
+        self.url_dict = read_url_dict(path)
 
-    def ingest(self):
+    def ingest(self, session=None, timeout=None):
         """
         Method to ingest the raw feed to the ITS Work Zone Raw Sandbox and trigger
         the lambda that will ingest and process the feed further to the ITS Work
         Zone Semi-processed Sandbox.
 
+        Parameters:
+            session: Optional requests session to fetch the feed with (see
+                wzdx_sandbox.http_session), so that connections are reused.
+            timeout: Optional timeout of the feed request in seconds, or a
+                (connect, read) tuple.
+        Returns:
+            S3 key of the raw feed object, of the '__UNCHANGED' marker object if
+            the feed did not change since the last fetch, or None if the feed did
+            not respond with status code 200 or 304.
+        """
+        snapshot = self.fetch(session, timeout)
+        if snapshot['key'] is not None and not snapshot['unchanged']:
+            self.trigger_downstream(snapshot['key'])
+        return snapshot['key']
+
+    def fetch(self, session=None, timeout=None, keep_content=False):
+        """
+        Method to ingest the raw feed to the ITS Work Zone Raw Sandbox without
+        triggering the downstream lambdas.
+
+        Parameters:
+            session: Optional requests session to fetch the feed with (see
+                wzdx_sandbox.http_session), so that connections are reused.
+            timeout: Optional timeout of the feed request in seconds, or a
+                (connect, read) tuple.
+            keep_content: Optional. If True, the body of a new snapshot is also
+                kept in memory and returned, so that it can be processed further
+                without reading it back from S3 (see wzdx_sandbox.pipeline).
+        Returns:
+            Dictionary object {'key', 'unchanged', 'content'}. key is as returned
+            by ingest, unchanged is True if key is an '__UNCHANGED' marker object,
+            and content is the uncompressed body of a new snapshot if keep_content
+            is True, otherwise None.
         """
         datetime_retrieved = datetime.now()
         prefix = self.prefix_template.format(**self.feed, year=datetime_retrieved.strftime('%Y'), month=datetime_retrieved.strftime('%m'))
@@ -113,17 +192,33 @@ class WorkZoneRawSandbox(ITSSandbox):
         )
 
         url_to_request = self.url_dict[(self.feed['state'],self.feed['feedname'])]
+        headers = {}
+        if self.conditional_fetch:
+            fetch_state = FeedFetchState(self.s3helper, self.state_bucket,
+                'state={state}/feedName={feedname}/'.format(**self.feed)).load()
+            headers = fetch_state.request_headers()
+        body = []
+        result = None
         try:
-            r = requests.get(url_to_request)
-            if r.status_code == 200:
-                data_to_write = r.content
-                self.s3helper.write_bytes(data_to_write, self.bucket, key=prefix+fp)
-                self.print_func('Raw data ingested from {} to {} at {} UTC'.format(url_to_request, prefix+fp, datetime_retrieved))
-            else:
-                self.print_func('Received status code {} from {} feed.'.format(r.status_code,self.feed['feedname']))
-                self.print_func('Skip triggering ingestion of {} to sandbox.'.format(self.feed['feedname']))
-                self.print_func('Skip triggering ingestion of {} to Socrata.'.format(self.feed['feedname']))
-                return
+            # the body is streamed to S3 in parts, so memory use does not grow with the size of the feed
+            r = (session or requests).get(url_to_request, headers=headers, timeout=timeout, stream=True)
+            try:
+                if r.status_code == 200:
+                    def commit(digest):
+                        # an unchanged snapshot is dropped before its upload completes
+                        return not (self.conditional_fetch and fetch_state.matches(digest))
+
+                    def chunks():
+                        for chunk in r.iter_content(self.chunk_size):
+                            if keep_content:
+                                body.append(chunk)
+                            yield chunk
+
+                    result = self.s3helper.write_stream(chunks(), self.bucket,
+                        prefix+fp+self.extension, compression=self.compression, level=self.compression_level,
+                        commit=commit)
+            finally:
+                r.close()
         except BaseException as e:
             data_to_write = f'The feed at {datetime_retrieved.isoformat()}.'.encode('utf-8')
             fp += '__FEED_NOT_RETRIEVED'
@@ -131,12 +226,55 @@ class WorkZoneRawSandbox(ITSSandbox):
             self.print_func('We could not ingest data from {} at {} UTC'.format(url_to_request, datetime_retrieved))
             raise e
 
+        # a 304 only means unchanged in answer to the conditional request headers
+        unchanged = (self.conditional_fetch and r.status_code == 304) or (result is not None and not result['committed'])
+        if unchanged:
+            fp += '__UNCHANGED'
+            marker = {'status_code': r.status_code, 'sha256': fetch_state.state.get('sha256'),
+                      'key': fetch_state.state.get('key')}
+            self.s3helper.write_bytes(codec.dumps(marker), self.bucket, key=prefix+fp)
+            self.print_func('{} feed unchanged since {}. Skip triggering ingestion to sandbox and Socrata.'.format(
+                self.feed['feedname'], marker['key']))
+            return {'key': prefix+fp, 'unchanged': True, 'content': None}
+        if r.status_code != 200:
+            self.print_func('Received status code {} from {} feed.'.format(r.status_code,self.feed['feedname']))
+            self.print_func('Skip triggering ingestion of {} to sandbox.'.format(self.feed['feedname']))
+            self.print_func('Skip triggering ingestion of {} to Socrata.'.format(self.feed['feedname']))
+            return {'key': None, 'unchanged': False, 'content': None}
+        fp += self.extension
+        self.print_func('Raw data ingested from {} to {} at {} UTC ({} bytes, {} bytes stored)'.format(
+            url_to_request, prefix+fp, datetime_retrieved, result['n_bytes'], result['n_bytes_written']))
+        if self.conditional_fetch:
+            fetch_state.save(r, result['sha256'], prefix+fp)
+
+        return {'key': prefix+fp, 'unchanged': False, 'content': b''.join(body) if keep_content else None}
+
+    def trigger_downstream(self, key):
+        """
+        Triggers the lake lambda and, if the feed is piped to Socrata, the
+        Socrata lambda for a raw feed object.
+
+        Parameters:
+            key: S3 key of the raw feed object.
+        """
         # trigger semi-parse ingest
-        self.print_func('Trigger {} for {}'.format(self.lambda_to_trigger, self.feed['feedname']))
-        lambda_client = self.s3helper.session.client('lambda')
-        data_to_send = {'feed': self.feed, 'bucket': self.bucket, 'key': prefix+fp}
+        self._trigger('lake', self.lambda_to_trigger, key)
+
+        # trigger ingest to socrata
+        if self.feed['pipedtosocrata'] == True:
+            self._trigger('socrata', self.socrata_lambda_to_trigger, key)
+        else:
+            self.print_func('Skip triggering ingestion of {} to Socrata.'.format(self.feed['feedname']))
+
+    def _trigger(self, target, function_name, key):
+        if self.dispatcher is not None and self.dispatcher.has_target(target):
+            self.dispatcher.add(target, self.feed, self.bucket, key)
+            return
+        self.print_func('Trigger {} for {}'.format(function_name, self.feed['feedname']))
+        lambda_client = self.lambda_client or self.s3helper.get_client('lambda')
+        data_to_send = {'feed': self.feed, 'bucket': self.bucket, 'key': key}
         response = lambda_client.invoke(
-            FunctionName=self.lambda_to_trigger,
+            FunctionName=function_name,
             InvocationType='Event',
             LogType='Tail',
             ClientContext='',
@@ -144,21 +282,86 @@ class WorkZoneRawSandbox(ITSSandbox):
         )
         self.print_func(response)
 
-        # trigger ingest to socrata
-        if self.feed['pipedtosocrata'] == True:
-            self.print_func('Trigger {} for {}'.format(self.socrata_lambda_to_trigger, self.feed['feedname']))
-            lambda_client = self.s3helper.session.client('lambda')
-            data_to_send = {'feed': self.feed, 'bucket': self.bucket, 'key': prefix+fp}
-            response = lambda_client.invoke(
-                FunctionName=self.socrata_lambda_to_trigger,
-                InvocationType='Event',
-                LogType='Tail',
-                ClientContext='',
-                Payload=json.dumps(data_to_send).encode('utf-8')
-            )
-            self.print_func(response)
-        else:
-            self.print_func('Skip triggering ingestion of {} to Socrata.'.format(self.feed['feedname']))
+
+def read_url_dict(path='WZDx_URLs.csv'):
+    """
+    Reads the feed URL file once per container.
+
+    Parameters:
+        path: Optional path of the CSV file of feed URLs, with state, feed name
+            and URL columns.
+    Returns:
+        Dictionary of feed URLs keyed by (state, feedname).
+    """
+    if path not in _url_dicts:
+        url_dict = {}
+        header = True
+        with open(path) as in_f:
+            for line in in_f:
+                if header:
+                    header = False
+                    continue
+                row = line.strip('\n').split(',')
+                url_dict[(row[0],row[1])] = row[2]
+        _url_dicts[path] = url_dict
+    return _url_dicts[path]
+
+
+def ingest_raw_feeds(feeds, bucket, max_workers=None, max_connections_per_host=DEFAULT_MAX_CONNECTIONS_PER_HOST,
+                     timeout=DEFAULT_TIMEOUT, timeouts=None, session=None, **kwargs):
+    """
+    Ingests many raw feeds concurrently, with one keep-alive HTTP session and
+    one S3Helper shared by all feeds. Each feed is written to the ITS Work Zone
+    Raw Sandbox, and its downstream lambdas triggered, as soon as it has been
+    fetched. A feed that fails does not stop the others.
+
+    Parameters:
+        feeds: Array of feed dictionary objects, as for WorkZoneRawSandbox. A feed's
+            'compression' field, if set, overrides the compression argument.
+        bucket: Name of the AWS S3 bucket that contains the ITS Work Zone Raw Sandbox.
+        max_workers: Optional maximum number of feeds fetched at the same time.
+        max_connections_per_host: Optional maximum number of concurrent
+            connections to any one host, for feeds served from the same host.
+        timeout: Optional default timeout of each feed request in seconds, or a
+            (connect, read) tuple.
+        timeouts: Optional dictionary of timeouts keyed by feed name, for feeds
+            that need a timeout other than the default.
+        session: Optional requests session to use instead of creating one.
+        **kwargs: Other arguments of WorkZoneRawSandbox (e.g. lambda_to_trigger,
+            compression, logger, s3helper, dispatcher). A dispatcher is flushed
+            once all feeds are done.
+    Returns:
+        Array of {'feedname', 'key', 'error'} dictionary objects, one per feed,
+        in the order of feeds. key is None if nothing was ingested, and error
+        is the repr of the exception raised for the feed, if any.
+    """
+    timeouts = timeouts or {}
+    session = session or create_http_session(max_connections_per_host)
+    if 'url_dict' not in kwargs:
+        kwargs['url_dict'] = read_url_dict()
+    if 's3helper' not in kwargs:
+        kwargs['s3helper'] = S3Helper(aws_profile=kwargs.pop('aws_profile', None),
+            max_pool_connections=max_workers or DEFAULT_MAX_WORKERS)
+    compression = kwargs.pop('compression', None)
+
+    def ingest_feed(feed):
+        sandbox = WorkZoneRawSandbox(bucket, feed=feed, compression=feed.get('compression') or compression, **kwargs)
+        return sandbox.ingest(session=session, timeout=timeouts.get(feed['feedname'], timeout))
+
+    with create_executor('thread', max_workers) as executor:
+        queue = TaskQueue(executor)
+        for i, feed in enumerate(feeds):
+            queue.submit(i, ingest_feed, feed)
+        try:
+            keys = queue.results()
+            errors = {}
+        except TaskFailures as e:
+            keys = e.results
+            errors = dict(e.failures)
+    if kwargs.get('dispatcher') is not None:
+        kwargs['dispatcher'].flush()
+    return [{'feedname': feed['feedname'], 'key': keys[i], 'error': repr(errors[i]) if i in errors else None}
+            for i, feed in enumerate(feeds)]
 
 
 class WorkZoneSandbox(ITSSandbox):
@@ -166,7 +369,10 @@ class WorkZoneSandbox(ITSSandbox):
     Class for working with ITS Work Zone Sandbox.
 
     """
-    def __init__(self, bucket, feed=None, **kwargs):
+    def __init__(self, bucket, feed=None, executor_type='thread', max_workers=None,
+                layout='ndjson', use_digest_index=False, ignore_paths=DEFAULT_IGNORE_PATHS,
+                compression=None, compression_level=None, use_spatial_index=False, dedup_headers=False,
+                conditional_writes=False, skip_replayed=False, state_bucket=None, **kwargs):
         """
         Initialization function of the WorkZoneSandbox class.
 
@@ -175,6 +381,51 @@ class WorkZoneSandbox(ITSSandbox):
             feed: Dictionary object. Should be a record read from the WZDx feed
                 registry Socrata dataset, with all fields, including the system
                 fields (e.g. ':id').
+            executor_type: Optional. 'thread' (default) or 'process'. Type of
+                worker pool used to process work zone statuses concurrently.
+            max_workers: Optional maximum number of concurrent workers used to
+                process work zone statuses.
+            layout: Optional. Storage layout of the monthly work zone files, see
+                wzdx_sandbox.record_store. 'ndjson' (default) keeps one newline
+                JSON object per work zone file, 'segmented' keeps one part object
+                per status plus a small manifest so that updates do not rewrite
+                the whole monthly history.
+            use_digest_index: Optional. If True, a per feed-month index of the
+                digest of the last status of each work zone file is kept in
+                state_bucket (see wzdx_sandbox.digest_index), and statuses that
+                match it are skipped without reading their work zone file. The
+                digest only covers the work zone activity without ignore_paths
+                (see status_digest), so a status that is unchanged but for its
+                update time is skipped rather than written over the last one.
+            ignore_paths: Optional list of dotted paths of work zone activity fields
+                (e.g. 'properties.update_date') that are ignored when deciding if a
+                status changed. Defaults to the top-level 'update_date' field only;
+                add wzdx_sandbox.record_diff.GEOJSON_UPDATE_DATE_PATHS to also
+                ignore the update date fields of the GeoJSON spec versions.
+            compression: Optional compression of the work zone files, 'gzip' or
+                'zstd' (see wzdx_sandbox.compression). Compressed work zone files
+                get the extension of the compression (e.g. '.gz'), so files written
+                before compression was turned on are not appended to.
+            compression_level: Optional compression level.
+            use_spatial_index: Optional. If True, a per feed-month index of the
+                bounding box and start, end and update times of each status
+                written is kept (see wzdx_sandbox.spatial_index), for query.
+            dedup_headers: Optional. If True, each distinct feed header is stored
+                once per feed-month and records only hold a reference to it (see
+                wzdx_sandbox.record_store.HeaderDedupRecordStore). Records are
+                read back in their original shape.
+            conditional_writes: Optional. If True, work zone files and indexes
+                are written only if they did not change since they were read
+                (S3 conditional writes). A status whose work zone file was
+                changed by another ingest of the same feed in the meantime is
+                compared again with the file as it now is, so that overlapping
+                ingests can run at the same time without losing statuses.
+            skip_replayed: Optional. If True, a status whose feed update time
+                is not newer than the last record of its work zone file is
+                skipped, so that snapshots delivered again (e.g. by SQS after a
+                failure) do not append statuses that were already ingested.
+            state_bucket: Optional name of the AWS S3 bucket internal state is
+                kept in (the digest index). Required if use_digest_index is True.
             aws_profile: Optional string name of your AWS profile, as set up in
                 the credential file at ~/.aws/credentials. No need to pass in
                 this parameter if you will be using your default profile. For
@@ -184,24 +435,103 @@ class WorkZoneSandbox(ITSSandbox):
                 in anything. If a logger object is passed in, information will be
                 logged instead of printed. If not, information will be printed.
         """
+        # one S3 connection per worker thread
+        kwargs.setdefault('max_pool_connections', max_workers or DEFAULT_MAX_WORKERS)
         super(WorkZoneSandbox, self).__init__(bucket, **kwargs)
         self.prefix_template = 'state={state}/feedName={feedname}/year={year}/month={month}/'
         self.feed = feed
+        self.executor_type = executor_type
+        self.max_workers = max_workers
+        self.layout = layout
+        if use_digest_index and state_bucket is None:
+            raise ValueError('state_bucket is required for the digest index')
+        self.use_digest_index = use_digest_index
+        self.state_bucket = state_bucket
+        self.use_spatial_index = use_spatial_index
+        self.dedup_headers = dedup_headers
+        self.conditional_writes = conditional_writes
+        self.skip_replayed = skip_replayed
+        self.ignore_paths = list(ignore_paths)
+        self.ignore_tree = compile_paths(self.ignore_paths)
+        self.compression = compression
+        self.compression_level = compression_level
+        self.record_store = create_record_store(layout, self.s3helper, bucket, compression, compression_level,
+            dedup_headers=dedup_headers, header_field_names=all_header_field_names(), conditional=conditional_writes)
 
         self.n_new_status = 0
         self.n_overwrite = 0
         self.n_new_fps = 0
         self.n_skipped = 0
 
-    def process_records(self, key, data, status, name, statuses):
-        out_rec = data(status)
-        if self.s3helper.path_exists(self.bucket, key):
-            out_recs = self.combine_with_existing_recs(key, data, name)
-        else:
-            out_recs = [out_rec]
-            self.n_new_fps += 1
-        if out_recs is not None:
-            self.s3helper.write_recs(out_recs, self.bucket, key)
+    def read_recs(self, key):
+        """
+        Method to read the full monthly history of a work zone, regardless of
+        the storage layout.
+
+        Parameters:
+            key: S3 key of the monthly work zone file.
+        Returns:
+            Array of dictionary objects, oldest first.
+        """
+        return self.record_store.read_recs(key)
+
+    def process_records(self, key, out_rec, field_name_tuple, listing=None, digest=None):
+        """
+        Method to merge one work zone status into its monthly work zone file.
+
+        Parameters:
+            key: S3 key of the monthly work zone file.
+            out_rec: Dictionary object of the work zone status to be ingested.
+            field_name_tuple: Tuple consisting of field names for feed header (feed
+                metadata), last updated timestamp, and activity list, in that order.
+            listing: Optional dictionary of existing objects under the key's prefix,
+                as returned by S3Helper.list_prefix. If not given, existence of the
+                key is checked with a HEAD request.
+            digest: Optional canonical hash of out_rec, if already computed.
+        Returns:
+            Tuple of the outcome of the status ('skipped', 'overwrite',
+            'new_status' or 'new_fp'), its record offset in the work zone file
+            (None if skipped or not known), and the IngestReport object of this
+            status, with its outcome, S3 usage and phase times.
+        """
+        report = IngestReport()
+        report.n_statuses = 1
+        with self.s3helper.collect(report):
+            if self.conditional_writes:
+                # after a conflict, the file is looked up again, as another ingest may have just created it
+                outcome, diffs, offset = retry_on_conflict(lambda attempt: self._merge_status(
+                    key, out_rec, field_name_tuple, listing if not attempt else None, digest, report))
+            else:
+                outcome, diffs, offset = self._merge_status(key, out_rec, field_name_tuple, listing, digest, report)
+        if diffs:
+            report.add_changed_fields(diffs)
+        report.add_outcome(outcome)
+        return outcome, offset, report
+
+    def _merge_status(self, key, out_rec, field_name_tuple, listing, digest, report):
+        with report.timer('diff'):
+            diffs = None
+            if self.record_store.exists(key, listing):
+                tail = self.record_store.read_tail(key)
+                outcome = self.compare_with_existing_recs(out_rec, tail.recs, field_name_tuple, digest)
+                if outcome == 'new_status':
+                    activity_list_field_name = field_name_tuple[2]
+                    diffs = diff_records(
+                        tail.recs[-1][activity_list_field_name][0],
+                        out_rec[activity_list_field_name][0],
+                        self.ignore_tree)
+            else:
+                tail = None
+                outcome = 'new_fp'
+        offset = None
+        with report.timer('write'):
+            if outcome == 'overwrite':
+                self.record_store.replace_last(key, out_rec, tail)
+                offset = tail.n_recs - 1 if tail.n_recs is not None else None
+            elif outcome in ('new_status', 'new_fp'):
+                self.record_store.append(key, out_rec, tail)
+                offset = 0 if tail is None else tail.n_recs
+        return outcome, diffs, offset
 
     def ingest(self, data):
         """
@@ -211,35 +541,191 @@ class WorkZoneSandbox(ITSSandbox):
         Parameters:
             data: Raw string data from feed archive sandbox. Could be stringified
                 JSON object or XML.
+        Returns:
+            IngestReport object aggregated over all work zone statuses in the feed.
         """
+        start = time.perf_counter()
+        report = IngestReport(feedname=self.feed['feedname'])
         self.print_func('Ingesting data from {} feed.'.format(self.feed['feedname']))
-        data = self.parse_to_json(data)
-        new_statuses, generate_out_rec, prefix, field_name_tuple = self.generate_fp_status_dict(data)
-
-        num_threads = 3
-        processes = {}
-
-        count = 0
-        for fp, current_status in new_statuses.items():
-            key = prefix+fp
-            if count < num_threads:
-                processes[count] = multiprocessing.Process(target=self.process_records, args=(
-                key, generate_out_rec, current_status, field_name_tuple, new_statuses,))
-                processes[count].start()
-            else:
-                for i in range(num_threads):
-                    processes[i].join()
-                count = 0
-                processes[count] = multiprocessing.Process(target=self.process_records, args=(
-                key, generate_out_rec, current_status, field_name_tuple, new_statuses,))
-                processes[count].start()
-            count += 1
+        with report.timer('parse'):
+            data = self.parse_to_json(data)
+        with report.timer('fingerprint'):
+            new_statuses, generate_out_rec, prefix, field_name_tuple = self.generate_fp_status_dict(data)
+            statuses = [(prefix+fp, generate_out_rec(status)) for fp, status in new_statuses.items()]
+        self.process_statuses(statuses, prefix, field_name_tuple, report)
+        return self._finish_ingest(report, start)
+
+    def ingest_stream(self, datastream, chunk_size=CHUNK_SIZE):
+        """
+        Method to ingest and parse the raw feed from the ITS Work Zone Raw Sandbox
+        to the ITS Work Zone Semi-processed Sandbox while it is being read. Work
+        zone statuses are fingerprinted as they are parsed, without keeping the
+        raw feed or its parsed document in memory. As in ingest, a work zone that
+        appears more than once in the feed keeps only its last status, so the
+        statuses are written once the whole feed has been read.
 
-        for i in range(len(processes)):
-            processes[i].join()
+        Parameters:
+            datastream: "Readable" file datastream object of the raw feed (e.g. as
+                returned by S3Helper.get_data_stream).
+            chunk_size: Optional number of bytes read from the stream at a time.
+        Returns:
+            IngestReport object aggregated over all work zone statuses in the feed.
+        """
+        feed_format = self.feed['format']
+        spec = get_spec(self.feed)
+        if feed_format == 'xml':
+            events = iter_xml_feed(datastream, spec.activity_list_field_name, chunk_size)
+        elif feed_format in ['json', 'geojson'] and spec.root_field_name is None:
+            events = iter_json_feed(datastream, spec.activity_list_field_name, chunk_size)
+        else:
+            return self.ingest(datastream.read())
+
+        start = time.perf_counter()
+        report = IngestReport(feedname=self.feed['feedname'])
+        self.print_func('Ingesting data stream from {} feed.'.format(self.feed['feedname']))
+        events = _timed(events, report, 'parse')
+        activities = (value for event, value in events if event == 'activity')
+        _, doc = next(events)
+        first = next(activities, None)
+        try:
+            with report.timer('fingerprint'):
+                generate_status_fp, generate_out_rec, prefix, field_name_tuple = self.get_feed_context(doc)
+                if first is not None:
+                    generate_out_rec(first)
+        except KeyError:
+            # the feed header comes after the activity list, so the whole feed has to be read first
+            activities = list(activities)
+            with report.timer('fingerprint'):
+                generate_status_fp, generate_out_rec, prefix, field_name_tuple = self.get_feed_context(doc)
+        if first is not None:
+            activities = itertools.chain([first], activities)
+
+        # as in generate_fp_status_dict, the last status of a work zone replaces the earlier ones
+        latest = {}
+        for activity in activities:
+            with report.timer('fingerprint'):
+                latest[prefix+generate_status_fp(activity)] = activity
+
+        def statuses():
+            for key, activity in latest.items():
+                with report.timer('fingerprint'):
+                    status = (key, generate_out_rec(activity))
+                yield status
+
+        self.process_statuses(statuses(), prefix, field_name_tuple, report)
+        return self._finish_ingest(report, start)
+
+    def list_month(self, prefix):
+        """
+        Method to list the objects of a feed-month, as returned by
+        S3Helper.list_prefix.
+
+        """
+        return self.s3helper.list_prefix(self.bucket, prefix, delimiter='/')
 
+    def process_statuses(self, statuses, prefix, field_name_tuple, report):
+        """
+        Method to process work zone statuses of one feed-month concurrently, as
+        they are produced.
+
+        Parameters:
+            statuses: Iterable of (S3 key, record) tuples.
+            prefix: Feed-month prefix of the work zone files.
+            field_name_tuple: Tuple consisting of field names for feed header (feed
+                metadata), last updated timestamp, and activity list, in that order.
+            report: IngestReport object the outcomes are added to.
+        Raises:
+            TaskFailures if any status could not be processed, after all others were.
+        """
+        with report.timer('diff'), self.s3helper.collect(report):
+            # one listing of the month's prefix answers existence for every work zone file
+            listing = self.list_month(prefix)
+            if self.use_digest_index:
+                digest_index = FeedDigestIndex(self.s3helper, self.state_bucket, prefix,
+                    conditional=self.conditional_writes).load()
+            if self.use_spatial_index:
+                spatial_index = FeedSpatialIndex(self.s3helper, self.bucket, prefix,
+                    conditional=self.conditional_writes)
+        if self.executor_type == 'process':
+            # workers cannot share this object's boto3 client, so each worker process builds its own sandbox
+            sandbox_args = {'bucket': self.bucket, 'feed': self.feed, 'layout': self.layout,
+                'ignore_paths': self.ignore_paths, 'compression': self.compression,
+                'compression_level': self.compression_level, 'dedup_headers': self.dedup_headers,
+                'conditional_writes': self.conditional_writes, 'skip_replayed': self.skip_replayed,
+                'aws_profile': self.s3helper.aws_profile}
+
+        keys = []
+        digests = {}
+        index_entries = []
+        error = None
+        failures = None
+        with create_executor(self.executor_type, self.max_workers) as executor:
+            queue = TaskQueue(executor, max_pending=4 * (self.max_workers or DEFAULT_MAX_WORKERS))
+            try:
+                for key, out_rec in statuses:
+                    digest = None
+                    if self.use_digest_index:
+                        with report.timer('fingerprint'):
+                            digest = self.status_digest(out_rec, field_name_tuple)
+                        # statuses unchanged since the last record written are skipped without any per-key I/O
+                        if digest_index.matches(key, digest) and self.record_store.exists(key, listing):
+                            report.n_statuses += 1
+                            report.add_outcome('skipped')
+                            continue
+                    # the same work zone may appear more than once in a feed
+                    queue.wait_for(key)
+                    keys.append(key)
+                    digests[key] = digest
+                    if self.use_spatial_index:
+                        with report.timer('fingerprint'):
+                            index_entries.append(self.get_index_entry(out_rec))
+                    if self.executor_type == 'process':
+                        # only ship each worker the listing entry of its own key
+                        object_key = self.record_store.object_key(key)
+                        worker_listing = {object_key: listing[object_key]} if object_key in listing else {}
+                        queue.submit(key, _process_records_in_worker, sandbox_args, key, out_rec,
+                            field_name_tuple, worker_listing)
+                    else:
+                        queue.submit(key, self.process_records, key, out_rec, field_name_tuple, listing)
+            except Exception as e:
+                # e.g. a feed that cannot be parsed past some point; statuses already submitted still count
+                error = e
+            try:
+                results = queue.results()
+            except TaskFailures as e:
+                for key, err in e.failures:
+                    self.print_func('Failed to process {}: {!r}'.format(key, err))
+                failures = e
+                results = e.results
+        if self.use_digest_index:
+            # the last record of every successfully processed work zone file is now the current status
+            for key, result in zip(keys, results):
+                if result is not None:
+                    digest_index.update(key, digests[key])
+            with self.s3helper.collect(report):
+                digest_index.save()
+        if self.use_spatial_index:
+            with self.s3helper.collect(report):
+                for key, result, entry in zip(keys, results, index_entries):
+                    if result is not None and result[0] != 'skipped':
+                        spatial_index.update(key, result[0], entry, offset=result[1])
+                spatial_index.save()
+        if error is not None:
+            raise error
+        if failures is not None:
+            raise failures
+        for _, _, status_report in results:
+            report.merge(status_report)
+
+    def _finish_ingest(self, report, start):
+        report.wall_seconds = time.perf_counter() - start
+        self.n_skipped = report.outcomes['skipped']
+        self.n_overwrite = report.outcomes['overwrite']
+        self.n_new_status = report.outcomes['new_status']
+        self.n_new_fps = report.outcomes['new_fp']
         self.print_func('{} status found in {} feed: {} skipped, {} overwrites, {} updates, {} new files'.format(
-        len(new_statuses), self.feed['feedname'], self.n_skipped, self.n_overwrite, self.n_new_status, self.n_new_fps))
+        report.n_statuses, self.feed['feedname'], self.n_skipped, self.n_overwrite, self.n_new_status, self.n_new_fps))
+        return report
 
     def parse_to_json(self, data):
         """
@@ -256,10 +742,9 @@ class WorkZoneSandbox(ITSSandbox):
             if type(data) == dict:
                 out = data
             elif feed_format == 'xml':
-                xmldict = xmltodict.parse(data)
-                out = json.loads(json.dumps(xmldict))
+                out = xmltodict.parse(data, dict_constructor=dict)
             elif feed_format in ['json', 'geojson']:
-                out = json.loads(data)
+                out = codec.loads(data)
             else:
                 out = data
             return out
@@ -270,102 +755,138 @@ class WorkZoneSandbox(ITSSandbox):
             self.print_func(traceback.format_exc())
             raise e
             
-    def generate_fp_status_dict(self, data):
-        if self.feed['version'] == '1':
-            # spec version 1
-            data = data['WZDx']
-            activity_list_field_name = 'WorkZoneActivity'
-            header_field_name = 'Header'
-            update_time_field_name = 'timeStampUpdate'
-            feed_version = data[header_field_name]['versionNo']
-            generate_out_rec = lambda activity: {header_field_name: data[header_field_name], activity_list_field_name: [activity]}
-        elif self.feed['version'] == '2':
-            # spec version 2
-            activity_list_field_name = 'features'
-            header_field_name = 'road_event_feed_info'
-            update_time_field_name = 'feed_update_date'
-            feed_version = data[header_field_name]['version']
-            generate_out_rec = lambda activity: {header_field_name: data[header_field_name], activity_list_field_name: [activity], 'type': data['type']}
-        elif '3' in self.feed['version']:
-            # spec version 3, 3.1
-            activity_list_field_name = 'features'
-            header_field_name = 'road_event_feed_info'
-            update_time_field_name = 'update_date'
-            feed_version = data[header_field_name]['version']
-            generate_out_rec = lambda activity: {header_field_name: data[header_field_name], activity_list_field_name: [activity], 'type': data['type']}
-        else:
-            #spec version 4, 4.1
-            activity_list_field_name = 'features'
-            if 'road_event_feed_info' in data:
-                header_field_name = 'road_event_feed_info'
-            else:
-                header_field_name = 'feed_info'
-            update_time_field_name = 'update_date'
-            feed_version = data[header_field_name]['version']
-            generate_out_rec = lambda activity: {header_field_name: data[header_field_name], activity_list_field_name: [activity], 'type': data['type']}
-
-        field_name_tuple = (header_field_name, update_time_field_name, activity_list_field_name)
-        
-        YYYYMM = data[header_field_name][update_time_field_name][:7].replace('-', '')
+    def get_feed_context(self, data):
+        """
+        Method to resolve the spec version specific fields of a feed (see
+        wzdx_sandbox.spec_registry).
+
+        Parameters:
+            data: Dictionary object of the feed. Only the feed header is needed,
+                the activity list may be empty.
+        Returns:
+            Tuple of a function returning the work zone file name of an activity,
+            a function wrapping an activity into the record to be stored, the
+            feed-month prefix, and the field name tuple (field names for feed
+            header, last updated timestamp, and activity list, in that order).
+        """
+        layout = resolve_feed(self.feed, data)
+        YYYYMM = layout.update_time[:7].replace('-', '')
         prefix = self.prefix_template.format(**self.feed, year=YYYYMM[:4], month=YYYYMM[-2:])
-        
-        template = '{identifier}_{beginLocation_roadDirection}_{YYYYMM}_v{version}'
-        new_statuses = {
-            self.generate_fp(
-                template, 
-                identifier=self.get_identifier_from_status(feed_version, status),
-                beginLocation_roadDirection=self.get_road_direction_from_status(feed_version, status),
-                YYYYMM=YYYYMM,
-                version=feed_version
-            ): status 
-            for status in data[activity_list_field_name]
-        }
+
+        # everything but the key fields of the activity is the same for the whole feed
+        template = '{{identifier}}_{{beginLocation_roadDirection}}_{}_v{}'.format(YYYYMM, layout.feed_version)
+        get_identifier = layout.get_identifier
+        get_road_direction = layout.get_road_direction
+        generate_status_fp = lambda status: template.format(
+            identifier=get_identifier(status),
+            beginLocation_roadDirection=get_road_direction(status)
+        )
+        return generate_status_fp, layout.generate_out_rec, prefix, layout.field_name_tuple
+
+    def generate_fp_status_dict(self, data):
+        generate_status_fp, generate_out_rec, prefix, field_name_tuple = self.get_feed_context(data)
+        activities = get_spec(self.feed).get_root(data)[field_name_tuple[2]]
+        new_statuses = {generate_status_fp(status): status for status in activities}
         return new_statuses, generate_out_rec, prefix, field_name_tuple
-    
+
     def get_identifier_from_status(self, feed_version, status):
-        if feed_version[0] == '1':
-            return status['identifier']
-        else:
-            return status['properties'].get('road_event_id') or status.get('id')
-    
+        return self._get_key_spec(feed_version).get_identifier(status)
+
     def get_road_direction_from_status(self, feed_version, status):
-        if feed_version[0] == '1':
-            return status['beginLocation']['roadDirection']
-        elif feed_version[0] == '4':
-            return status['properties']['core_details']['direction']
-        else:
-            return status['properties']['direction']
+        return self._get_key_spec(feed_version).get_road_direction(status)
 
-    def combine_with_existing_recs(self, key, out_rec, field_name_tuple):
+    def _get_key_spec(self, feed_version):
+        return find_spec(get_spec(self.feed).feed_type, feed_version) or get_spec(self.feed)
+
+    def get_index_entry(self, rec):
+        """
+        Method to build the spatio-temporal index entry of a stored work zone
+        status (see wzdx_sandbox.spatial_index.make_entry).
+
+        """
+        spec = get_spec(self.feed)
+        header = rec[spec.get_header_field_name(rec)]
+        key_spec = self._get_key_spec(header[spec.version_field_name])
+        return make_entry(key_spec, rec[spec.activity_list_field_name][0], header[spec.update_time_field_name])
+
+    def query(self, bbox=None, start=None, end=None, prefixes=None):
+        """
+        Method to find the work zone statuses of the feed that were active in a
+        bounding box during a time range, with the spatio-temporal index kept
+        when use_spatial_index is True. Only the index of each feed-month and
+        the work zone files with a matching status are read.
+
+        Parameters:
+            bbox: Optional (min longitude, min latitude, max longitude, max
+                latitude) bounding box.
+            start: Optional start of the time range, as a datetime or ISO 8601
+                string.
+            end: Optional end of the time range.
+            prefixes: Optional list of feed-month prefixes to search. Defaults
+                to the months from start to end.
+        Returns:
+            Generator of (S3 key, record offset, record) tuples.
+        """
+        if prefixes is None:
+            if start is None or end is None:
+                raise ValueError('start and end are required unless prefixes are given')
+            prefixes = month_prefixes(self.prefix_template, self.feed, start, end)
+        return query_index(self.record_store, self.s3helper, self.bucket, prefixes, bbox, start, end,
+            get_entry=self.get_index_entry)
+
+    def compare_with_existing_recs(self, out_rec, recs, field_name_tuple, digest=None):
+        """
+        Method to decide how the current work zone status should be merged with
+        the statuses previously ingested for the same work zone in the same month.
+
+        Parameters:
+            out_rec: Dictionary object of the work zone status to be ingested.
+            recs: Array of the last (at least two, if available) records previously
+                ingested for the work zone, oldest first.
+            field_name_tuple: Tuple consisting of field names for feed header (feed
+                metadata), last updated timestamp, and activity list, in that order.
+            digest: Optional canonical hash of out_rec, if already computed.
+        Returns:
+            String outcome: 'skipped', 'overwrite' or 'new_status'.
+        """
+        header_field_name, update_time_field_name, _ = field_name_tuple
+        if self.skip_replayed and _parse_utc(out_rec[header_field_name][update_time_field_name]) <= \
+                _parse_utc(recs[-1][header_field_name][update_time_field_name]):
+            # the snapshot was already ingested, or is older than one that was
+            return 'skipped'
         # if not first status for the workzone for the month
-        datastream = self.s3helper.get_data_stream(self.bucket, key)
-        recs = [json.loads(rec) for rec in datastream.iter_lines()]
-        if [out_rec] == recs[-1]:
+        if (digest or canonical_hash(out_rec)) == canonical_hash(recs[-1]):
             # skip if completely the same as previous record
-            self.print_func('Skipped')
-            self.n_skipped += 1
-            return None
+            return 'skipped'
         if len(recs) == 1:
             # if only one record so far, automatically archive first record and save current record
-            out_recs = recs + [out_rec]
-            self.n_new_status += 1
-            self.print_func('Only 1 rec and not the same')
-        else:
-            # if more than one record, compare current record with previous and previous previous record
-            if self.cmp_status([out_rec], recs[-1], recs[-2], field_name_tuple):
-                out_recs = recs[:-1] + [out_rec]
-                self.n_overwrite += 1
-            else:
-                out_recs = recs + [out_rec]
-                self.n_new_status += 1
-        return out_recs
+            return 'new_status'
+        # if more than one record, compare current record with previous and previous previous record
+        if self.cmp_status(out_rec, recs[-1], recs[-2], field_name_tuple):
+            return 'overwrite'
+        return 'new_status'
+
+    def status_digest(self, out_rec, field_name_tuple):
+        """
+        Method to compute the digest of a work zone status kept in the digest
+        index: the canonical hash of its work zone activity without the fields
+        ignored (see ignore_paths), as compared by cmp_status.
+
+        Parameters:
+            out_rec: Dictionary object of the work zone status.
+            field_name_tuple: Tuple consisting of field names for feed header (feed
+                metadata), last updated timestamp, and activity list, in that order.
+        Returns:
+            String hex digest.
+        """
+        return canonical_hash(out_rec[field_name_tuple[2]][0], self.ignore_tree)
 
     def cmp_status(self, cur_status, prev_status, prev_prev_status, field_name_tuple):
         """
         Method to check 1) if the current status is retrieved less than one day
         ago compared to the status prior to the previous status, and 2) if the
         current status matches the previous status for all fields except for
-        the fields ignored (update_date). Will return false (no overwrite)
+        the fields ignored (see ignore_paths). Will return false (no overwrite)
         if either condition is false.
 
         Parameters:
@@ -381,7 +902,6 @@ class WorkZoneSandbox(ITSSandbox):
             Boolean value showing whether or not the current status should overwrite
             the previous status.
         """
-        ignore_keys = ['update_date']
         # consider status as new if last record was at least one day ago
         header_field_name, update_time_field_name, activity_list_field_name = field_name_tuple
         time_diff = dateutil.parser.parse(cur_status[header_field_name][update_time_field_name]) - dateutil.parser.parse(prev_prev_status[header_field_name][update_time_field_name])
@@ -389,6 +909,49 @@ class WorkZoneSandbox(ITSSandbox):
             return False
 
         # if last record is more recent, consider status as new only if any non-ignored field is different
-        cur_status = {k:v for k,v in cur_status[activity_list_field_name][0].items() if k not in ignore_keys}
-        prev_status = {k:v for k,v in prev_status[activity_list_field_name][0].items() if k not in ignore_keys}
-        return cur_status == prev_status
\ No newline at end of file
+        cur_hash = canonical_hash(cur_status[activity_list_field_name][0], self.ignore_tree)
+        prev_hash = canonical_hash(prev_status[activity_list_field_name][0], self.ignore_tree)
+        return cur_hash == prev_hash
+
+def _parse_utc(value):
+    """
+    Parses a feed timestamp to an aware UTC datetime, so that timestamps with
+    and without a time zone compare. Timestamps without one are taken as UTC.
+
+    """
+    parsed = dateutil.parser.parse(value)
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+_worker_sandboxes = {}
+
+
+def _process_records_in_worker(sandbox_args, key, out_rec, field_name_tuple, listing=None, digest=None):
+    """
+    Entry point for process pool workers. Builds one WorkZoneSandbox per worker
+    process and feed, and reuses it for every subsequent task.
+
+    """
+    cache_key = json.dumps(sandbox_args, sort_keys=True, default=str)
+    if cache_key not in _worker_sandboxes:
+        _worker_sandboxes[cache_key] = WorkZoneSandbox(**sandbox_args)
+    return _worker_sandboxes[cache_key].process_records(key, out_rec, field_name_tuple, listing, digest)
+
+
+def _timed(iterator, report, phase):
+    """
+    Wraps an iterator so that the time spent producing each item (e.g. reading
+    and parsing a feed) is added to the phase of the report.
+
+    """
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            report.add_phase_time(phase, time.perf_counter() - start)
+            return
+        report.add_phase_time(phase, time.perf_counter() - start)
+        yield item